@@ -1,4 +1,5 @@
 
+from contextlib import ExitStack
 from typing import Tuple
 from pathlib import Path
 
@@ -10,12 +11,16 @@ from pymodaq_utils.utils import ThreadCommand, getLineInfo, is_64bits, find_keys
 from pymodaq_gui.parameter.utils import iter_children
 
 
+from pipython import GCSError
+
 from pymodaq_plugins_physik_instrumente.utils import Config, get_devices_and_dlls
-from pymodaq_plugins_physik_instrumente.hardware.pi_wrapper import PIWrapper, ConnectionEnum
+from pymodaq_plugins_physik_instrumente.hardware.pi_wrapper import PIWrapper, ConnectionEnum, MotionProfile, \
+    ParameterSnapshot
 
 config = Config()
 possible_dll_names = config['dll_names']
 devices, devices_name, dll_names = get_devices_and_dlls(possible_dll_names)
+PIWrapper.position_history_size = config('pi', 'position_history_size')
 
 
 class DAQ_Move_PI(DAQ_Move_base):
@@ -65,11 +70,58 @@ class DAQ_Move_PI(DAQ_Move_base):
             {'title': 'Min:', 'name': 'min', 'type': 'float'},
             {'title': 'Max:', 'name': 'max', 'type': 'float'},
             ]},
+        {'title': 'Auto reconnect:', 'name': 'auto_reconnect', 'type': 'bool', 'value': False,
+         'tip': 'Check the link when idle and reconnect if lost, the calls waiting for it instead of failing'},
+        {'title': 'Deferred error check:', 'name': 'defer_errors', 'type': 'bool', 'value': False,
+         'tip': 'Query the controller errors once per move, the status register being read with the polled positions '
+                'to catch an error early, instead of after each command'},
+        {'title': 'On-target trigger:', 'name': 'on_target_trigger', 'type': 'group', 'children': [
+            {'title': 'Enable:', 'name': 'enable', 'type': 'bool', 'value': False,
+             'tip': 'Assert a digital output when the axis is on target, to trigger the detectors by hardware'},
+            {'title': 'Output line:', 'name': 'line', 'type': 'int', 'value': 1, 'min': 1},
+            ]},
+        {'title': 'Parameters:', 'name': 'parameters', 'type': 'group', 'children': [
+            {'title': 'File:', 'name': 'file', 'type': 'browsepath', 'value': '', 'filetype': True,
+             'tip': 'Snapshot of the controller parameters (JSON)'},
+            {'title': 'Save:', 'name': 'save', 'type': 'bool_push', 'value': False, 'label': 'Save',
+             'tip': 'Read all the controller parameters and save them in the file'},
+            {'title': 'Restore:', 'name': 'restore', 'type': 'bool_push', 'value': False, 'label': 'Restore',
+             'tip': 'Write the parameters of the file that differ from the controller ones'},
+            ]},
+        {'title': 'Position history size:', 'name': 'position_history_size', 'type': 'int',
+         'value': PIWrapper.position_history_size, 'min': 1,
+         'tip': 'Number of position readings kept by the controller for diagnostics, resizing clears them'},
+        {'title': 'Motion profiles:', 'name': 'motion_profiles', 'type': 'group', 'children': [
+            {'title': 'Use profiles:', 'name': 'use_profiles', 'type': 'bool', 'value': False,
+             'tip': 'Set the velocity, acceleration and deceleration of the current axis from the move distance'},
+            {'title': 'Scan step max distance:', 'name': 'scan_max_distance', 'type': 'float', 'value': 0.01,
+             'tip': 'Moves up to this distance use the scan profile, longer ones the move profile'},
+            {'title': 'Scan velocity:', 'name': 'scan_velocity', 'type': 'float', 'value': 0., 'min': 0.,
+             'tip': '0 to keep the controller value'},
+            {'title': 'Scan acceleration:', 'name': 'scan_acceleration', 'type': 'float', 'value': 0., 'min': 0.},
+            {'title': 'Scan deceleration:', 'name': 'scan_deceleration', 'type': 'float', 'value': 0., 'min': 0.},
+            {'title': 'Move velocity:', 'name': 'move_velocity', 'type': 'float', 'value': 0., 'min': 0.,
+             'tip': '0 to keep the controller value'},
+            {'title': 'Move acceleration:', 'name': 'move_acceleration', 'type': 'float', 'value': 0., 'min': 0.},
+            {'title': 'Move deceleration:', 'name': 'move_deceleration', 'type': 'float', 'value': 0., 'min': 0.},
+            ]},
+        {'title': 'Settling:', 'name': 'settling', 'type': 'group', 'children': [
+            {'title': 'Use settle detection:', 'name': 'use_settle', 'type': 'bool', 'value': False,
+             'tip': 'The move is done once several consecutive readings are within tolerance, instead of epsilon'},
+            {'title': 'Tolerance:', 'name': 'tolerance', 'type': 'float', 'value': 0.001, 'min': 0.,
+             'tip': 'In controller units'},
+            {'title': 'Window (readings):', 'name': 'window', 'type': 'int', 'value': 5, 'min': 1},
+            {'title': 'Last settle time (ms):', 'name': 'settle_time', 'type': 'float', 'value': 0.,
+             'readonly': True},
+            ]},
         ] + comon_parameters_fun(is_multiaxes, axis_names=stage_names, epsilon=_epsilon)
 
     def ini_attributes(self):
         self.controller: PIWrapper = None
         self.is_referencing_function = True
+        self._motion_profiles_values = {}  # values of the motion_profiles parameters for each axis
+        self._trigger: Tuple[str, int] = None  # axis and output line of the on-target trigger if enabled
+        self._deferred_errors: ExitStack = None  # deferred_errors block of the running move
 
     def commit_settings(self, param):
         """
@@ -83,10 +135,38 @@ class DAQ_Move_PI(DAQ_Move_base):
                 self.settings.child('closed_loop').setValue(self.controller.get_servo(param.value()))
                 self.controller.set_referencing(self.axis_name)
                 self.set_axis_limits(self.controller.get_axis_limits(self.axis_name))
+                self.show_motion_profiles()
+                self.set_settle_detection()
+                self.set_on_target_trigger()
 
             elif param.name() == 'closed_loop':
                 self.controller.set_servo(self.axis_name, self.settings['closed_loop'])
 
+            elif param.parent().name() == 'motion_profiles':
+                self.set_motion_profiles()
+
+            elif param.name() in ('use_settle', 'tolerance', 'window'):
+                self.set_settle_detection()
+
+            elif param.parent().name() == 'on_target_trigger':
+                self.set_on_target_trigger()
+
+            elif param.name() == 'auto_reconnect':
+                self.set_supervision()
+
+            elif param.name() == 'save' and param.value():
+                self.controller.read_parameters().save(self.settings['parameters', 'file'])
+
+            elif param.name() == 'restore' and param.value():
+                changes = self.controller.restore_parameters(
+                    ParameterSnapshot.load(self.settings['parameters', 'file']))
+                self.emit_status(ThreadCommand('Update_Status',
+                                               [f'{sum(len(values) for values in changes.values())} parameters '
+                                                f'restored']))
+
+            elif param.name() == 'position_history_size':
+                self.controller.position_history.resize(param.value())
+
         except Exception as e:
             self.emit_status(ThreadCommand("Update_Status", [getLineInfo() + str(e), 'log']))
 
@@ -102,6 +182,7 @@ class DAQ_Move_PI(DAQ_Move_base):
             self.controller.connection_type = ConnectionEnum[self.settings['connect_type']]
             self.controller.device_id = devices_name[devices.index(self.settings['devices'])]
             self.controller.connect_device()
+            self.set_supervision()
 
         self.settings.child('controller_id').setValue(self.controller.identify())
         self.axis_names = self.controller.axis_names
@@ -111,6 +192,8 @@ class DAQ_Move_PI(DAQ_Move_base):
         self.settings.child('closed_loop').setValue(self.controller.get_servo(self.axis_name))
 
         self.set_axis_limits(self.controller.get_axis_limits(self.axis_name))
+        self.set_settle_detection()
+        self.set_on_target_trigger()
 
         self.axis_unit = self.controller.get_axis_units(self.axis_unit)
 
@@ -118,6 +201,61 @@ class DAQ_Move_PI(DAQ_Move_base):
         initialized = True
         return info, initialized
 
+    def set_motion_profiles(self):
+        """ Set the motion profiles of the current axis from the motion_profiles parameters"""
+        group = self.settings.child('motion_profiles')
+        self._motion_profiles_values[self.axis_name] = {child.name(): child.value() for child in group.children()}
+        profiles = []
+        if group['use_profiles']:
+            for kind, max_distance in (('scan', group['scan_max_distance']), ('move', float('inf'))):
+                profiles.append(MotionProfile(*[group[f'{kind}_{name}'] or None
+                                                for name in ('velocity', 'acceleration', 'deceleration')],
+                                              max_distance=max_distance))
+        self.controller.set_motion_profiles(self.axis_name, profiles)
+
+    def show_motion_profiles(self):
+        """ Display the motion_profiles parameters of the current axis, their default values if never set"""
+        group = self.settings.child('motion_profiles')
+        values = self._motion_profiles_values.get(self.axis_name,
+                                                  {child.name(): child.defaultValue() for child in group.children()})
+        for name, value in values.items():
+            group.child(name).setValue(value)
+
+    def set_settle_detection(self):
+        """ Enable or disable the settle detection of the current axis from the settling parameters"""
+        tolerance = self.settings['settling', 'tolerance'] if self.settings['settling', 'use_settle'] else None
+        self.controller.set_settle_detection(self.axis_name, tolerance, self.settings['settling', 'window'])
+
+    def set_supervision(self):
+        """ Start or stop the supervision of the link to the controller, done by the master only"""
+        if self.settings['multiaxes', 'multi_status'] != "Master":
+            return
+        if self.settings['auto_reconnect']:
+            self.controller.start_supervision()
+        else:
+            self.controller.stop_supervision()
+
+    def set_on_target_trigger(self):
+        """ Configure the on-target trigger output of the current axis from the on_target_trigger parameters"""
+        trigger = None
+        if self.settings['on_target_trigger', 'enable']:
+            trigger = (self.axis_name, self.settings['on_target_trigger', 'line'])
+        if self._trigger is not None and self._trigger != trigger:
+            self.controller.set_on_target_trigger(*self._trigger, enable=False)
+        if trigger is not None:
+            self.controller.set_on_target_trigger(*trigger, enable=True)
+        self._trigger = trigger
+
+    def _condition_to_reach_target(self, check_absolute_difference=True) -> bool:
+        """ Use the windowed settle detection of the controller instead of epsilon if activated"""
+        if not self.settings['settling', 'use_settle']:
+            return super()._condition_to_reach_target(check_absolute_difference)
+        settled = self.controller.is_settled(self.axis_name) and self.user_condition_to_reach_target()
+        settle_time = self.controller.get_settle_time(self.axis_name)
+        if settled and settle_time is not None:
+            self.settings.child('settling', 'settle_time').setValue(settle_time * 1000)
+        return settled
+
     def set_axis_limits(self, limits: Tuple[float]):
         self.settings.child('axis_infos', 'min').setValue(limits[0])
         self.settings.child('axis_infos', 'max').setValue(limits[1])
@@ -126,20 +264,60 @@ class DAQ_Move_PI(DAQ_Move_base):
         """
 
         """
+        self.end_deferred_errors()
         self.controller.close()
 
     def stop_motion(self):
-        """
+        """ Stop the motion, the errors deferred during the move being queried first
 
         """
+        self.end_deferred_errors()
         self.controller.stop()
         self.move_done()
 
+    def begin_deferred_errors(self):
+        """ Defer the controller errors until the end of the move if the defer_errors parameter is set
+
+        The move command and the polling of the position are sent without error query, the status register being
+        read with each position to catch an error early. The errors are queried once when the move is done.
+
+        See Also
+        --------
+        PIWrapper.deferred_errors, end_deferred_errors
+        """
+        self.end_deferred_errors()
+        if self.settings['defer_errors']:
+            self._deferred_errors = ExitStack()
+            self._deferred_errors.enter_context(self.controller.deferred_errors(watch_status=True))
+
+    def end_deferred_errors(self):
+        """ Query the errors deferred during the move, an error being emitted as a status"""
+        if self._deferred_errors is None:
+            return
+        stack, self._deferred_errors = self._deferred_errors, None
+        try:
+            stack.close()
+        except GCSError as e:
+            self.emit_status(ThreadCommand('Update_Status', [f'Controller error during the move: {str(e)}', 'log']))
+
+    def check_target_reached(self):
+        """ Check the end of the move from the polled position, the deferred errors are queried as soon as the
+        polling stops, also when the move timed out"""
+        super().check_target_reached()
+        if not self.poll_timer.isActive():
+            self.end_deferred_errors()
+
+    def move_done(self, position: DataActuator = None):
+        """ Query the errors deferred during the move then emit the move_done signal"""
+        self.end_deferred_errors()
+        super().move_done(position)
+
     def get_actuator_value(self):
         """
 
         """
-        pos = DataActuator(self.axis_name, data=self.controller.get_axis_position(self.axis_name))
+        position = self.controller.get_axis_position(self.axis_name)
+        pos = DataActuator(self.axis_name, data=position)
         pos = self.get_position_with_scaling(pos)
         return pos
 
@@ -150,7 +328,12 @@ class DAQ_Move_PI(DAQ_Move_base):
         position = self.check_bound(position)
         self.target_position = position
         position = self.set_position_with_scaling(position)
-        out = self.controller.move_absolute(self.axis_name, position.value())
+        self.begin_deferred_errors()
+        try:
+            self.controller.move_absolute(self.axis_name, position.value())
+        except Exception:
+            self.end_deferred_errors()
+            raise
 
     def move_rel(self, position):
         """
@@ -160,7 +343,12 @@ class DAQ_Move_PI(DAQ_Move_base):
         self.target_position = position + self.current_position
 
         position = self.set_position_relative_with_scaling(position)
-        self.controller.move_relative(self.axis_name, position.value())
+        self.begin_deferred_errors()
+        try:
+            self.controller.move_relative(self.axis_name, position.value())
+        except Exception:
+            self.end_deferred_errors()
+            raise
 
     def move_home(self):
         """
@@ -1,35 +1,107 @@
+import threading
+
+import numpy as np
 from pipython import GCSDevice
 
 from pymodaq.control_modules.move_utility_classes import DAQ_Move_base, main, comon_parameters_fun
+from pymodaq_data.data import Unit
 from pymodaq_utils.utils import ThreadCommand, getLineInfo
+from pymodaq_utils.logger import set_logger, get_module_name
 from pymodaq_gui.parameter.utils import iter_children
 
+from pymodaq_plugins_physik_instrumente.utils import Config, LazyParams
+from pymodaq_plugins_physik_instrumente.hardware.e870_wrapper import E870Group
+
+logger = set_logger(get_module_name(__file__))
+config = Config()
+
+
+def enumerate_usb() -> list:
+    """ Get the identifiers of the controllers plugged with USB"""
+    try:
+        return list(GCSDevice().EnumerateUSB())
+    except Exception as e:  # the GCS dll could not be loaded
+        logger.warning(f'Could not enumerate the USB controllers: {str(e)}')
+        return []
+
+
+STEP_RATE_TIP = ('Used to estimate the duration of the moves. Sent to the controller only if the step frequency '
+                 'parameter ID is set in the config (e870.profiles.step_frequency_id)')
+
+
+def controller_units() -> str:
+    """ Units of the calibrated step sizes from the config, dimensionless ('') for raw steps or unknown units"""
+    units = config('e870', 'units')
+    try:
+        Unit(units)
+    except Exception:  # as 'step' in former configurations, not a pint unit
+        return ''
+    return units
+
+
+def plugin_params(klass) -> list:
+    """ Parameters of the plugin, built when the plugin is selected so that the USB enumeration is done only then"""
+    devices = enumerate_usb()
+    return [
+        {'title': 'Devices:', 'name': 'devices', 'type': 'itemselect',
+         'value': dict(all_items=devices, selected=devices[:1]),
+         'tip': 'The E-870 controllers to be driven together, their axes are exposed by this plugin and its slaves'},
+        {'title': 'Refresh devices:', 'name': 'refresh_devices', 'type': 'bool_push', 'value': False,
+         'label': 'Refresh', 'tip': 'Enumerate again the controllers plugged with USB'},
+        {'title': 'Controller ID:', 'name': 'controller_id', 'type': 'str', 'value': '', 'readonly': True},
+        {'title': 'Set estimated position:', 'name': 'estimated_position', 'type': 'float', 'value': 0.,
+         'tip': 'Set the estimated position of the current axis, for instance after an external measurement'},
+        {'title': 'Stepping:', 'name': 'stepping', 'type': 'group', 'children': [
+            {'title': 'Use profiles:', 'name': 'use_profiles', 'type': 'bool',
+             'value': config('e870', 'profiles', 'use_profiles')},
+            {'title': 'Fine steps:', 'name': 'fine_steps', 'type': 'int', 'min': 0,
+             'value': config('e870', 'profiles', 'fine_steps'),
+             'tip': 'Number of steps done at the end of a move with the fine profile'},
+            {'title': 'Coarse step rate (Hz):', 'name': 'coarse_frequency', 'type': 'float', 'min': 0.,
+             'value': config('e870', 'profiles', 'coarse', 'frequency'), 'tip': STEP_RATE_TIP},
+            {'title': 'Coarse amplitude (V):', 'name': 'coarse_amplitude', 'type': 'float', 'min': 0.,
+             'value': config('e870', 'profiles', 'coarse', 'amplitude'),
+             'tip': '0 to keep the amplitude set on the controller'},
+            {'title': 'Fine step rate (Hz):', 'name': 'fine_frequency', 'type': 'float', 'min': 0.,
+             'value': config('e870', 'profiles', 'fine', 'frequency'), 'tip': STEP_RATE_TIP},
+            {'title': 'Fine amplitude (V):', 'name': 'fine_amplitude', 'type': 'float', 'min': 0.,
+             'value': config('e870', 'profiles', 'fine', 'amplitude'),
+             'tip': '0 to keep the amplitude set on the controller'},
+            {'title': 'Fine step scale:', 'name': 'fine_step_scale', 'type': 'float', 'min': 0.,
+             'value': config('e870', 'profiles', 'fine', 'step_scale'),
+             'tip': 'Size of a fine step relative to a calibrated (coarse) one'},
+        ]},
+    ] + comon_parameters_fun(klass.is_multiaxes, klass.axes_names, epsilon=klass._epsilon)
+
 
 class DAQ_Move_PI_E870(DAQ_Move_base):
     """Minimalistic plugin for the PI E870 4G controller with PiezoMike actuators.
 
     Use the pipython package wrapper.
-    It works in open loop. There is no referencing. It considers only relative moves.
-    It does not consider the daisy chain option: only one controller.
+    It works in open loop. There is no referencing. The position is estimated from the issued steps using the
+    calibration of each axis (distance per step in each direction, see the e870 section of the config), allowing
+    estimated absolute moves. Without calibration, positions are in steps.
+    It does not consider the daisy chain option but several USB controllers can be selected: their axes are exposed
+    together, named after the controller, and the moves of different controllers are executed concurrently.
     Only USB connexion is implemented.
-    Tested with PI_E870_4G: we consider 4 axes.
+    Tested with PI_E870_4G: we consider 4 axes per controller.
+    The demultiplexer (MOD command) is only switched when a move targets another axis than the selected one, and
+    moves requested at the same time by several axes (Master/Slaves) are grouped per axis (see E870Wrapper).
+    Long moves can use a coarse (fast) stepping profile then a fine one for their last steps. The polling timeout is
+    extended to the duration of each move, estimated from its number of steps and the step frequencies.
     """
-    _controller_units = 'step'
-    gcs_device = GCSDevice()
-    devices = gcs_device.EnumerateUSB()  # we only look for the controllers that are plugged with USB.
+    _controller_units = controller_units()
     is_multiaxes = True
     axes_names = [1, 2, 3, 4]
     _epsilon = 1
 
-    params = [
-        {'title': 'Devices:', 'name': 'devices', 'type': 'list', 'values': devices},
-        {'title': 'Controller ID:', 'name': 'controller_id', 'type': 'str', 'value': '', 'readonly': True},
-            ] + comon_parameters_fun(is_multiaxes, axes_names, epsilon=_epsilon)
+    params = LazyParams(plugin_params)
 
     def ini_attributes(self):
-        self.controller: GCSDevice = None
+        self.controller: E870Group = None
         self.is_referencing_function = True
         self._device = None
+        self._move_timeout: int = 0  # minimum polling timeout of the running move, from its estimated duration
 
     @property
     def device(self):
@@ -42,22 +114,43 @@ class DAQ_Move_PI_E870(DAQ_Move_base):
     def commit_settings(self, param):
         """Apply the consequences of a change of value in the parameter tree.
 
+        The change of axis doesn't send anything to the controller: the demultiplexer is switched by the next move
+        of this axis (see E870Wrapper.select_axis).
+
         Parameters
         ----------
         param: Parameter
             A given parameter (within detector_settings) whose value has been changed by the user.
         """
-        if param.name() == "axis" and param.name() in iter_children(self.settings.child('multiaxes')):
-            self.settings.child('multiaxes', 'axis').setValue(param.value())
-            if self.controller.HasOSM():
-                # The controller has only one PIShift channel. The demultiplexing (selection of the correct axis) is
-                # done with the MOD command (see the documentation of the controller).
-                self.controller.MOD(1, 2, param.value())
-            else:
-                self.emit_status(ThreadCommand('Update_Status', ['The controller cannot use the OSM command.']))
-                pass
-        else:
-            pass
+        if param.name() == 'refresh_devices' and param.value():
+            self.refresh_devices()
+        elif param.name() == 'estimated_position':
+            self.controller.set_estimated_position(self.axis_value, self.set_position_with_scaling(param.value()))
+            self.get_actuator_value()
+        elif param.parent().name() == 'stepping':
+            self.set_profiles()
+
+    def refresh_devices(self):
+        """Enumerate again the USB controllers, the selected ones still plugged stay selected
+
+        The cached params of the plugin class are also cleared so that new instances list the current controllers.
+        """
+        devices = enumerate_usb()
+        selected = [device for device in self.settings['devices']['selected'] if device in devices]
+        self.settings.child('devices').setValue(dict(all_items=devices, selected=selected))
+        vars(DAQ_Move_PI_E870)['params'].refresh()
+
+    def set_profiles(self):
+        """Set the stepping profiles of the controller from the stepping parameters"""
+        self.controller.load_profiles(dict(
+            use_profiles=self.settings['stepping', 'use_profiles'],
+            fine_steps=self.settings['stepping', 'fine_steps'],
+            step_frequency_id=config('e870', 'profiles', 'step_frequency_id'),
+            coarse=dict(frequency=self.settings['stepping', 'coarse_frequency'],
+                        amplitude=self.settings['stepping', 'coarse_amplitude']),
+            fine=dict(frequency=self.settings['stepping', 'fine_frequency'],
+                      amplitude=self.settings['stepping', 'fine_amplitude'],
+                      step_scale=self.settings['stepping', 'fine_step_scale'])))
 
     def ini_device(self):
         """Load the correct dll given the chosen device.
@@ -70,7 +163,7 @@ class DAQ_Move_PI_E870(DAQ_Move_base):
             self.close()
         except:
             pass
-        return GCSDevice()
+        return E870Group()
 
     def ini_stage(self, controller=None):
         """Actuator communication initialization.
@@ -89,69 +182,100 @@ class DAQ_Move_PI_E870(DAQ_Move_base):
             False if initialization failed otherwise True
         """
         self.ini_stage_init(old_controller=controller, new_controller=self.ini_device())
-        self.device = self.settings['devices']
+        self.device = self.settings['devices']['selected']
         if self.settings['multiaxes', 'multi_status'] == "Master":
-            self.controller.ConnectUSB(self.device)
+            if len(self.device) == 0:
+                return 'No controller selected', False
+            self.controller.connect_usb(self.device)
+            self.controller.load_calibrations(config('e870', 'calibration'))
+            self.set_profiles()
+            if not self.controller.has_osm:
+                self.emit_status(ThreadCommand('Update_Status', ['The controller cannot use the OSM command.']))
+        self.axis_names = self.controller.axis_names
+        self.axis_units = controller_units()
+        self.epsilons = self.settings['epsilon']
 
-        self.settings.child('controller_id').setValue(self.controller.qIDN())
+        self.settings.child('controller_id').setValue(self.controller.identify())
 
-        info = "connected on device:{} /".format(self.device) + self.controller.qIDN()
+        info = "connected on device:{} /".format(self.device) + self.controller.identify()
         initialized = True
         return info, initialized
 
     def close(self):
         """Terminate the communication protocol."""
-        self.controller.CloseConnection()
+        if self.settings['multiaxes', 'multi_status'] == "Master":
+            self.controller.close()
 
     def stop_motion(self):
         """Stop the actuator and emits move_done signal."""
-        self.controller.StopAll()
+        self.controller.stop()
         self.move_done()
 
     def get_actuator_value(self):
         """Get the current value from the hardware with scaling conversion.
 
-        This plugin considers only open-loop operation so there is no value for the actuator position. We return 0.
+        This plugin considers only open-loop operation: the position is estimated from the steps done by the axis.
 
         Returns
         -------
         float: The position obtained after scaling conversion.
         """
-        self.emit_status(ThreadCommand('Update_Status', [
-            'This plugin considers only open-loop operation so there is no value for the actuator position. We return'
-            ' 0.']))
-        return 0.
+        pos = self.controller.get_estimated_position(self.axis_value)
+        pos = self.get_position_with_scaling(pos)
+        return pos
 
     def move_abs(self, value):
         """ Move the actuator to the absolute target defined by value.
 
-        This plugin considers only relative moves, thus this method is not implemented.
+        The number of steps is computed from the estimated position and the calibration of the axis.
 
         Parameters
         ----------
-        value: (float) value of the absolute target positioning
+        value: (DataActuator) value of the absolute target positioning
         """
-        self.emit_status(ThreadCommand('Update_Status', [
-            'This plugin considers only relative moves, the method "move_abs" is not implemented.']))
-        pass
+        value = self.check_bound(value)
+        self.target_value = value
+        value = self.set_position_with_scaling(value)
+        self._move_steps(self.controller.estimated_steps_to(self.axis_value, value.value()))
 
     def move_rel(self, value):
         """ Move the actuator to the relative target actuator value defined by value.
 
         Parameters
         ----------
-        value: (float) value in steps of the relative move.
+        value: (DataActuator) value of the relative move, converted into steps with the calibration of the axis.
         """
-        if self.controller.HasOSM():
-            # the first parameter of the OSM method is the channel value. For the E-870, there is only one channel (see
-            # documentation of the controller). The action of this channel is distributed towards the correct axis by
-            # the demultiplexer. The selection of the axis is done with the MOD command (see the method commit_settings
-            # of this plugin).
-            self.controller.OSM(1, value)
+        value = self.check_bound(self.current_value + value) - self.current_value
+        self.target_value = value + self.current_value
+        value = self.set_position_relative_with_scaling(value)
+        self._move_steps(self.controller.distance_to_steps(self.axis_value, value.value()))
+
+    def _move_steps(self, steps: int):
+        if self.controller.has_osm:
+            # For the E-870, there is only one channel (see documentation of the controller). The action of this
+            # channel is distributed towards the correct axis by the demultiplexer, switched with the MOD command only
+            # if needed. Requests of other axes sharing the controller are executed grouped with this one, the ones of
+            # other controllers concurrently.
+            self._move_timeout = int(np.ceil(2 * self.controller.estimate_duration(self.axis_value, steps))) + 1
+            self.controller.queue_steps(self.axis_value, steps)
+            # executed in a worker thread as switching the axis or the profile waits for the end of the running steps
+            threading.Thread(target=self._run_pending, daemon=True).start()
         else:
             self.emit_status(ThreadCommand('Update_Status', ['The controller cannot use the OSM command.']))
             pass
 
+    def poll_moving(self):
+        """ Poll the current moving, the timeout parameter being extended if needed to the estimated duration of
+        the move (without changing the parameter)"""
+        super().poll_moving()
+        self.start_time += max(0, self._move_timeout - self.settings['timeout'])
+
+    def _run_pending(self):
+        try:
+            self.controller.run_pending(wait=False)
+        except Exception as e:
+            self.emit_status(ThreadCommand('Update_Status', [f'The open-loop move failed: {str(e)}']))
+
     def move_home(self):
         """Call the reference method of the controller."""
         self.emit_status(ThreadCommand('Update_Status', [
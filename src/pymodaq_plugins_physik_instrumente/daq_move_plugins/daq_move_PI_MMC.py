@@ -1,6 +1,8 @@
 """
 this plugin use an old dll from PI MMC-DLL not compatible with their new GCS-command stuff
-The dll is 32 bits only so should be used with a 32bits python distribution
+The dll is 32 bits only so should be used with a 32bits python distribution (or through a 32 bits server)
+It can also use a pure python driver (serial) of the native Mercury command set, without any dll
+Each controller of the Mercury network is an axis: slave plugins share the connection (and the 32 bits server)
 C-862 Mercury™-DC Motor Controller
 C-863 Mercury™-DC Motor Controller
 C-663 Mercury™-Step Motor Controller
@@ -10,22 +12,57 @@ C-170 Redstone PILine® Controller
 
 import sys
 import os
-from qtpy.QtCore import QThread
+import threading
 
-from pymodaq.control_modules.move_utility_classes import DAQ_Move_base, comon_parameters_fun, main, ThreadCommand
+from pymodaq.control_modules.move_utility_classes import (DAQ_Move_base, comon_parameters_fun, main,
+                                                           ThreadCommand, DataActuator)
 from pymodaq_utils.logger import set_logger, get_module_name
 
-from pymodaq_plugins_physik_instrumente.utils import Config
-from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper import MMC_Wrapper
-from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper_client64 import MMCWrapperClient64
-
-is64bit = sys.maxsize > 2**32
-if is64bit:
-    MMC_Wrapper = MMCWrapperClient64
+from pymodaq_plugins_physik_instrumente.utils import Config, LazyParams
+from pymodaq_plugins_physik_instrumente.hardware.PI.base import MMCBase, devices_to_bitmap
+from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_serial import MMCSerial
 
 logger = set_logger(get_module_name(__file__))
 config = Config()
-ports = MMC_Wrapper.ports
+MMCBase.load_stages(config('mmc', 'stages'))
+
+drivers = {'serial': MMCSerial}
+is64bit = sys.maxsize > 2**32
+try:
+    if is64bit:
+        from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper_client64 import \
+            MMCWrapperClient64 as MMC_Wrapper
+        from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper_client64 import MMCServer32
+        MMCServer32.idle_timeout = config('mmc', 'server_idle_timeout')
+    else:
+        from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper import MMC_Wrapper
+    drivers['dll'] = MMC_Wrapper
+except ImportError as e:  # no windll outside windows
+    logger.info(f'The MMC dll cannot be used: {str(e)}')
+
+
+def plugin_params(klass) -> list:
+    """ Parameters of the plugin, built when the plugin is selected so that VISA (if used by the driver) is started
+    only then"""
+    driver = config('mmc', 'driver') if config('mmc', 'driver') in drivers else 'serial'
+    return [{'title': 'Driver:', 'name': 'driver', 'type': 'list', 'limits': list(drivers.keys()), 'value': driver},
+            {'title': 'COM Ports:', 'name': 'com_port', 'type': 'list', 'limits': drivers[driver].list_com_ports(),
+             'value': config('mmc', 'com_port')},
+            {'title': 'Refresh COM ports:', 'name': 'refresh_ports', 'type': 'bool_push', 'value': False,
+             'label': 'Refresh'},
+            {'title': 'Rescan network:', 'name': 'rescan', 'type': 'bool_push', 'value': False,
+             'label': 'Rescan'},
+            {'title': 'Stages:', 'name': 'stage', 'type': 'list', 'limits': list(MMCBase.stages.keys())},
+            {'title': 'Closed loop?:', 'name': 'closed_loop', 'type': 'bool', 'value': True},
+            {'title': 'Wait for stop flag:', 'name': 'wait_stop', 'type': 'bool', 'value': True,
+             'tip': 'Use the controller motion flag to signal the end of a move instead of polling the position'},
+            {'title': 'Homing timeout (s):', 'name': 'home_timeout', 'type': 'float',
+             'value': config('mmc', 'home_timeout'), 'min': 0.,
+             'tip': 'Maximum duration of the reference edge search, the motion is aborted (AB) if it expires'},
+            {'title': 'Position max age (ms):', 'name': 'position_max_age', 'type': 'int', 'value': 50, 'min': 0,
+             'tip': 'The positions of all the axes are polled at once, a position younger than this is reused'},
+            {'title': 'Controller ID:', 'name': 'controller_id', 'type': 'str', 'value': '', 'readonly': True},
+            ] + comon_parameters_fun(klass.is_multiaxes, klass.stage_names, epsilon=klass._epsilon)
 
 
 class DAQ_Move_PI_MMC(DAQ_Move_base):
@@ -47,23 +84,14 @@ class DAQ_Move_PI_MMC(DAQ_Move_base):
 
     _controller_units = 'mm'  # dependent on the stage type so to be updated accordingly using self.controller_units = new_unit
 
-    com_ports = MMC_Wrapper.aliases
-    controller_addresses = []
-    is_multiaxes = False
+    is_multiaxes = True  # each Mercury controller of the network is an axis, sharing the COM port
     stage_names = []
     _epsilon = 0.01
 
-    params = [{'title': 'COM Ports:', 'name': 'com_port', 'type': 'list', 'limits': com_ports,
-               'value': config('mmc', 'com_port')},
-              {'title': 'Controller_address:', 'name': 'controller_address', 'type': 'list',
-               'limits': controller_addresses},
-              {'title': 'Stages:', 'name': 'stage', 'type': 'list', 'limits': list(MMC_Wrapper.stages.keys())},
-              {'title': 'Closed loop?:', 'name': 'closed_loop', 'type': 'bool', 'value': True},
-              {'title': 'Controller ID:', 'name': 'controller_id', 'type': 'str', 'value': '', 'readonly': True},
-              ] + comon_parameters_fun(is_multiaxes, stage_names, epsilon=_epsilon)
+    params = LazyParams(plugin_params)
 
     def ini_attributes(self):
-        self.controller: MMC_Wrapper = None
+        self.controller: MMCBase = None
 
     def commit_settings(self, param):
         """ bActivate any parameter changes on the PI_GCS2 hardware.
@@ -72,33 +100,51 @@ class DAQ_Move_PI_MMC(DAQ_Move_base):
         """
         if param.name() == 'stage':
             self.controller.stage = param.value()
+            self.axis_units = self.controller.stages[param.value()]['units']  # the stage is shared by all axes
+            self.axis_unit = self.axis_units[self.axis_index_key]
 
-        elif param.name() == 'controller_address':
-            self.controller.MMC_select(param.value())
-            self.get_actuator_value()
+        elif param.name() == 'rescan' and param.value():
+            self.enumerate_devices(rescan=True)
 
-    def enumerate_devices(self):
-        """
+        elif param.name() == 'driver' or (param.name() == 'refresh_ports' and param.value()):
+            driver = drivers[self.settings['driver']]
+            self.settings.child('com_port').setOpts(limits=driver.list_com_ports(refresh=True))
+
+    def enumerate_devices(self, rescan=False):
+        """ Get the controllers connected on the COM port, from the cache if they still answer
+
+            See Also
+            --------
+            MMCBase.discover_network
         """
         try:
-            devices = self.controller.MMC_initNetwork(3)  # up to 3 controller in a row (could be 16 at max but useless)
-            self.settings.child('controller_address').setOpts(limits=devices)
+            com_port = self.settings['com_port']
+            devices = self.controller.discover_network(config('mmc', 'networks').get(com_port, 0), rescan=rescan)
+            config['mmc', 'networks', com_port] = devices_to_bitmap(devices)
+            self.set_axis_names(devices)
             return devices
         except Exception as e:
             logger.warning(str(e))
 
-    def ini_stage(self, controller: MMC_Wrapper = None):
-        """
+    def set_axis_names(self, devices: list):
+        """ Map each device number to an axis named after it"""
+        self.axis_names = {f'Mercury {device}': device for device in devices}
+        self.axis_units = self.controller.stages[self.controller.stage]['units']
+        self.epsilons = self.settings['epsilon']
 
+    def ini_stage(self, controller: MMCBase = None):
         """
 
-        self.ini_stage_init(controller, MMC_Wrapper(stage=self.settings['stage'],
-                                                    com_port=self.settings['com_port']))
+        """
+        driver = drivers[self.settings['driver']]
+        self.ini_stage_init(controller, driver(stage=self.settings['stage'],
+                                               com_port=self.settings['com_port']))
 
         if self.settings['multiaxes', 'multi_status'] == "Master":
             self.controller.open()
-            devices = self.enumerate_devices()
-            self.controller.MMC_select(devices[0])
+            self.enumerate_devices()
+        else:
+            self.set_axis_names(self.controller.devices)
 
         self.get_actuator_value()
 
@@ -109,7 +155,8 @@ class DAQ_Move_PI_MMC(DAQ_Move_base):
     def close(self):
         """
         """
-        self.controller.close()
+        if self.settings['multiaxes', 'multi_status'] == "Master":
+            self.controller.close()
 
     def stop_motion(self):
         """
@@ -117,7 +164,7 @@ class DAQ_Move_PI_MMC(DAQ_Move_base):
             --------
             DAQ_Move_base.move_done
         """
-        self.controller.stop()
+        self.controller.stop(self.axis_value)
         self.move_done()
 
     def get_actuator_value(self):
@@ -128,12 +175,12 @@ class DAQ_Move_PI_MMC(DAQ_Move_base):
             --------
             DAQ_Move_base.get_position_with_scaling, daq_utils.ThreadCommand
         """
-        pos = self.controller.getPos()
-        pos=self.get_position_with_scaling(pos)
+        pos = self.controller.get_position(self.axis_value, self.settings['position_max_age'] / 1000)
+        pos = self.get_position_with_scaling(pos)
         self.current_position = pos
         return pos
 
-    def move_abs(self, value: float):
+    def move_abs(self, value: DataActuator):
         """
         """
 
@@ -141,35 +188,62 @@ class DAQ_Move_PI_MMC(DAQ_Move_base):
         self.target_value = value
 
         value = self.set_position_with_scaling(value)
-        self.controller.moveAbs(self.settings['controller_address'], value)
+        self.controller.moveAbs(self.axis_value, value.value())
 
-    def move_rel(self, value: float):
+    def move_rel(self, value: DataActuator):
         """ Make the hardware relative move
         """
         value = self.check_bound(self.current_value + value) - self.current_value
         self.target_value = value + self.current_value
         position = self.set_position_relative_with_scaling(value)
 
-        self.controller.moveRel(self.settings['controller_address'], value)
+        self.controller.moveRel(self.axis_value, position.value())
 
-    def move_home(self):
+    def poll_moving(self):
+        """ Wait for the controller motion flag in a worker thread instead of polling the position, within the
+        timeout of the plugin
+
+            See Also
+            --------
+            MMCBase.wait_stop, DAQ_Move_base.poll_moving
         """
+        if self.ispolling and self.settings['wait_stop']:
+            threading.Thread(target=self._wait_move_done, daemon=True).start()
+        else:
+            super().poll_moving()
+
+    def _wait_move_done(self):
+        try:
+            self.controller.wait_stop(self.axis_value, timeout=self.settings['timeout'])
+        except TimeoutError:
+            self.emit_status(ThreadCommand('raise_timeout'))
+            return
+        except IOError:  # interrupted by stop_motion (MMC_globalBreak) that emits itself the move_done
+            return
+        self.move_done()
+
+    def move_home(self):
+        """ Start the homing (find edge then define home) in a worker thread, move_done is emitted at its end
 
             See Also
             --------
-            DAQ_Move_PI.set_referencing, DAQ_Move_base.poll_moving
+            MMCBase.home, DAQ_Move_base.move_done
         """
-        self.controller.find_home()
-        moving = True
-        pos = self.get_actuator_value()
-        while moving:
-            pos_tmp = self.get_actuator_value()
-            moving = abs(pos - pos_tmp) > 0.001
-            QThread.msleep(100)
-            pos = pos_tmp
-        self.controller.MMC_sendCommand('DH')  #to define it as home
-        QThread.msleep(500)
-        self.get_actuator_value()
+        threading.Thread(target=self._home, daemon=True).start()
+
+    def _home(self):
+        try:
+            self.controller.home(progress=self._emit_home_progress, device=self.axis_value,
+                                 timeout=self.settings['home_timeout'])
+        except TimeoutError:
+            self.emit_status(ThreadCommand('raise_timeout'))
+            return
+        except IOError:  # interrupted by stop_motion (MMC_globalBreak) that emits itself the move_done
+            return
+        self.move_done()
+
+    def _emit_home_progress(self, pos: float):
+        self.emit_value(DataActuator(data=self.get_position_with_scaling(pos)))
 
 
 if __name__ == '__main__':
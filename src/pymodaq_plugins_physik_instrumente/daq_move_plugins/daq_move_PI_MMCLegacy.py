@@ -9,18 +9,40 @@ C-170 Redstone PILine® Controller
 """
 
 import sys, os
-from qtpy.QtCore import QThread
+import threading
 from pymodaq.control_modules.move_utility_classes import DAQ_Move_base, comon_parameters_fun, main
 from pymodaq_utils.utils import ThreadCommand, getLineInfo
 from easydict import EasyDict as edict
 
+from pymodaq_plugins_physik_instrumente.utils import Config, LazyParams
+from pymodaq_plugins_physik_instrumente.hardware.PI.base import devices_to_bitmap, get_com_ports
 from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper import MMC_Wrapper
 
 #is64bit = sys.maxsize > 2**32
 if (sys.maxsize > 2**32):
     raise Exception("It must a python 32 bit version")
 
-ports = MMC_Wrapper.ports
+config = Config()
+MMC_Wrapper.load_stages(config('mmc', 'stages'))
+
+
+def plugin_params(klass) -> list:
+    """ Parameters of the plugin, built when the plugin is selected so that VISA is started only then"""
+    return [{'title': 'COM Ports:', 'name': 'com_port', 'type': 'list', 'limits': MMC_Wrapper.aliases},
+            {'title': 'Refresh COM ports:', 'name': 'refresh_ports', 'type': 'bool_push', 'value': False,
+             'label': 'Refresh'},
+            {'title': 'Controller_address:', 'name': 'controller_address', 'type': 'list',
+             'limits': klass.controller_addresses},
+            {'title': 'Rescan network:', 'name': 'rescan', 'type': 'bool_push', 'value': False, 'label': 'Rescan'},
+            {'title': 'Stages:', 'name': 'stage', 'type': 'list', 'limits': list(MMC_Wrapper.stages.keys())},
+            {'title': 'Closed loop?:', 'name': 'closed_loop', 'type': 'bool', 'value': True},
+            {'title': 'Wait for stop flag:', 'name': 'wait_stop', 'type': 'bool', 'value': True,
+             'tip': 'Use the controller motion flag to signal the end of a move instead of polling the position'},
+            {'title': 'Homing timeout (s):', 'name': 'home_timeout', 'type': 'float',
+             'value': config('mmc', 'home_timeout'), 'min': 0.,
+             'tip': 'Maximum duration of the reference edge search, the motion is aborted (AB) if it expires'},
+            {'title': 'Controller ID:', 'name': 'controller_id', 'type': 'str', 'value': '', 'readonly': True},
+            ] + comon_parameters_fun(klass.is_multiaxes, klass.stage_names, epsilon=klass._epsilon)
 
 
 class DAQ_Move_PI_MMCLegacy(DAQ_Move_base):
@@ -42,18 +64,12 @@ class DAQ_Move_PI_MMCLegacy(DAQ_Move_base):
 
     _controller_units = 'mm'  # dependent on the stage type so to be updated accordingly using self.controller_units = new_unit
 
-    com_ports = MMC_Wrapper.aliases
     controller_addresses = []
     is_multiaxes=False
     stage_names=[]
     _epsilon = 0.1
 
-    params= [{'title': 'COM Ports:', 'name': 'com_port', 'type': 'list', 'limits': com_ports},
-           {'title': 'Controller_address:', 'name': 'controller_address', 'type': 'list', 'limits': controller_addresses},
-           {'title': 'Stages:', 'name': 'stage', 'type': 'list', 'limits': list(MMC_Wrapper.stages.keys())},
-           {'title': 'Closed loop?:', 'name': 'closed_loop', 'type': 'bool', 'value': True},
-           {'title': 'Controller ID:', 'name': 'controller_id', 'type': 'str', 'value': '', 'readonly': True},
-           ] + comon_parameters_fun(is_multiaxes, stage_names, epsilon=_epsilon)
+    params = LazyParams(plugin_params)
 
     def __init__(self,parent=None,params_state=None):
 
@@ -83,16 +99,28 @@ class DAQ_Move_PI_MMCLegacy(DAQ_Move_base):
                 self.controller.MMC_select(param.value())
                 self.get_actuator_value()
 
+            elif param.name() == 'rescan' and param.value():
+                self.enumerate_devices(rescan=True)
+
+            elif param.name() == 'refresh_ports' and param.value():
+                self.settings.child('com_port').setOpts(limits=get_com_ports(refresh=True)[0])
+
 
         except Exception as e:
             self.emit_status(ThreadCommand("Update_Status", [getLineInfo()+ str(e), 'log']))
 
 
-    def enumerate_devices(self):
-        """
+    def enumerate_devices(self, rescan=False):
+        """ Get the controllers connected on the COM port, from the cache if they still answer
+
+            See Also
+            --------
+            MMCBase.discover_network
         """
         try:
-            devices = self.controller.MMC_initNetwork(3) #up to 3 controller in a row (could be 16 at max but useless)
+            com_port = self.settings.child('com_port').value()
+            devices = self.controller.discover_network(config('mmc', 'networks').get(com_port, 0), rescan=rescan)
+            config['mmc', 'networks', com_port] = devices_to_bitmap(devices)
             self.settings.child('controller_address').setOpts(limits=devices)
             return devices
         except Exception as e:
@@ -157,7 +185,7 @@ class DAQ_Move_PI_MMCLegacy(DAQ_Move_base):
             --------
             DAQ_Move_base.move_done
         """
-        self.controller.MMC_globalBreak()
+        self.controller.stop()
         self.move_done()
 
     def get_actuator_value(self):
@@ -204,24 +232,50 @@ class DAQ_Move_PI_MMCLegacy(DAQ_Move_base):
 
         out=self.controller.moveRel(self.settings.child('controller_address').value(), position)
 
-    def move_home(self):
+    def poll_moving(self):
+        """ Wait for the controller motion flag in a worker thread instead of polling the position, within the
+        timeout of the plugin
+
+            See Also
+            --------
+            MMCBase.wait_stop, DAQ_Move_base.poll_moving
         """
+        if self.ispolling and self.settings['wait_stop']:
+            threading.Thread(target=self._wait_move_done, daemon=True).start()
+        else:
+            super().poll_moving()
+
+    def _wait_move_done(self):
+        try:
+            self.controller.wait_stop(timeout=self.settings['timeout'])
+        except TimeoutError:
+            self.emit_status(ThreadCommand('raise_timeout'))
+            return
+        except IOError:  # interrupted by stop_motion (MMC_globalBreak) that emits itself the move_done
+            return
+        self.move_done()
+
+    def move_home(self):
+        """ Start the homing (find edge then define home) in a worker thread, move_done is emitted at its end
 
             See Also
             --------
-            DAQ_Move_PI.set_referencing, DAQ_Move_base.poll_moving
-        """
-        self.controller.find_home()
-        moving = True
-        pos = self.get_actuator_value()
-        while moving:
-            pos_tmp = self.get_actuator_value()
-            moving = abs(pos - pos_tmp) > 0.001
-            QThread.msleep(100)
-            pos = pos_tmp
-        self.controller.MMC_sendCommand('DH')  #to define it as home
-        QThread.msleep(500)
-        self.get_actuator_value()
+            MMCBase.home, DAQ_Move_base.move_done
+        """
+        threading.Thread(target=self._home, daemon=True).start()
+
+    def _home(self):
+        try:
+            self.controller.home(progress=self._emit_home_progress, timeout=self.settings['home_timeout'])
+        except TimeoutError:
+            self.emit_status(ThreadCommand('raise_timeout'))
+            return
+        except IOError:  # interrupted by stop_motion (MMC_globalBreak) that emits itself the move_done
+            return
+        self.move_done()
+
+    def _emit_home_progress(self, pos: float):
+        self.emit_status(ThreadCommand('Update_Status', [f'Homing, position: {self.get_position_with_scaling(pos)}']))
 
 
 if __name__ == '__main__':
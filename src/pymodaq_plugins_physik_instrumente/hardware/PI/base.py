@@ -0,0 +1,587 @@
+from abc import ABC, abstractmethod
+import threading
+import time
+from typing import List, Tuple, Dict, Iterable, Union, Optional
+
+import numpy as np
+
+
+MAXINT = 2**31 - 1  # the dll returns error codes from MAXINT-3 to MAXINT in place of positions or values
+
+
+def bitarray(integer: int):
+    binary_string = bin(integer)[2:]
+    return [int(bit) for bit in binary_string]
+
+
+def devices_to_bitmap(devices: Iterable[int]) -> int:
+    """ Convert a list of device numbers (1 to 16) to a bitmap (bit 0 for device 1)"""
+    bitmap = 0
+    for device in devices:
+        bitmap |= 1 << (device - 1)
+    return bitmap
+
+
+def bitmap_to_devices(bitmap: int) -> List[int]:
+    """ Convert a bitmap (bit 0 for device 1) to the sorted list of device numbers"""
+    return [ind + 1 for ind in range(16) if bitmap >> ind & 1]
+
+
+_com_ports: Tuple[List[str], List[int]] = None
+
+
+def get_com_ports(refresh=False) -> Tuple[List[str], List[int]]:
+    """ Get the aliases (as 'COM13') and board numbers of the COM ports declared in VISA
+
+    The VISA library is loaded and the resources scanned only at the first call (or if refresh is True), the result
+    being memoized for the next ones.
+
+    Parameters
+    ----------
+    refresh: bool
+        if True, scan again the VISA resources
+
+    Returns
+    -------
+    list of str: the aliases
+    list of int: the board numbers
+    """
+    global _com_ports
+    if _com_ports is None or refresh:
+        from pyvisa import ResourceManager
+        aliases = []
+        ports = []
+        for info in ResourceManager().list_resources_info().values():
+            if info.alias is not None and 'COM' in info.alias:
+                aliases.append(info.alias)
+                ports.append(info.interface_board_number)
+        _com_ports = (aliases, ports)
+    return _com_ports
+
+
+class ComPortsView:
+    """ Class attribute computed from get_com_ports only when accessed"""
+
+    def __init__(self, index: int):
+        self._index = index
+
+    def __get__(self, instance, owner) -> list:
+        return get_com_ports()[self._index]
+
+
+class MMCBase(ABC):
+    """
+    Wrapper to the MMC dll from Physik Instrumente
+
+    """
+    stages: Dict[str, dict] = {}  # the stage catalogue, see add_stage and load_stages
+    aliases = ComPortsView(0)  # COM ports aliases, as 'COM13', discovered at first access
+    ports = ComPortsView(1)  # their corresponding board numbers
+
+    baudrates = [9600, 19200]
+    network_cache: Dict[str, int] = {}  # COM port -> bitmap of the device numbers discovered on this port
+
+    def __init__(self, stage='M521DG', com_port='COM1', baud_rate=9600):
+
+        if stage not in self.stages.keys():
+            raise Exception('not valid stage')
+        self._counts_per_unit: float = None
+        if not self.is_valid_com_port(com_port):
+            raise IOError('invalid com port')
+        if baud_rate not in self.baudrates:
+            raise IOError('invalid baudrate')
+        self.stage = stage
+        self._comport = com_port
+        self._baudrate = baud_rate
+        self._break = threading.Event()  # global break, see MMC_globalBreak
+        self._breaks: Dict[int, threading.Event] = {}  # break of the moves of a given device, see stop
+        self._device: Optional[int] = None  # last device selected with select
+        self.devices: List[int] = []  # devices discovered on the network, see discover_network
+        self._positions: Dict[int, Tuple[float, float]] = {}  # device -> (time, position) of the last poll
+        self._positions_lock = threading.Lock()
+
+    @classmethod
+    def list_com_ports(cls, refresh=False) -> List[str]:
+        """ Get the COM ports that can be used by this wrapper, the ones declared in VISA
+
+        Parameters
+        ----------
+        refresh: bool
+            if True, scan again the available ports
+        """
+        return get_com_ports(refresh=refresh)[0]
+
+    def is_valid_com_port(self, com_port: str) -> bool:
+        """ Check if com_port can be used by this wrapper"""
+        return com_port in self.aliases
+
+    @property
+    def comport(self):
+        return self._comport
+
+    @comport.setter
+    def comport(self,port):
+        if not isinstance(port, str):
+            raise TypeError("not a valid port type, should be a string: 'COM6'")
+        if port not in self.ports:
+            raise IOError('{} is an invalid COM port'.format(port))
+        self._comport = port
+
+    @property
+    def baudrate(self):
+        return self._comport
+
+    @baudrate.setter
+    def baudrate(self,rate):
+        if not isinstance(rate, int):
+            raise TypeError("not a valid baudrate")
+        if rate not in self.baudrates:
+            raise IOError('{} is an invalid baudrate'.format(rate))
+        self._baudrate = rate
+
+    @classmethod
+    def add_stage(cls, name: str, cts_units_num: int, cts_units_denom: int = 1, units: str = 'mm',
+                  motor: str = 'DC'):
+        """ Add (or update) a stage in the catalogue, precomputing its number of counts per unit
+
+        Parameters
+        ----------
+        name: str
+            the stage reference, as 'M521DG'
+        cts_units_num: int
+            numerator of the number of counts (or steps) per unit
+        cts_units_denom: int
+            denominator of the number of counts (or steps) per unit
+        units: str
+            the physical units of the stage
+        motor: str
+            either 'DC' (C-862, C-863) or 'step' (C-663)
+        """
+        cls.stages[name] = dict(cts_units_num=cts_units_num, cts_units_denom=cts_units_denom, units=units,
+                                motor=motor, counts_per_unit=cts_units_num / cts_units_denom)
+
+    @classmethod
+    def load_stages(cls, stages: Dict[str, dict]):
+        """ Add to the catalogue the stages described as a mapping, as the mmc.stages entry of the config file"""
+        for name, stage in stages.items():
+            cls.add_stage(name, **stage)
+
+    @property
+    def stage(self) -> str:
+        return self._stage
+
+    @stage.setter
+    def stage(self, stage: str):
+        if stage not in self.stages:
+            raise ValueError(f'{stage} is not a valid stage, possible ones are: {list(self.stages.keys())}')
+        self._stage = stage
+        self._counts_per_unit = self.stages[stage]['counts_per_unit']
+
+    def counts_to_units(self, counts: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        """ Convert counts (or steps) to the stage units, scalars or arrays"""
+        units = np.divide(counts, self._counts_per_unit)
+        return units if isinstance(units, np.ndarray) else float(units)
+
+    def units_to_counts(self, units: Union[float, np.ndarray]) -> Union[int, np.ndarray]:
+        """ Convert stage units to counts (or steps) rounded to the nearest integer, scalars or arrays"""
+        counts = np.rint(np.multiply(units, self._counts_per_unit)).astype(np.int64)
+        return counts if np.ndim(counts) else int(counts)
+
+    def _break_event(self, device: Optional[int] = None) -> threading.Event:
+        if device is None:
+            return self._break
+        return self._breaks.setdefault(device, threading.Event())
+
+    def _arm_break(self, device: Optional[int] = None):
+        """ Re-arm the global break and the one of the given device before a new move"""
+        self._break.clear()
+        self._break_event(device).clear()
+
+    def _wait_break(self, timeout: float, device: Optional[int] = None) -> bool:
+        """ Wait for timeout seconds, returns True if the moves of the device or all moves have been interrupted"""
+        return self._break_event(device).wait(timeout) or self._break.is_set()
+
+    def select(self, device: int):
+        """ Select the device (1 to 16) receiving the next commands"""
+        self.MMC_select(device)
+        self._device = device
+
+    def _call_on(self, device: Optional[int], name: str, *args):
+        """ Call the MMC_ (MDC_, MST_) method name on device, selecting it within the same batch
+
+        If device is None, the method is called on the currently selected device
+        """
+        if device is None:
+            return getattr(self, name)(*args)
+        result = self.MMC_batch([('MMC_select', (device,)), (name, args)])[1]
+        self._device = device
+        return result
+
+    def moveAbs(self, axis, units):
+        """
+        displacement in the selected stage units
+        Parameters
+        ----------
+        axis: (int) device number of the controller, 0 for the currently selected one
+        units: (float)
+        """
+        self._arm_break(axis if axis > 0 else None)
+        self.MMC_moveA(axis, self.units_to_counts(units))
+        if axis > 0:
+            self._device = axis
+            with self._positions_lock:
+                self._positions.pop(axis, None)  # the next get_position has to poll the moving device
+
+    def moveRel(self,axis, units):
+        """
+        displacement in the selected stage units
+        Parameters
+        ----------
+        axis: (int) device number of the controller, 0 for the currently selected one
+        units: (float)
+        """
+        self._arm_break(axis if axis > 0 else None)
+        self.MMC_moveR(axis, self.units_to_counts(units))
+        if axis > 0:
+            self._device = axis
+            with self._positions_lock:
+                self._positions.pop(axis, None)  # the next get_position has to poll the moving device
+
+    def getPos(self, device: Optional[int] = None):
+        return self.counts_to_units(self._call_on(device, 'MMC_getPos'))
+
+    def get_positions(self, devices: Iterable[int] = None) -> Dict[int, float]:
+        """ Read in a single batch (one request to the 32 bits server) the positions of several devices
+
+        Each device is selected in turn (round robin) then the previously selected device is selected back.
+
+        Parameters
+        ----------
+        devices: list of int or None
+            the device numbers, if None all the devices discovered on the network
+
+        Returns
+        -------
+        dict: device number -> position in stage units
+        """
+        devices = list(self.devices if devices is None else devices)
+        calls = []
+        for device in devices:
+            calls.extend([('MMC_select', (device,)), ('MMC_getPos', ())])
+        if self._device is not None and len(devices) > 0 and self._device != devices[-1]:
+            calls.append(('MMC_select', (self._device,)))
+        counts = self.MMC_batch(calls)[1:2 * len(devices):2]
+        positions = dict(zip(devices, np.atleast_1d(self.counts_to_units(np.array(counts, dtype=np.int64)))))
+        now = time.perf_counter()
+        with self._positions_lock:
+            self._positions.update({device: (now, float(pos)) for device, pos in positions.items()})
+        if self._device is None and len(devices) > 0:
+            self._device = devices[-1]
+        return positions
+
+    def get_position(self, device: int, max_age: float = 0.) -> float:
+        """ Get the position of a device from the last poll of all devices if not older than max_age
+
+        Otherwise, the positions of all discovered devices are polled at once (see get_positions), so that plugins
+        sharing the controller and polling their own device at the same rate cost a single batch per cycle.
+
+        Parameters
+        ----------
+        device: int
+            the device number
+        max_age: float
+            maximum age in seconds of the cached position
+
+        Returns
+        -------
+        float: the position in stage units
+        """
+        with self._positions_lock:
+            timestamp, pos = self._positions.get(device, (-np.inf, None))
+        if time.perf_counter() - timestamp > max_age:
+            devices = self.devices if device in self.devices else [device]
+            pos = self.get_positions(devices)[device]
+        return pos
+
+    def open(self):
+        port = self.ports[self.aliases.index(self._comport)]
+        self.MMC_COM_open(port, self._baudrate)
+
+    def close(self):
+        self.MMC_COM_close()
+
+    def stop(self, device: Optional[int] = None):
+        """ Abort the motion of a device and interrupt its waiting loops (wait_stop, home)
+
+        If device is None, all waiting loops are interrupted (MMC_globalBreak) and the selected device is stopped
+        """
+        if device is None:
+            self.MMC_globalBreak()
+        else:
+            self._break_event(device).set()
+        self._call_on(device, 'MMC_sendCommand', 'AB')
+
+    def find_home(self, device: Optional[int] = None):
+        self._arm_break(device)
+        self._call_on(device, 'MMC_sendCommand', 'FE1')
+
+    def home(self, progress=None, min_interval: float = 0.05, max_interval: float = 1., device: Optional[int] = None,
+             timeout: Optional[float] = None):
+        """ Find the reference edge (FE1) and define it as the home position (DH) once the motion flag is down
+
+        Blocking but interruptible with MMC_globalBreak (see stop) so it should be called from a worker thread.
+        The motion flag is polled less and less often: starting at min_interval, the delay between two queries
+        grows by 50% after each one up to max_interval. If the edge is not found in time, the motion is aborted (AB)
+        and a TimeoutError is raised.
+
+        Parameters
+        ----------
+        progress: callable or None
+            called with the current position (in stage units) after each poll
+        min_interval: float
+            initial delay in seconds between two polls
+        max_interval: float
+            maximum delay in seconds between two polls
+        device: int or None
+            the device to be homed, if None the currently selected one
+        timeout: float or None
+            maximum duration in seconds of the homing, if None no limit
+        """
+        self.find_home(device)
+        interval = min_interval
+        end = None if timeout is None else time.perf_counter() + timeout
+        while self.moving(device):
+            if progress is not None:
+                progress(self.getPos(device))
+            if end is not None and time.perf_counter() >= end:
+                self._call_on(device, 'MMC_sendCommand', 'AB')
+                raise TimeoutError(f'Homing not terminated within {timeout} s')
+            if self._wait_break(interval, device):
+                raise IOError('User break')
+            interval = min(1.5 * interval, max_interval)
+        self._call_on(device, 'MMC_sendCommand', 'DH')  # to define it as home
+
+    @property
+    def is_step_motor(self) -> bool:
+        """ True if the stage is driven by a Mercury-Step controller (C-663) otherwise a DC one"""
+        return self.stages[self.stage].get('motor', 'DC') == 'step'
+
+    def moving(self, device: Optional[int] = None) -> bool:
+        """ Get the motion flag of a device, if None of the selected controller"""
+        return self._call_on(device, 'MST_moving' if self.is_step_motor else 'MDC_moving')
+
+    def wait_stop(self, device: Optional[int] = None, timeout: Optional[float] = None):
+        """ Block until the current move of a device (if None, of the selected controller) is terminated
+
+        Raises an IOError if interrupted by MMC_globalBreak or by stopping this device (see stop), a TimeoutError if
+        the move is not terminated within timeout seconds. The motion flag is polled (selecting the device each time)
+        rather than waited for with the blocking waitStop functions, so that the other devices (and the dispatcher
+        of the dll) can be used meanwhile.
+        """
+        self._poll_wait_stop(lambda: self.moving(device), device=device, timeout=timeout)
+
+    def _poll_wait_stop(self, moving, poll_interval: float = 0.05, device: Optional[int] = None,
+                        timeout: Optional[float] = None):
+        """ Polling implementation of the waitStop functions, interruptible with MMC_globalBreak
+
+        The break is re-armed by each new move (moveAbs, moveRel, find_home)
+
+        Parameters
+        ----------
+        moving: callable
+            returns the motion flag (MDC_moving or MST_moving)
+        poll_interval: float
+            time in seconds between two queries of the motion flag
+        device: int or None
+            if not None, the loop is also interrupted by stopping this device
+        timeout: float or None
+            maximum waiting time in seconds before raising a TimeoutError, if None no limit
+        """
+        end = None if timeout is None else time.perf_counter() + timeout
+        while moving():
+            if end is not None and time.perf_counter() >= end:
+                raise TimeoutError(f'Move not terminated within {timeout} s')
+            if self._wait_break(poll_interval, device):
+                raise IOError('User break')
+
+    def get_status(self) -> dict:
+        """ Get in one go the position, target, distance to target (in stage units) and moving flag
+
+        Returns
+        -------
+        dict: with keys position, target, distance and moving
+        """
+        moving = 'MST_moving' if self.is_step_motor else 'MDC_moving'
+        counts, target, error, is_moving = self.MMC_batch([('MMC_getPos', ()), ('MMC_getVal', (2,)),
+                                                           ('MMC_getVal', (4,)), (moving, ())])
+        # TE (4) reports target minus actual position
+        return dict(position=self.counts_to_units(counts), target=self.counts_to_units(target),
+                    distance=self.counts_to_units(error), moving=is_moving)
+
+    def verify_devices(self, devices: List[int]) -> bool:
+        """ Check, without scanning the network, that each device is registered and answers
+
+        Parameters
+        ----------
+        devices: list of int
+            device numbers to be checked (1 to 16)
+
+        Returns
+        -------
+        bool: True if all devices could be selected and their position read
+        """
+        if len(devices) == 0:
+            return False
+        calls = []
+        for device in devices:
+            calls.extend([('MMC_select', (device,)), ('MMC_getPos', ())])
+        try:
+            results = self.MMC_batch(calls)
+        except Exception:  # IOError or the error raised by the 32 bits server
+            return False
+        return all(pos < MAXINT - 3 for pos in results[1::2])
+
+    def discover_network(self, bitmap: int = 0, rescan=False, maxAxis: int = 16) -> List[int]:
+        """ Get the device numbers of the controllers connected on the COM port
+
+        Scanning takes about 0.5s per address, so the previously discovered devices (given as a bitmap or
+        cached for the COM port) are first verified with MMC_select. If they cannot be selected (not registered in
+        this dll session), the network is scanned up to the highest of them. Only if this fails or if rescan is True,
+        is the full network scanned.
+
+        Parameters
+        ----------
+        bitmap: int
+            previously discovered devices (bit 0 for device 1), if 0 use the cache of this COM port
+        rescan: bool
+            if True, force a full scan of the network
+        maxAxis: int
+            the highest device number of the full scan
+
+        Returns
+        -------
+        list of int: the sorted device numbers
+        """
+        if not rescan:
+            bitmap = bitmap if bitmap else self.network_cache.get(self._comport, 0)
+            devices = bitmap_to_devices(bitmap)
+            if self.verify_devices(devices) or \
+                    (len(devices) > 0 and self.MMC_initNetwork(max(devices)) == devices):
+                self.network_cache[self._comport] = bitmap
+                self.devices = devices
+                return devices
+        devices = self.MMC_initNetwork(maxAxis)
+        self.network_cache[self._comport] = devices_to_bitmap(devices)
+        self.devices = devices
+        return devices
+
+    def MMC_batch(self, calls: List[Tuple[str, tuple]]) -> list:
+        """ Execute sequentially a list of calls to the MMC_ (MDC_, MST_) methods
+
+        On the 64 bits client, the whole list is executed by the 32 bits server within a single request
+
+        Parameters
+        ----------
+        calls: list of tuple
+            each tuple contains the name of the method and the tuple of its arguments, for instance:
+            [('MMC_getVal', (2,)), ('MMC_sendCommand', ('TE',)), ('MMC_getStringCR', ())]
+
+        Returns
+        -------
+        list: the results of each call
+        """
+        results = []
+        for name, args in calls:
+            if not name.startswith(('MMC_', 'MDC_', 'MST_')) or name == 'MMC_batch':
+                raise ValueError(f'{name} cannot be batched')
+            try:
+                results.append(getattr(self, name)(*args))
+            except Exception as e:
+                raise IOError(f'Batched call {name}{tuple(args)} failed: {str(e)}')
+        return results
+
+    @abstractmethod
+    def MMC_moveA(self, axis: int = 0, position: int = 0):
+        pass
+
+    @abstractmethod
+    def MMC_moveR(self, axis: int = 0, position: int = 0):
+        pass
+
+    @abstractmethod
+    def MMC_getPos(self):
+        pass
+
+    @abstractmethod
+    def MMC_COM_open(self, port: int, baudrate: int):
+        pass
+
+    @abstractmethod
+    def MMC_COM_close(self):
+        pass
+
+    @abstractmethod
+    def MMC_globalBreak(self):
+        pass
+
+    @abstractmethod
+    def MMC_sendCommand(self, cmd: str):
+        pass
+
+    @abstractmethod
+    def MMC_getVal(self, cmd: int):
+        pass
+
+    @abstractmethod
+    def MMC_getStringCR(self) -> str:
+        pass
+
+    @abstractmethod
+    def MDC_moving(self) -> bool:
+        pass
+
+    @abstractmethod
+    def MST_moving(self) -> bool:
+        pass
+
+    @abstractmethod
+    def MDC_waitStop(self):
+        pass
+
+    @abstractmethod
+    def MST_waitStop(self):
+        pass
+
+    @abstractmethod
+    def MMC_select(self, axis: int = 0):
+        """
+        Selects the specified axis (device) to enable communication with it.
+        Unlike the MMC_setDevice function, here the registration status is checked, so this function requires that the
+        MMC_initNetwork function have been called previously at the beginning of the program.
+        Parameters
+        ----------
+        axis: (int) range 1 to 16 Device number of the controller that is to be selected for communication.
+        """
+        pass
+
+    @abstractmethod
+    def MMC_initNetwork(self, maxAxis: int = 16):
+        """
+        Searches all addresses, starting at address maxAxis down to 1 for Mercury™ devices connected.
+        If a Mercury™ device (can be C-862, C-863, C-663 or C-170) is found, it is registered so as to allow access through the MMC_select() function.
+        The function MMC_initNetwork is optional. If it is not used, devices can be activated anyway using the MMC_setDevice function.
+        Parameters
+        ----------
+        maxAxis: (int) This parameter represents the highest device number from which the search is to run, continuing downwards.
+                        If you have 3 Mercury™s connected at the addresses 0,1 and 2 (this equals the device numbers 1,2 and 3) you may call the function as MMC_initNetwork(3).
+                        If you do no know what addresses the controllers are set to, call the function with maxAxis = 16 to find all devices connected. (Remember that valid device numbers range from 1 to 16.)
+                        The range of maxAxis is 1 to 16
+                        Because scanning each address takes about 0.5 seconds, it saves time to not start at device numbers higher than required.
+        Returns
+        -------
+        list: list of integers corresponding to the connected devices
+        """
+        pass
+
+
+MMCBase.add_stage('M521DG', cts_units_num=2458624, cts_units_denom=81, units='mm', motor='DC')
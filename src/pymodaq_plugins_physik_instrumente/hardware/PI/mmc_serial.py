@@ -0,0 +1,222 @@
+"""
+Pure python driver for the Mercury controllers using their native ASCII command set over a serial link.
+
+It implements the same interface as the MMC dll wrapper (see MMCBase) but doesn't need the 32 bits MMC.dll nor
+the 64 bits to 32 bits bridge. It is therefore usable on any OS and any python distribution.
+C-862 Mercury™-DC Motor Controller
+C-863 Mercury™-DC Motor Controller
+C-663 Mercury™-Step Motor Controller
+C-170 Redstone PILine® Controller
+
+See MercuryNativeCommands_MS176E101.pdf for the description of the command set
+"""
+import os
+import threading
+from typing import List, Optional
+
+import serial
+import serial.tools.list_ports as list_ports
+
+from pymodaq_plugins_physik_instrumente.hardware.PI.base import MMCBase
+
+
+ADDRESS_CODES = '0123456789ABCDEF'
+GET_VAL_COMMANDS = {1: 'TP', 2: 'TT', 3: 'TF', 4: 'TE', 5: 'TY', 6: 'TL', 7: 'GP', 8: 'GI', 9: 'GD', 10: 'GL'}
+
+
+def address_selection_code(axis: int) -> bytes:
+    """ Get the two characters address selection code of a given device number (1 to 16)"""
+    if not 1 <= axis <= 16:
+        raise IOError('Wrong axis number')
+    return b'\x01' + ADDRESS_CODES[axis - 1].encode()
+
+
+def parse_report(report: str) -> int:
+    """ Get the integer value of a report string such as 'P:+0000005555'"""
+    try:
+        return int(report.split(':')[1])
+    except (IndexError, ValueError):
+        raise IOError(f'Wrong content in the report: {report}')
+
+
+class MMCSerial(MMCBase):
+    """
+    Driver of the Mercury controllers using pyserial and the Mercury native command set
+
+    """
+    command_terminator = b'\r'
+    report_terminator = b'\x03'  # reports are terminated by CR LF ETX
+    moving_char = b'\\'  # single character command returning the moving status
+    network_scan_timeout = 0.1
+    _com_ports: Optional[List[str]] = None  # serial ports of the system, see list_com_ports
+
+    def __init__(self, stage='M521DG', com_port='COM1', baud_rate=9600, timeout=1.):
+        super().__init__(stage, com_port, baud_rate)
+        self._serial: serial.Serial = None
+        self._timeout = timeout
+        self._lock = threading.RLock()
+        self._devices = None
+        self._axis = 0
+
+    @classmethod
+    def list_com_ports(cls, refresh=False) -> List[str]:
+        """ Get the serial ports of the system (as 'COM13' or '/dev/ttyUSB0'), without VISA
+
+        The ports are listed at the first call (or if refresh is True), the result being memoized for the next ones.
+        """
+        if cls._com_ports is None or refresh:
+            MMCSerial._com_ports = [port.device for port in list_ports.comports()]
+        return cls._com_ports
+
+    def is_valid_com_port(self, com_port: str) -> bool:
+        return (com_port in self.list_com_ports() or com_port in self.list_com_ports(refresh=True) or
+                os.path.exists(com_port))
+
+    @property
+    def axis(self) -> int:
+        """ Get the currently selected device number"""
+        return self._axis
+
+    def open(self):
+        self.MMC_COM_open(self._comport, self._baudrate)
+
+    def _write(self, data: bytes):
+        if self._serial is None:
+            raise IOError('Error, not connected')
+        self._serial.write(data)
+
+    def _read_report(self) -> str:
+        report = self._serial.read_until(self.report_terminator)
+        if not report.endswith(self.report_terminator):
+            raise IOError('Error in _getString')
+        return report[:-len(self.report_terminator)].decode().strip()
+
+    def query(self, cmd: str) -> str:
+        """ Send a report command and get its reply as a string"""
+        with self._lock:
+            self._serial.reset_input_buffer()
+            self._write(cmd.encode() + self.command_terminator)
+            return self._read_report()
+
+    def MMC_batch(self, calls):
+        with self._lock:
+            return super().MMC_batch(calls)
+
+    def MMC_COM_open(self, port: str, baudrate: int):
+        self._serial = serial.Serial(port, baudrate, timeout=self._timeout)
+        self._axis = 0
+
+    def MMC_COM_close(self):
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    def MMC_COM_EOF(self) -> int:
+        return self._serial.in_waiting
+
+    def MMC_COM_clear(self):
+        self._serial.reset_input_buffer()
+
+    def MMC_setDevice(self, axis: int = 0):
+        """ Address a device, the selection code is only sent if it is not already the selected one"""
+        with self._lock:
+            if axis == self._axis:
+                return
+            self._write(address_selection_code(axis))
+            self._axis = axis
+
+    def MMC_select(self, axis: int = 0):
+        if self._devices is not None and axis not in self._devices:
+            raise IOError('axis not registered')
+        self.MMC_setDevice(axis)
+
+    def MMC_initNetwork(self, maxAxis: int = 16):
+        devices = []
+        with self._lock:
+            self._axis = 0  # forces the selection of each scanned address
+            timeout = self._serial.timeout
+            self._serial.timeout = self.network_scan_timeout
+            try:
+                for axis in range(maxAxis, 0, -1):
+                    self.MMC_setDevice(axis)
+                    try:
+                        self.query('TB')
+                        devices.append(axis)
+                    except IOError:
+                        pass
+            finally:
+                self._serial.timeout = timeout
+        devices.sort()
+        self._devices = devices
+        return devices
+
+    def MMC_moveA(self, axis: int = 0, position: int = 0):
+        with self._lock:
+            if axis > 0:
+                self.MMC_setDevice(axis)
+            self.MMC_sendCommand(f'MA{int(position)}')
+        return 0
+
+    def MMC_moveR(self, axis: int = 0, position: int = 0):
+        with self._lock:
+            if axis > 0:
+                self.MMC_setDevice(axis)
+            self.MMC_sendCommand(f'MR{int(position)}')
+        return 0
+
+    def MMC_getPos(self) -> int:
+        return parse_report(self.query('TP'))
+
+    def MMC_getVal(self, cmd: int) -> int:
+        return parse_report(self.query(GET_VAL_COMMANDS[cmd]))
+
+    def MMC_sendCommand(self, cmd: str):
+        with self._lock:
+            self._write(cmd.encode() + self.command_terminator)
+
+    def MMC_getStringCR(self) -> str:
+        with self._lock:
+            return self._read_report()
+
+    def MDC_moving(self) -> bool:
+        with self._lock:
+            self._serial.reset_input_buffer()
+            self._write(self.moving_char)
+            return self._read_report().endswith('1')
+
+    MST_moving = MDC_moving
+
+    def MDC_waitStop(self):
+        self._poll_wait_stop(self.MDC_moving)
+
+    MST_waitStop = MDC_waitStop
+
+    def MMC_globalBreak(self):
+        """ Interrupt the waiting loops and abort (AB) the motion of all the registered devices, of the selected one
+        if the network was not scanned"""
+        self._break.set()
+        if self._serial is None:
+            return
+        with self._lock:
+            selected = self._axis
+            devices = self._devices if self._devices else [selected]
+            for device in devices:
+                if device > 0:
+                    self.MMC_setDevice(device)
+                self.MMC_sendCommand('AB')
+            if selected > 0:
+                self.MMC_setDevice(selected)
+
+
+if __name__ == '__main__':
+    mmc = MMCSerial(com_port='COM13')
+    try:
+        mmc.open()
+        devices = mmc.MMC_initNetwork(3)
+        mmc.MMC_select(devices[0])
+        print(mmc.getPos())
+    except Exception as e:
+        print(e)
+        pass
+    finally:
+        mmc.close()
@@ -1,10 +1,9 @@
 import sys
-
-from abc import ABC, abstractmethod
-from ctypes import windll, create_string_buffer, byref
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import windll, create_string_buffer, c_int, c_char_p
+import functools
 import os
-
-from pyvisa import ResourceManager
+import threading
 
 try:
     from msl.loadlib import Server32
@@ -13,183 +12,55 @@ except ImportError:
     Server32 = object
     server32 = False
 
-
-def bitarray(integer: int):
-    binary_string = bin(integer)[2:]
-    return [int(bit) for bit in binary_string]
-
-
-class MMCBase(ABC):
-    """
-    Wrapper to the MMC dll from Physik Instrumente
-
+try:
+    from pymodaq_plugins_physik_instrumente.hardware.PI.base import MMCBase, bitarray
+except ImportError:  # when loaded as a top level module by the 32 bits server
+    from base import MMCBase, bitarray
+
+
+# argument and return types of the dll functions, declared once when the dll is loaded
+PROTOTYPES = {
+    'MMC_COM_open': ((c_int, c_int), c_int),
+    'MMC_COM_close': ((), c_int),
+    'MMC_COM_EOF': ((), c_int),
+    'MMC_COM_clear': ((), c_int),
+    'MMC_getDLLversion': ((), c_int),
+    'MMC_getPos': ((), c_int),
+    'MDC_getPosErr': ((), c_int),
+    'MMC_getVal': ((c_int,), c_int),
+    'MMC_getStringCR': ((c_char_p,), c_int),
+    'MMC_initNetwork': ((c_int,), c_int),
+    'MMC_moveA': ((c_int, c_int), c_int),
+    'MMC_moveR': ((c_int, c_int), c_int),
+    'MDC_moving': ((), c_int),
+    'MST_moving': ((), c_int),
+    'MMC_setDevice': ((c_int,), c_int),
+    'MMC_select': ((c_int,), c_int),
+    'MMC_sendCommand': ((c_char_p,), c_int),
+    'MDC_waitStop': ((), c_int),
+    'MST_waitStop': ((), c_int),
+    'MMC_globalBreak': ((), c_int),
+}
+
+CACHED_COMMANDS = ('TE', 'FE1', 'DH', 'AB')  # commands sent repeatedly, encoded once
+
+
+def dispatched(method):
+    """ Execute the decorated method in the dispatcher thread owning the COM port
+
+    Callers from any thread (plugin instances sharing the wrapper, polling and waiting threads) are queued and served
+    one at a time in the order of their calls. Calls made from the dispatcher thread itself (within MMC_batch for
+    instance) are executed directly. The dispatcher only runs while the COM port is open (see MMC_COM_open).
     """
-    stages = {'M521DG': dict(cts_units_num=2458624, cts_units_denom=81, units="mm")}
-    VISA_rm = ResourceManager()
-    ress = VISA_rm.list_resources_info()
-    aliases = []
-    ports = []
-    for key in ress.keys():
-        if ress[key].alias is not None:
-            if 'COM' in ress[key].alias:
-                aliases.append(ress[key].alias)
-                ports.append(ress[key].interface_board_number)
-
-    baudrates = [9600, 19200]
-
-    def __init__(self, stage='M521DG', com_port='COM1', baud_rate=9600):
-
-        if stage not in self.stages.keys():
-            raise Exception('not valid stage')
-        if com_port not in self.aliases:
-            raise IOError('invalid com port')
-        if baud_rate not in self.baudrates:
-            raise IOError('invalid baudrate')
-        self.stage = stage
-        self._comport = com_port
-        self._baudrate = baud_rate
-
-    @property
-    def comport(self):
-        return self._comport
-
-    @comport.setter
-    def comport(self,port):
-        if not isinstance(port, str):
-            raise TypeError("not a valid port type, should be a string: 'COM6'")
-        if port not in self.ports:
-            raise IOError('{} is an invalid COM port'.format(port))
-        self._comport = port
-
-    @property
-    def baudrate(self):
-        return self._comport
-
-    @baudrate.setter
-    def baudrate(self,rate):
-        if not isinstance(rate, int):
-            raise TypeError("not a valid baudrate")
-        if rate not in self.baudrates:
-            raise IOError('{} is an invalid baudrate'.format(rate))
-        self._baudrate = rate
-
-    def counts_to_units(self,counts):
-        return counts*1/(self.stages[self.stage]['cts_units_num']/self.stages[self.stage]['cts_units_denom'])
-
-    def units_to_counts(self,units):
-        return int(units/(self.stages[self.stage]['cts_units_denom']/self.stages[self.stage]['cts_units_num']))
-
-    def moveAbs(self, axis, units):
-        """
-        displacement in the selected stage units
-        Parameters
-        ----------
-        units: (float)
-        """
-        self.MMC_moveA(axis, self.units_to_counts(units))
-
-    def moveRel(self,axis, units):
-        """
-        displacement in the selected stage units
-        Parameters
-        ----------
-        units: (float)
-        """
-        self.MMC_moveR(axis, self.units_to_counts(units))
-
-    def getPos(self):
-        return self.counts_to_units(self.MMC_getPos())
-
-    def open(self):
-        port = self.ports[self.aliases.index(self._comport)]
-        self.MMC_COM_open(port, self._baudrate)
-
-    def close(self):
-        self.MMC_COM_close()
-
-    def stop(self):
-        self.MMC_globalBreak()
-
-    def find_home(self):
-        self.MMC_sendCommand('FE1')
-
-    def moving(self):
-        target = self.MMC_getVal(2)
-        self.MMC_sendCommand('TE')
-        st = self.MMC_getStringCR()
-        if '-' in st:
-            pos = -int(st.split('E:-')[1])
-        else:
-            pos = int(st.split('E:+')[1])
-        return abs(target - pos) > 100
-
-    @abstractmethod
-    def MMC_moveA(self, axis: int = 0, position: int = 0):
-        pass
-
-    @abstractmethod
-    def MMC_moveR(self, axis: int = 0, position: int = 0):
-        pass
-
-    @abstractmethod
-    def MMC_getPos(self):
-        pass
-
-    @abstractmethod
-    def MMC_COM_open(self, port: int, baudrate: int):
-        pass
-
-    @abstractmethod
-    def MMC_COM_close(self):
-        pass
-
-    @abstractmethod
-    def MMC_globalBreak(self):
-        pass
-
-    @abstractmethod
-    def MMC_sendCommand(self, cmd: str):
-        pass
-
-    @abstractmethod
-    def MMC_getVal(self, cmd: int):
-        pass
-
-    @abstractmethod
-    def MMC_getStringCR(self) -> str:
-        pass
-
-    @abstractmethod
-    def MMC_select(self, axis: int = 0):
-        """
-        Selects the specified axis (device) to enable communication with it.
-        Unlike the MMC_setDevice function, here the registration status is checked, so this function requires that the
-        MMC_initNetwork function have been called previously at the beginning of the program.
-        Parameters
-        ----------
-        axis: (int) range 1 to 16 Device number of the controller that is to be selected for communication.
-        """
-        pass
-
-    @abstractmethod
-    def MMC_initNetwork(self, maxAxis: int = 16):
-        """
-        Searches all addresses, starting at address maxAxis down to 1 for Mercury™ devices connected.
-        If a Mercury™ device (can be C-862, C-863, C-663 or C-170) is found, it is registered so as to allow access through the MMC_select() function.
-        The function MMC_initNetwork is optional. If it is not used, devices can be activated anyway using the MMC_setDevice function.
-        Parameters
-        ----------
-        maxAxis: (int) This parameter represents the highest device number from which the search is to run, continuing downwards.
-                        If you have 3 Mercury™s connected at the addresses 0,1 and 2 (this equals the device numbers 1,2 and 3) you may call the function as MMC_initNetwork(3).
-                        If you do no know what addresses the controllers are set to, call the function with maxAxis = 16 to find all devices connected. (Remember that valid device numbers range from 1 to 16.)
-                        The range of maxAxis is 1 to 16
-                        Because scanning each address takes about 0.5 seconds, it saves time to not start at device numbers higher than required.
-        Returns
-        -------
-        list: list of integers corresponding to the connected devices
-        """
-        pass
-
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self._local, 'is_dispatcher', False):
+            return method(self, *args, **kwargs)
+        dispatcher = self._dispatcher
+        if dispatcher is None:
+            raise IOError('The COM port is not open')
+        return dispatcher.submit(method, self, *args, **kwargs).result()
+    return wrapper
 
 
 class MMC_Wrapper(MMCBase, Server32):
@@ -199,31 +70,84 @@ class MMC_Wrapper(MMCBase, Server32):
                               'windll', host, port)
         else:
             Server32.__init__(self)
-            self._lib = windll.LoadLibrary(os.path.join(os.path.split(__file__)[0], 'MMC.dll'))
+            self.lib = windll.LoadLibrary(os.path.join(os.path.split(__file__)[0], 'MMC.dll'))
+        self._declare_prototypes()
+        self._string_buffer = create_string_buffer(128)  # reused by MMC_getStringCR
+        self._encoded_commands = {cmd: cmd.encode() for cmd in CACHED_COMMANDS}
         MMCBase.__init__(self, stage, com_port, baud_rate)
+        self._selected = 0  # device currently addressed on the COM port, 0 if unknown
+        self._registered = set()  # devices registered in the dll (see MMC_initNetwork), selectable with MMC_select
+        self._local = threading.local()
+        self._dispatcher: ThreadPoolExecutor = None  # started by MMC_COM_open, shut down by MMC_COM_close
 
+    def _declare_prototypes(self):
+        """ Set once the argtypes and restype of the dll functions so that ctypes doesn't guess them at each call"""
+        for name, (argtypes, restype) in PROTOTYPES.items():
+            function = getattr(self.lib, name)
+            function.argtypes = argtypes
+            function.restype = restype
+
+    def _init_dispatcher(self):
+        self._local.is_dispatcher = True
+
+    def _forget_selection(self):
+        self._selected = 0
+        self._registered.clear()
+
+    @property
+    def selected(self) -> int:
+        """ Get the device number currently addressed on the COM port (0 if unknown)"""
+        return self._selected
+
+    @dispatched
+    def MMC_batch(self, calls):
+        return super().MMC_batch(calls)
+
+    @dispatched
     def MMC_getStringCR(self):
-        st = create_string_buffer(128)
-        res = self.lib.MMC_getStringCR(byref(st))
+        res = self.lib.MMC_getStringCR(self._string_buffer)
         if res != 0:
-            return st.decode()
+            return self._string_buffer.value.decode()
         else:
             raise IOError('wrong return from dll')
 
     def MMC_COM_open(self, port_number, baudrate):
+        """
+        Opens the COM port, starting the dispatcher thread serving all the calls to the dll until MMC_COM_close
+        """
+        if self._dispatcher is None:
+            self._dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='MMC_dispatcher',
+                                                  initializer=self._init_dispatcher)
+        self._COM_open(port_number, baudrate)
+
+    @dispatched
+    def _COM_open(self, port_number, baudrate):
         res = self.lib.MMC_COM_open(port_number, baudrate)
+        self._forget_selection()
         if res != 0:
             raise IOError('wrong return from dll')
 
     def MMC_COM_close(self):
         """
         Closes the COM port previously opened by the MMC_COM_open function.
-
-        """
+        The dispatcher thread is shut down once the calls already queued are served.
+        """
+        if self._dispatcher is None:
+            return
+        try:
+            self._COM_close()
+        finally:
+            self._dispatcher.shutdown(wait=True)
+            self._dispatcher = None
+
+    @dispatched
+    def _COM_close(self):
         res = self.lib.MMC_COM_close()
+        self._forget_selection()
         if res != 0:
             raise IOError('wrong return from dll')
 
+    @dispatched
     def MMC_COM_EOF(self):
         """
         Returns the number of characters available in the COM-port input buffer
@@ -234,6 +158,7 @@ class MMC_Wrapper(MMCBase, Server32):
         res = self.lib.MMC_COM_EOF()
         return res
 
+    @dispatched
     def MMC_COM_clear(self):
         """
         Clears the COM-port input buffer.
@@ -254,6 +179,7 @@ class MMC_Wrapper(MMCBase, Server32):
         return res
 
 
+    @dispatched
     def MMC_getPos(self):
         """
         Reads the current motor position of the currently selected Mercury™ controller.
@@ -270,6 +196,7 @@ class MMC_Wrapper(MMCBase, Server32):
         res = self.lib.MMC_getPos()
         return res
 
+    @dispatched
     def MDC_getPosErr(self):
         """
         Reads the current motor-position error of the currently selected Mercury™ controller.
@@ -286,6 +213,7 @@ class MMC_Wrapper(MMCBase, Server32):
         res = self.lib.MDC_getPosErr()
         return res
 
+    @dispatched
     def MMC_getVal(self, command_ID: int):
         """
         Reads the value of the requested parameter.
@@ -315,6 +243,7 @@ class MMC_Wrapper(MMCBase, Server32):
         res = self.lib.MMC_getVal(command_ID)
         return res
 
+    @dispatched
     def MMC_initNetwork(self, maxAxis: int=16):
         """
         Searches all addresses, starting at address maxAxis down to 1 for Mercury™ devices connected.
@@ -333,6 +262,7 @@ class MMC_Wrapper(MMCBase, Server32):
         """
         devices = []
         res = self.lib.MMC_initNetwork(maxAxis)
+        self._forget_selection()  # the scan addresses each device in turn
         if res < 0:
             raise IOError('wrong return from dll')
         if res > 0:
@@ -340,8 +270,10 @@ class MMC_Wrapper(MMCBase, Server32):
             for ind in range(len(bits)):
                 if bits[-1-ind] == 1:
                     devices.append(ind+1)
+        self._registered.update(devices)
         return devices
 
+    @dispatched
     def MMC_moveA(self, axis: int=0, position: int=0):
         """
         Moves the motor of the specified axis (device number) to specified position.
@@ -349,7 +281,7 @@ class MMC_Wrapper(MMCBase, Server32):
         ----------
         axis: (int) If this parameter is 0 then the move command is sent to the currently selected device.
                     If it is >0 then an address selection code will be sent for the specified axis addressed
-                    before the move command is sent.
+                    before the move command is sent, unless it is already the selected one.
         position: (int) The new target position
 
         Returns
@@ -360,9 +292,13 @@ class MMC_Wrapper(MMCBase, Server32):
                     2: Error, not connected
                     3: Error, sendString
         """
+        axis = 0 if axis == self._selected and axis in self._registered else axis
         res = self.lib.MMC_moveA(axis, position)
+        if res == 0 and axis > 0:
+            self._selected = axis
         return res
 
+    @dispatched
     def MMC_moveR(self, axis: int=0, shift: int=0):
         """
         Moves the motor of the specified axis (device number) relative to its current position by shift counts or steps.
@@ -370,7 +306,7 @@ class MMC_Wrapper(MMCBase, Server32):
         ----------
         axis: (int) If this parameter is 0 then the move command is sent to the currently selected device.
                     If it is >0 then an address selection code will be sent for the specified axis before
-                    the move command is sent.
+                    the move command is sent, unless it is already the selected one.
         shift: (int) Position increment added to the current position.
         Returns
         -------
@@ -380,11 +316,15 @@ class MMC_Wrapper(MMCBase, Server32):
                     2: Error, not connected
                     3: Error, sendString
         """
+        axis = 0 if axis == self._selected and axis in self._registered else axis
         res = self.lib.MMC_moveR(axis, shift)
+        if res == 0 and axis > 0:
+            self._selected = axis
         return res
 
         
         
+    @dispatched
     def MDC_moving(self):
         """
         Returns the motion status of the currently selected C-862 or C-863 Mercury™ DC motor controller.
@@ -401,6 +341,7 @@ class MMC_Wrapper(MMCBase, Server32):
         else:
             return bool(res)
 
+    @dispatched
     def MST_moving(self):
         """
         Returns the moving status of the currently selected Mercury™-Step controller.
@@ -417,6 +358,7 @@ class MMC_Wrapper(MMCBase, Server32):
         else:
             return bool(res)
     
+    @dispatched
     def MMC_setDevice(self, axis: int=0):
         """
         Addresses the selected axis (controller).
@@ -430,10 +372,14 @@ class MMC_Wrapper(MMCBase, Server32):
                 Device number of the controller that shall be selected for communication.
                 The device number or address can be set by the controller's front panel DIP switches.
         """
+        if axis == self._selected:
+            return
         res = self.lib.MMC_setDevice(axis)
         if res ==1:
             raise IOError('Wrong axis number')
+        self._selected = axis
 
+    @dispatched
     def MMC_select(self, axis: int=0):
         """
         Selects the specified axis (device) to enable communication with it.
@@ -442,22 +388,32 @@ class MMC_Wrapper(MMCBase, Server32):
         Parameters
         ----------
         axis: (int) range 1 to 16 Device number of the controller that is to be selected for communication.
+        The address selection code is only sent if the device is not already the selected one, and known as
+        registered (a device selected with MMC_setDevice is checked by the dll).
         """
+        if axis == self._selected and axis in self._registered:
+            return
         res = self.lib.MMC_select(axis)
         if res == 1:
             raise IOError('Wrong axis number')
         elif res == 2:
             raise IOError('axis not registered')
+        self._selected = axis
+        self._registered.add(axis)
 
+    @dispatched
     def MMC_sendCommand(self,cmd):
-        c_cmd = create_string_buffer(cmd.encode())
-        res = self.lib.MMC_sendCommand(byref(c_cmd))
+        c_cmd = self._encoded_commands.get(cmd)
+        if c_cmd is None:
+            c_cmd = cmd.encode()
+        res = self.lib.MMC_sendCommand(c_cmd)
         if res == 114:
             raise IOError('Write error')
         elif res == 116:
             raise IOError('Length Error')
 
 
+    @dispatched
     def MDC_waitStop(self):
         """
         For C-862 Mercury™ (DC motor) C-863 Mercury™ (DC motor)
@@ -469,6 +425,7 @@ class MMC_Wrapper(MMCBase, Server32):
         elif res == 2:
             raise IOError('User break')
 
+    @dispatched
     def MST_waitStop(self):
         """
         For C-663 Mercury™-Step
@@ -484,8 +441,10 @@ class MMC_Wrapper(MMCBase, Server32):
         """
         This function interrupts pending operations waiting for termination of a move. Can be used with _moving()
         or _waitStop functions.
+        Not dispatched: it has to reach the dll while the dispatcher is blocked in a _waitStop function.
 
         """
+        self._break.set()
         res = self.lib.MMC_globalBreak()
         if res != 0:
             raise IOError('wrong return from dll')
@@ -1,23 +1,143 @@
 import sys
 import os
+import atexit
+import threading
 from pathlib import Path
+from typing import List, Tuple, Dict
 
 from msl.loadlib import Client64
-from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper import MMCBase
+from pymodaq_plugins_physik_instrumente.hardware.PI.base import MMCBase
 
 here = Path(__file__).parent
 
 
-class MMCWrapperClient64(MMCBase, Client64):
+class MMCServer32(Client64):
+    """
+    Connection to a 32 bits server process hosting the MMC dll, shared by all the clients of a COM port
+
+    The dll handles a single COM port per process, so one server is started per COM port (see acquire). When its
+    last client is released, the server is kept alive for idle_timeout seconds so that a re-initialized plugin
+    reuses it instead of paying the start of a new process. A server that doesn't answer anymore is replaced.
+    """
+    idle_timeout = 60.  # seconds before shutting down a server without clients
+    _servers: Dict[str, 'MMCServer32'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, com_port: str):
+        super().__init__(module32='mmc_wrapper', append_sys_path=str(here))
+        self.com_port = com_port
+        self.clients = 0
+        self.port_users = 0  # clients that opened the COM port, see MMCWrapperClient64.open
+        self._lock = threading.Lock()
+        self._idle_timer: threading.Timer = None
+
+    def request32(self, name, *args, **kwargs):
+        # the connection to the 32 bits server cannot be shared between threads (see wait_stop)
+        with self._lock:
+            return super().request32(name, *args, **kwargs)
+
+    def is_alive(self) -> bool:
+        """ Health check of the server process and of its dll"""
+        try:
+            self.request32('MMC_getDLLversion')
+            return True
+        except Exception:
+            return False
+
+    @classmethod
+    def acquire(cls, com_port: str) -> 'MMCServer32':
+        """ Get the running server of a COM port (if healthy) or start a new one, to be released after use"""
+        with cls._registry_lock:
+            server = cls._servers.get(com_port)
+            if server is not None:
+                server._cancel_idle_timer()
+                if not server.is_alive():
+                    server._shutdown()
+                    server = None
+            if server is None:
+                server = cls(com_port)
+                cls._servers[com_port] = server
+            server.clients += 1
+            return server
+
+    def release(self):
+        """ Release a client, the server is shut down after idle_timeout seconds without any client"""
+        with self._registry_lock:
+            self.clients -= 1
+            if self.clients <= 0:
+                self._cancel_idle_timer()
+                self._idle_timer = threading.Timer(self.idle_timeout, self._shutdown_if_idle)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _shutdown_if_idle(self):
+        with self._registry_lock:
+            if self.clients <= 0:
+                self._shutdown()
+
+    def _shutdown(self):
+        if self._servers.get(self.com_port) is self:
+            del self._servers[self.com_port]
+        try:
+            self.shutdown_server32()
+        except Exception:
+            pass
+
+    @classmethod
+    def shutdown_all(cls):
+        with cls._registry_lock:
+            for server in list(cls._servers.values()):
+                server._cancel_idle_timer()
+                server._shutdown()
+
+
+atexit.register(MMCServer32.shutdown_all)
+
+
+class MMCWrapperClient64(MMCBase):
     """
     Wrapper to the MMC dll from Physik Instrumente
 
+    The dll calls are forwarded to the 32 bits server of the COM port, shared with the other clients of this port
     """
 
     def __init__(self, stage='M521DG', com_port='COM1', baud_rate=9600):
         MMCBase.__init__(self, stage, com_port, baud_rate)
-        Client64.__init__(self, module32='mmc_wrapper',
-                          append_sys_path=str(here))
+        self._server = MMCServer32.acquire(com_port)
+        self._opened = False
+
+    def request32(self, name, *args, **kwargs):
+        if self._server is None:
+            raise IOError('Error, the 32 bits server has been released')
+        return self._server.request32(name, *args, **kwargs)
+
+    def open(self):
+        """ Open the COM port unless another client of the shared server already did"""
+        with MMCServer32._registry_lock:
+            if self._opened:
+                return
+            if self._server.port_users == 0:
+                super().open()
+            self._server.port_users += 1
+            self._opened = True
+
+    def close(self):
+        """ Close the COM port if this is its last user then release the shared server"""
+        if self._server is None:
+            return
+        with MMCServer32._registry_lock:
+            if self._opened:
+                self._server.port_users -= 1
+                self._opened = False
+                if self._server.port_users == 0:
+                    self.MMC_COM_close()
+        self._server.release()
+        self._server = None
 
     def MMC_moveA(self, axis: int=0, position: int=0):
         return self.request32('MMC_moveA', axis, position)
@@ -49,9 +169,26 @@ class MMCWrapperClient64(MMCBase, Client64):
     def MMC_initNetwork(self, maxAxis: int=16):
         return self.request32('MMC_initNetwork', maxAxis)
 
+    def MDC_moving(self) -> bool:
+        return self.request32('MDC_moving')
+
+    def MST_moving(self) -> bool:
+        return self.request32('MST_moving')
+
+    def MDC_waitStop(self):
+        # a blocking request would lock the server so poll it, between requests MMC_globalBreak can interrupt
+        self._poll_wait_stop(self.MDC_moving)
+
+    def MST_waitStop(self):
+        self._poll_wait_stop(self.MST_moving)
+
     def MMC_globalBreak(self):
+        self._break.set()
         return self.request32('MMC_globalBreak')
 
+    def MMC_batch(self, calls: List[Tuple[str, tuple]]) -> list:
+        return self.request32('MMC_batch', calls)
+
 
 if __name__ == '__main__':
     mmc = MMCWrapperClient64(com_port='COM13')
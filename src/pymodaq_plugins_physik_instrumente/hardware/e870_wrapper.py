@@ -0,0 +1,481 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from pipython import GCSDevice
+
+from pymodaq_utils.logger import set_logger, get_module_name
+
+
+logger = set_logger(get_module_name(__file__))
+
+
+class StepCalibration:
+    """
+    Open-loop calibration of a PiezoMike axis: distance done per step in each direction
+
+    The step size decreases (or increases) linearly with the load of the actuator: the nominal sizes are multiplied by
+    (1 + load_slope * load).
+
+    Parameters
+    ----------
+    forward: float
+        distance per step for positive steps (at zero load)
+    backward: float
+        distance per step for negative steps (at zero load)
+    load_slope: float
+        relative change of the step size per unit of load
+    load: float
+        the current load of the actuator
+    """
+
+    def __init__(self, forward: float = 1., backward: float = 1., load_slope: float = 0., load: float = 0.):
+        self.forward = forward
+        self.backward = backward
+        self.load_slope = load_slope
+        self.load = load
+
+    def step_size(self, direction: float) -> float:
+        """ Get the distance of a single step in the direction given by the sign of direction"""
+        size = self.forward if direction >= 0 else self.backward
+        return size * (1 + self.load_slope * self.load)
+
+    def steps_to_distance(self, steps: float) -> float:
+        return steps * self.step_size(steps)
+
+    def distance_to_steps(self, distance: float) -> int:
+        return int(np.rint(distance / self.step_size(distance)))
+
+
+class StepProfile:
+    """
+    Open-loop stepping profile of the PIShift channel
+
+    Parameters
+    ----------
+    frequency: float
+        step frequency in Hz, used to estimate the duration of the moves. It is sent to the controller only if the
+        SPA parameter ID of the step frequency is known (see E870Wrapper.step_frequency_id), otherwise it has to match
+        the frequency set on the controller
+    amplitude: float
+        step voltage amplitude (SSA command), 0 to leave the one set on the controller
+    step_scale: float
+        size of the steps done with this profile relative to the calibrated ones (see StepCalibration)
+    """
+
+    def __init__(self, frequency: float = 1000., amplitude: float = 0., step_scale: float = 1.):
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.step_scale = step_scale
+
+
+class E870Wrapper:
+    """
+    Wrapper of an E-870 PIShift controller driving up to 4 PiezoMike actuators with the pipython package.
+
+    The controller has a single PIShift channel whose output is distributed towards an axis by a demultiplexer,
+    selected with the MOD command. The wrapper remembers the selected axis so that MOD is only sent when the axis
+    changes, and open-loop step requests can be queued then executed grouped per axis (see queue_steps and
+    run_pending) to switch the demultiplexer as little as possible.
+
+    Using a calibration of each axis (see StepCalibration), the issued steps are integrated into an estimated position
+    so that estimated absolute moves are possible without external measurement.
+
+    Long moves can be split between a coarse (fast) stepping profile and a fine one for their last fine_steps steps
+    (see StepProfile and split_steps).
+
+    A stop aborts the moves being executed by run_pending or move_steps: no MOD or OSM is sent after it.
+    """
+    channel = 1  # the only PIShift channel of the E-870
+    demux_item = 2  # MOD item selecting the demultiplexer output
+    axes = [1, 2, 3, 4]
+    step_frequency_id = 0  # SPA parameter ID of the step frequency (see the controller manual), 0 to not set it
+    wait_timeout = 60.  # default maximum waiting time in seconds for the end of a move (see wait_steps_done)
+
+    def __init__(self, device: GCSDevice = None):
+        self._device: GCSDevice = device
+        self._demux_axis: int = None  # axis currently selected by the demultiplexer, None if unknown
+        self._has_osm: bool = None
+        self._pending: Dict[int, int] = {}  # axis -> steps, in the order of the first request
+        self._pending_lock = threading.Lock()  # requests can be queued while others are executed
+        self._lock = threading.RLock()
+        self._abort = threading.Event()  # set by stop, checked before each MOD/OSM of the running moves
+        self.demux_switches = 0  # number of MOD commands sent since the connection
+        self.calibrations: Dict[int, StepCalibration] = {axis: StepCalibration() for axis in self.axes}
+        self._positions: Dict[int, float] = {axis: 0. for axis in self.axes}  # estimated, including issued steps
+        self._last_steps = 0  # steps of the last move, done on the demultiplexed axis
+        self._last_scale = 1.  # relative size of these steps
+        self._state_lock = threading.Lock()  # the estimates can be read while the moves are executed
+        self.profiles: Dict[str, StepProfile] = {'coarse': StepProfile(), 'fine': StepProfile()}
+        self.use_profiles = False
+        self.fine_steps = 0  # number of steps done at the end of a move with the fine profile, 0 to not split
+        self._profile: str = None  # profile currently set on the controller, None if unknown
+
+    @property
+    def device(self) -> GCSDevice:
+        """ Get the instance of the GCSDevice"""
+        return self._device
+
+    @device.setter
+    def device(self, dev: GCSDevice):
+        self._device = dev
+        self._demux_axis = None
+        self._has_osm = None
+
+    def connect_usb(self, device_id: str):
+        """ Connect a new GCSDevice to the controller of the given USB identifier"""
+        self.device = GCSDevice()
+        self.device.ConnectUSB(device_id)
+
+    def identify(self) -> str:
+        """ Get the device string identifier """
+        return self.device.qIDN()
+
+    def close(self):
+        self.device.CloseConnection()
+
+    @property
+    def has_osm(self) -> bool:
+        """ Check (once) if the controller accepts open-loop step moves"""
+        if self._has_osm is None:
+            self._has_osm = bool(self.device.HasOSM())
+        return self._has_osm
+
+    @property
+    def demux_axis(self) -> int:
+        """ Get the axis currently selected by the demultiplexer (None if unknown)"""
+        return self._demux_axis
+
+    def select_axis(self, axis: int):
+        """ Route the PIShift channel to axis, MOD is sent only if another axis is selected
+
+        The steps still to be done on the current axis are waited for, otherwise they would be redirected.
+        """
+        with self._lock:
+            if axis == self._demux_axis:
+                return
+            if self._demux_axis is not None:
+                self.wait_steps_done()
+            if self._abort.is_set():
+                return
+            self.device.MOD(self.channel, self.demux_item, axis)
+            self._demux_axis = axis
+            self.demux_switches += 1
+
+    def steps_left(self) -> float:
+        """ Get the number of steps left of the last open-loop move"""
+        return self.device.qOSN(self.channel)[self.channel]
+
+    def is_moving(self) -> bool:
+        return self.steps_left() != 0
+
+    def wait_steps_done(self, poll_interval: float = 0.01, timeout: float = None):
+        """ Block until the last open-loop move is done or a stop is requested
+
+        Parameters
+        ----------
+        poll_interval: float
+            time in seconds between two queries of the number of steps left
+        timeout: float or None
+            maximum waiting time in seconds, an IOError is raised when elapsed. If None, wait_timeout is used
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        start = time.perf_counter()
+        while self.is_moving() and not self._abort.is_set():
+            if time.perf_counter() - start > timeout:
+                raise IOError('Timeout while waiting for the end of the open-loop move')
+            time.sleep(poll_interval)
+
+    def move_steps(self, axis: int, steps: int, profile: str = None):
+        """ Make an open-loop relative move of a number of steps (signed) on axis
+
+        Parameters
+        ----------
+        axis: int
+        steps: int
+            steps of the given profile (positive or negative)
+        profile: str or None
+            one of the keys of profiles, applied before the move. If None, the current settings are used
+
+        Returns
+        -------
+        bool: False if the move was aborted by a stop while the axis or the profile was switched
+        """
+        with self._lock:
+            self._abort.clear()
+            return self._move_steps(axis, steps, profile)
+
+    def _move_steps(self, axis: int, steps: int, profile: str = None) -> bool:
+        if not self.has_osm:
+            raise IOError('The controller cannot use the OSM command')
+        with self._lock:
+            self.select_axis(axis)
+            if profile is not None:
+                self.apply_profile(profile)
+            if self._abort.is_set():
+                return False
+            scale = self.profiles[profile].step_scale if profile is not None else 1.
+            self.device.OSM(self.channel, steps)
+            with self._state_lock:
+                self._positions[axis] += scale * self.calibrations[axis].steps_to_distance(steps)
+                self._last_steps = steps
+                self._last_scale = scale
+            return True
+
+    def apply_profile(self, name: str):
+        """ Set the step amplitude and frequency of a profile, only if another one is set
+
+        The running move is waited for before changing its profile, nothing is sent if a stop was requested meanwhile
+        """
+        with self._lock:
+            if name == self._profile:
+                return
+            profile = self.profiles[name]
+            self.wait_steps_done()
+            if self._abort.is_set():
+                return
+            if profile.amplitude:
+                self.device.SSA(self.channel, profile.amplitude)
+            if self.step_frequency_id and profile.frequency:
+                self.device.SPA(self.channel, self.step_frequency_id, profile.frequency)
+            self._profile = name
+
+    def load_profiles(self, profiles: dict):
+        """ Set the stepping profiles from the config (see the e870.profiles section)"""
+        self.use_profiles = profiles.get('use_profiles', False)
+        self.fine_steps = profiles.get('fine_steps', 0)
+        self.step_frequency_id = profiles.get('step_frequency_id', 0)
+        for name in self.profiles:
+            if name in profiles:
+                self.profiles[name] = StepProfile(**profiles[name])
+        self._profile = None
+        if self.use_profiles and not self.step_frequency_id:
+            logger.warning('The step frequency ID is not set: the profiles only change the step amplitude, their '
+                           'frequencies only estimate the duration of the moves')
+
+    def split_steps(self, steps: int) -> List[Tuple[str, int]]:
+        """ Split a move of calibrated steps into its coarse part and its last fine_steps done with the fine profile
+
+        Returns
+        -------
+        list of tuple: (profile name, number of steps of this profile), the profile is None if profiles are not used
+        """
+        if not self.use_profiles:
+            return [(None, steps)]
+        fine = self.profiles['fine']
+        if abs(steps) <= self.fine_steps:
+            return [('fine', int(np.rint(steps / fine.step_scale)))]
+        fine_steps = int(np.sign(steps)) * self.fine_steps
+        coarse = self.profiles['coarse']
+        return [('coarse', int(np.rint((steps - fine_steps) / coarse.step_scale))),
+                ('fine', int(np.rint(fine_steps / fine.step_scale)))]
+
+    def estimate_duration(self, steps: int) -> float:
+        """ Estimate the duration in seconds of a move of calibrated steps from the step frequencies"""
+        return sum(abs(n) / self.profiles[profile if profile is not None else 'coarse'].frequency
+                   for profile, n in self.split_steps(steps))
+
+    def load_calibrations(self, calibrations: Dict[str, dict]):
+        """ Set the calibration of the axes from a mapping of the axis number (as a string, from the config) to the
+        keyword arguments of StepCalibration"""
+        for axis, calibration in calibrations.items():
+            if int(axis) in self.axes:
+                self.calibrations[int(axis)] = StepCalibration(**calibration)
+
+    def _steps_left_distance(self, axis: int) -> float:
+        """ Get the distance still to be done by the running move of axis"""
+        if axis != self._demux_axis or self._last_steps == 0:
+            return 0.
+        with self._state_lock:
+            sign, scale = np.sign(self._last_steps), self._last_scale
+        return scale * self.calibrations[axis].steps_to_distance(sign * abs(self.steps_left()))
+
+    def get_estimated_position(self, axis: int) -> float:
+        """ Get the position of axis estimated from the steps done since the last set_estimated_position"""
+        left = self._steps_left_distance(axis)
+        with self._state_lock:
+            return self._positions[axis] - left
+
+    def set_estimated_position(self, axis: int, position: float = 0.):
+        """ Set the estimated position of axis, for instance after an external measurement"""
+        left = self._steps_left_distance(axis)
+        with self._state_lock:
+            self._positions[axis] = position + left
+
+    def estimated_steps_to(self, axis: int, target: float) -> int:
+        """ Get the number of steps moving axis from its estimated position (once the issued steps are done) to
+        target"""
+        with self._pending_lock:
+            pending = self.calibrations[axis].steps_to_distance(self._pending.get(axis, 0))
+        return self.calibrations[axis].distance_to_steps(target - self._positions[axis] - pending)
+
+    def queue_steps(self, axis: int, steps: int):
+        """ Add a step request to the pending ones, requests on the same axis are merged"""
+        with self._pending_lock:
+            self._pending[axis] = self._pending.get(axis, 0) + steps
+
+    @property
+    def pending(self) -> Dict[int, int]:
+        return dict(self._pending)
+
+    def run_pending(self, wait=True) -> List[Tuple[int, int]]:
+        """ Execute the pending step requests grouped per axis, starting with the currently selected one
+
+        Parameters
+        ----------
+        wait: bool
+            if True, wait for the end of the last move before returning
+
+        Returns
+        -------
+        list of tuple: the executed (axis, steps) moves in their order of execution, the ones not started because of
+        a stop are not included
+        """
+        with self._lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+                self._abort.clear()
+            order = sorted(pending, key=lambda axis: axis != self._demux_axis)  # stable: keeps the request order
+            moves = [(axis, pending[axis]) for axis in order if pending[axis] != 0]
+            done = []
+            for axis, steps in moves:
+                if self._abort.is_set():
+                    break
+                for profile, profile_steps in self.split_steps(steps):
+                    if not self._move_steps(axis, profile_steps, profile):
+                        break
+                else:
+                    done.append((axis, steps))
+            if wait:
+                self.wait_steps_done()
+        return done
+
+    def stop(self):
+        """ Stop all moves and forget the pending requests (without waiting for the running ones)
+
+        The estimated position of the moving axis is corrected by the steps that were not done. A run_pending or
+        move_steps being executed in another thread sends no more MOD or OSM.
+        """
+        with self._pending_lock:
+            self._pending = {}
+            self._abort.set()
+        axis = self._demux_axis
+        left = self._steps_left_distance(axis) if axis is not None else 0.
+        self.device.StopAll()
+        if axis is not None:
+            with self._state_lock:
+                self._positions[axis] -= left
+                self._last_steps = 0
+
+
+class E870Group:
+    """
+    Several E-870 controllers driven together, each one having its own PIShift channel
+
+    The axes of all controllers are identified by an integer code: 10 * (controller index + 1) + axis, so that the
+    axis 2 of the first controller is 12. Pending moves of different controllers are executed concurrently, as the
+    only parallelism of these single channel controllers comes from driving several of them at the same time.
+    """
+
+    def __init__(self, controllers: List[E870Wrapper] = None):
+        self.controllers: List[E870Wrapper] = controllers if controllers is not None else []
+        self.device_ids: List[str] = []
+        self._executor: ThreadPoolExecutor = None
+
+    def connect_usb(self, device_ids: List[str]):
+        """ Connect a controller for each of the given USB identifiers"""
+        for device_id in device_ids:
+            controller = E870Wrapper()
+            controller.connect_usb(device_id)
+            self.controllers.append(controller)
+            self.device_ids.append(device_id)
+
+    @staticmethod
+    def axis_code(index: int, axis: int) -> int:
+        return 10 * (index + 1) + axis
+
+    def split_code(self, code: int) -> Tuple[E870Wrapper, int]:
+        """ Get the controller and its axis from an axis code"""
+        index, axis = divmod(code, 10)
+        return self.controllers[index - 1], axis
+
+    @property
+    def axis_names(self) -> Dict[str, int]:
+        """ Get the names of the axes of all controllers mapped to their code"""
+        names = {}
+        for index, controller in enumerate(self.controllers):
+            device_id = self.device_ids[index] if index < len(self.device_ids) else str(index + 1)
+            for axis in controller.axes:
+                names[f'{device_id} axis {axis}'] = self.axis_code(index, axis)
+        return names
+
+    def identify(self) -> str:
+        return ' / '.join(controller.identify() for controller in self.controllers)
+
+    def close(self):
+        for controller in self.controllers:
+            controller.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @property
+    def has_osm(self) -> bool:
+        return len(self.controllers) > 0 and all(controller.has_osm for controller in self.controllers)
+
+    def load_calibrations(self, calibrations: Dict[str, dict]):
+        for controller in self.controllers:
+            controller.load_calibrations(calibrations)
+
+    def load_profiles(self, profiles: dict):
+        for controller in self.controllers:
+            controller.load_profiles(profiles)
+
+    def get_estimated_position(self, code: int) -> float:
+        controller, axis = self.split_code(code)
+        return controller.get_estimated_position(axis)
+
+    def set_estimated_position(self, code: int, position: float = 0.):
+        controller, axis = self.split_code(code)
+        controller.set_estimated_position(axis, position)
+
+    def estimated_steps_to(self, code: int, target: float) -> int:
+        controller, axis = self.split_code(code)
+        return controller.estimated_steps_to(axis, target)
+
+    def distance_to_steps(self, code: int, distance: float) -> int:
+        controller, axis = self.split_code(code)
+        return controller.calibrations[axis].distance_to_steps(distance)
+
+    def estimate_duration(self, code: int, steps: int) -> float:
+        controller, axis = self.split_code(code)
+        return controller.estimate_duration(steps)
+
+    def queue_steps(self, code: int, steps: int):
+        controller, axis = self.split_code(code)
+        controller.queue_steps(axis, steps)
+
+    def run_pending(self, wait=True) -> Dict[int, List[Tuple[int, int]]]:
+        """ Execute concurrently the pending moves of each controller (see E870Wrapper.run_pending)
+
+        Returns
+        -------
+        dict: controller index -> executed (axis, steps) moves of this controller
+        """
+        busy = [index for index, controller in enumerate(self.controllers) if controller.pending]
+        if len(busy) == 0:
+            return {}
+        if len(busy) == 1:
+            return {busy[0]: self.controllers[busy[0]].run_pending(wait)}
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.controllers), thread_name_prefix='E870')
+        futures = {index: self._executor.submit(self.controllers[index].run_pending, wait) for index in busy}
+        return {index: future.result() for index, future in futures.items()}
+
+    def stop(self):
+        for controller in self.controllers:
+            controller.stop()
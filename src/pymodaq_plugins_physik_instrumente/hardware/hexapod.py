@@ -0,0 +1,111 @@
+"""
+Validation of hexapod poses (HEX_GCS_DLL devices such as the C-887) before multi-axis moves.
+
+The six axes X, Y, Z, U, V, W of a hexapod are not independent: a pose within the travel range of each axis can
+still be out of the workspace. The controller tells if a pose is reachable (VMO?), this module validates whole
+arrays of poses with as few of these queries as possible.
+"""
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from pymodaq_plugins_physik_instrumente.hardware.pi_wrapper import PIWrapper
+
+
+class HexapodPoses:
+    """ Validate arrays of hexapod poses with the VMO? query, keeping the answers locally
+
+    The poses are first checked against the travel range of each axis (qTMN/qTMX, read once), which rejects the
+    obviously unreachable ones without any query. The remaining poses are rounded to the resolution and only the
+    distinct poses not already known are sent to the controller, in batches: the VMO? queries of a batch are sent in
+    a single transfer followed by a single error query (see PIWrapper.transaction).
+
+    Parameters
+    ----------
+    wrapper: PIWrapper
+        connected to a hexapod controller
+    axes: sequence of str
+        the axes of a pose, in the order of the pose array columns
+    resolution: float
+        poses closer than this on every axis share the same answer
+    batch_size: int
+        number of VMO? queries per transfer
+    """
+
+    def __init__(self, wrapper: PIWrapper, axes: Sequence[str] = ('X', 'Y', 'Z', 'U', 'V', 'W'),
+                 resolution: float = 1e-4, batch_size: int = 50):
+        self.wrapper = wrapper
+        self.axes = list(axes)
+        self.resolution = resolution
+        self.batch_size = batch_size
+        self.queries = 0  # number of VMO? queries sent, for diagnostics
+        self._limits: Tuple[np.ndarray, np.ndarray] = None
+        self._reachable: Dict[tuple, bool] = {}  # answers of the controller by rounded pose
+
+    @property
+    def limits(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Get the min and max travel range of the axes as arrays"""
+        if self._limits is None:
+            limits = np.array([self.wrapper.get_axis_limits(axis) for axis in self.axes], dtype=float)
+            self._limits = limits[:, 0], limits[:, 1]
+        return self._limits
+
+    def clear_cache(self):
+        """ Forget the known poses and the travel range, for instance after a change of pivot point"""
+        self._limits = None
+        self._reachable = {}
+
+    def _keys(self, poses: np.ndarray) -> np.ndarray:
+        return np.round(poses / self.resolution).astype(np.int64)
+
+    def validate(self, poses: np.ndarray) -> np.ndarray:
+        """ Check which poses the hexapod can reach
+
+        Parameters
+        ----------
+        poses: ndarray
+            of shape (N, len(axes)) or (len(axes),)
+
+        Returns
+        -------
+        ndarray of bool: the mask of the reachable poses, of shape (N,) or () for a single pose
+        """
+        poses = np.asarray(poses, dtype=float)
+        single = poses.ndim == 1
+        poses = np.atleast_2d(poses)
+        if poses.shape[1] != len(self.axes):
+            raise ValueError(f'The poses should have {len(self.axes)} coordinates: {self.axes}')
+
+        min_values, max_values = self.limits
+        mask = np.all((poses >= min_values) | np.isnan(min_values), axis=1) & \
+            np.all((poses <= max_values) | np.isnan(max_values), axis=1)
+
+        keys = self._keys(poses[mask])
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        unknown = [tuple(key) for key in unique_keys if tuple(key) not in self._reachable]
+        self._query(unknown)
+        reachable = np.array([self._reachable[tuple(key)] for key in unique_keys], dtype=bool)
+        mask[mask] = reachable[inverse.reshape(-1)]
+        return mask[0] if single else mask
+
+    def _query(self, keys: List[tuple]):
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            with self.wrapper.transaction() as transaction:
+                with transaction.segment():  # a single error query for the batch
+                    answers = [transaction.query('qVMO', self.axes, list(np.array(key) * self.resolution))
+                               for key in batch]
+            for key, answer in zip(batch, answers):
+                self._reachable[key] = bool(answer.value)
+            self.queries += len(batch)
+
+    def move(self, pose: Sequence[float]):
+        """ Move all the axes to a pose at once, after checking it is reachable
+
+        Raises
+        ------
+        ValueError: if the pose is out of the workspace
+        """
+        if not self.validate(pose):
+            raise ValueError(f'The pose {dict(zip(self.axes, pose))} is not reachable')
+        self.wrapper.move_axes(dict(zip(self.axes, pose)))
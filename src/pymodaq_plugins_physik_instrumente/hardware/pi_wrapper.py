@@ -1,10 +1,21 @@
 
-from typing import Tuple, List, Union
+import copy
+import hashlib
+import json
+import math
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Tuple, List, Union, Dict, Optional, Iterable, Callable
 from pathlib import Path
+from datetime import datetime
+from time import perf_counter, time
 
 import numpy as np
 import os
 from pipython import GCSDevice, GCSError
+from pipython.pidevice import gcserror
 from pipython.pidevice.interfaces.gcsdll import get_gcstranslator_dir
 
 
@@ -26,6 +37,602 @@ devices, devices_name, dll_names = get_devices_and_dlls(possible_dll_names)
 ConnectionEnum = BaseEnum('ConnectionEnum', ['RS232', 'USB', 'TCP/IP'])
 
 
+class MotionProfile:
+    """ Velocity, acceleration and deceleration of an axis used for the moves up to a given distance
+
+    Parameters
+    ----------
+    velocity: float or None
+        VEL value in axis units per second, None to keep the controller value
+    acceleration: float or None
+        ACC value in axis units per second², None to keep the controller value
+    deceleration: float or None
+        DEC value in axis units per second², None to keep the controller value
+    max_distance: float
+        the profile is used for moves whose absolute distance is up to this value
+    """
+
+    def __init__(self, velocity: float = None, acceleration: float = None, deceleration: float = None,
+                 max_distance: float = np.inf):
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.deceleration = deceleration
+        self.max_distance = max_distance
+
+    def commands(self) -> List[Tuple[str, float]]:
+        """ Get the GCS commands and values setting this profile"""
+        return [(command, value) for command, value in
+                (('VEL', self.velocity), ('ACC', self.acceleration), ('DEC', self.deceleration))
+                if value is not None]
+
+
+class SettleDetector:
+    """ Detect the settling of an axis on its target from a window of consecutive position readings
+
+    The axis is settled once `window` consecutive readings are within `tolerance` of the target, so that the
+    ringing of a piezo stage crossing its target is not taken as the end of the move. The settle time is the time
+    of the first reading of this stable window relative to the start of the move.
+
+    Parameters
+    ----------
+    tolerance: float
+        maximum absolute distance to the target, in axis units
+    window: int
+        number of consecutive readings within tolerance
+    """
+
+    def __init__(self, tolerance: float = 1e-3, window: int = 5):
+        self.tolerance = tolerance
+        self.window = max(1, int(window))
+        self.target: float = None
+        self.start_time: float = None
+        self.settle_time: float = None
+        self._count = 0  # readings within tolerance at the end of the previous samples
+        self._first_time: float = None  # time of the first of these readings
+
+    def start(self, target: float, start_time: float = None):
+        """ Reset the detector for a new move toward target"""
+        self.target = target
+        self.start_time = perf_counter() if start_time is None else start_time
+        self.settle_time = None
+        self._count = 0
+        self._first_time = None
+
+    @property
+    def settled(self) -> bool:
+        return self.settle_time is not None
+
+    def add_samples(self, positions: Union[float, Iterable[float]], times: Union[float, Iterable[float]] = None) \
+            -> bool:
+        """ Feed position readings, a single one or a batch such as recorder samples
+
+        Parameters
+        ----------
+        positions: float or array of float
+        times: float or array of float
+            the time of each reading on the perf_counter time base, the current time if None
+
+        Returns
+        -------
+        bool: True if the axis is settled
+        """
+        if self.settled or self.target is None:
+            return self.settled
+        positions = np.atleast_1d(np.asarray(positions, dtype=float))
+        times = np.full(positions.shape, perf_counter()) if times is None else \
+            np.atleast_1d(np.asarray(times, dtype=float))
+        indexes = np.arange(len(positions))
+        within = np.abs(positions - self.target) <= self.tolerance
+        last_out = np.maximum.accumulate(np.where(within, -1, indexes))
+        # length of the run of readings within tolerance ending at each index, including the previous samples
+        runs = np.where(last_out < 0, indexes + 1 + self._count, indexes - last_out)
+        done = np.flatnonzero(runs >= self.window)
+        if len(done) != 0:
+            first = done[0] - self.window + 1
+            first_time = times[first] if first >= 0 else self._first_time
+            self.settle_time = first_time - self.start_time
+        elif len(runs) != 0:
+            if runs[-1] <= len(positions):
+                self._first_time = times[len(positions) - runs[-1]] if runs[-1] > 0 else None
+            self._count = int(runs[-1])
+        return self.settled
+
+
+class PositionHistory:
+    """ Fixed size ring buffer of timestamped axis positions and on-target flags
+
+    The arrays are allocated once (see resize), appending a reading only writes into them and the oldest readings
+    are overwritten once the buffer is full. It is filled by the position readings done anyway, so that drift
+    analysis or post scan checks don't need other queries to the controller. It is filled from the polling and
+    plugin threads, its methods are serialized by a lock.
+
+    Parameters
+    ----------
+    size: int
+        maximum number of readings kept
+    """
+    record_nbytes = 8 + 2 + 8 + 1  # time, axis index, position, on-target flag
+
+    def __init__(self, size: int = 10000):
+        self.axis_names: List[str] = []  # axis name of each axis index
+        self._axis_indexes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.resize(size)
+
+    @classmethod
+    def from_memory(cls, nbytes: int) -> 'PositionHistory':
+        """ Get a history using at most nbytes of memory"""
+        return cls(nbytes // cls.record_nbytes)
+
+    def resize(self, size: int):
+        """ Allocate the buffer for size readings, the current content is lost"""
+        with self._lock:
+            self.size = max(1, int(size))
+            self._times = np.full(self.size, np.nan)
+            self._axes = np.zeros(self.size, dtype=np.int16)
+            self._positions = np.full(self.size, np.nan)
+            self._on_target = np.full(self.size, -1, dtype=np.int8)  # -1 if unknown
+            self._index = 0  # where the next reading is written
+            self._count = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.record_nbytes
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        with self._lock:
+            self._index = 0
+            self._count = 0
+
+    def _axis_index(self, axis_name: str) -> int:
+        if axis_name not in self._axis_indexes:
+            self._axis_indexes[axis_name] = len(self.axis_names)
+            self.axis_names.append(axis_name)
+        return self._axis_indexes[axis_name]
+
+    def append(self, axis_name: str, position: float, on_target: int = -1, timestamp: float = None):
+        """ Store a reading
+
+        Parameters
+        ----------
+        axis_name: str
+        position: float
+        on_target: int
+            1 if the axis is on target, 0 if not, -1 if unknown
+        timestamp: float
+            time of the reading in seconds since the epoch, now if None
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self._lock:
+            index = self._index
+            self._times[index] = timestamp
+            self._axes[index] = self._axis_index(axis_name)
+            self._positions[index] = position
+            self._on_target[index] = on_target
+            self._index = (index + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def snapshot(self, axis_name: str = None) -> Dict[str, np.ndarray]:
+        """ Get a copy of the readings in chronological order
+
+        Parameters
+        ----------
+        axis_name: str or None
+            only get the readings of this axis if not None
+
+        Returns
+        -------
+        dict: of arrays, 'time', 'axis' (axis names), 'position' and 'on_target'
+        """
+        with self._lock:
+            order = (np.arange(self._count) + self._index - self._count) % self.size
+            if axis_name is not None:
+                order = order[self._axes[order] == self._axis_indexes.get(axis_name, -1)]
+            return dict(time=self._times[order], axis=np.array(self.axis_names + [''])[self._axes[order]],
+                        position=self._positions[order], on_target=self._on_target[order])
+
+    def export(self, path: Union[str, Path], axis_name: str = None):
+        """ Save the readings as a CSV file: time, axis, position, on_target"""
+        snapshot = self.snapshot(axis_name)
+        with open(path, 'w') as file:
+            file.write('time,axis,position,on_target\n')
+            for row in zip(snapshot['time'], snapshot['axis'], snapshot['position'], snapshot['on_target']):
+                file.write('{:.6f},{},{!r},{}\n'.format(row[0], row[1], float(row[2]), row[3]))
+
+
+def same_parameter_value(value, other) -> bool:
+    """ Compare two parameter values, numbers (or their string representations) up to the float precision"""
+    try:
+        return math.isclose(float(value), float(other), rel_tol=1e-9, abs_tol=1e-12)
+    except (TypeError, ValueError):
+        return str(value).strip() == str(other).strip()
+
+
+class ParameterSnapshot:
+    """ Values of controller parameters, {item: {parameter ID: value}}, that can be saved, loaded and compared
+
+    Parameters
+    ----------
+    parameters: dict
+        {item: {parameter ID: value}}, items are axes, channels or systems as strings
+    controller: str
+        identification of the controller the values were read from
+    created: str
+        ISO date of the reading, now if None
+    """
+    version = 1  # of the file format
+
+    def __init__(self, parameters: Dict[str, Dict[int, Union[int, float, str]]], controller: str = '',
+                 created: str = None):
+        self.parameters = {str(item): dict(values) for item, values in parameters.items()}
+        self.controller = controller
+        self.created = datetime.now().isoformat(timespec='seconds') if created is None else created
+
+    def __len__(self):
+        return sum(len(values) for values in self.parameters.values())
+
+    def save(self, path: Union[str, Path]):
+        """ Save the snapshot as a JSON file, parameter IDs written in hexadecimal"""
+        content = dict(version=self.version, controller=self.controller, created=self.created,
+                       parameters={item: {hex(param): value for param, value in values.items()}
+                                   for item, values in self.parameters.items()})
+        with open(path, 'w') as file:
+            json.dump(content, file, indent=1)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'ParameterSnapshot':
+        """ Load a snapshot saved with save
+
+        Raises
+        ------
+        ValueError: if the file was saved by a newer version
+        """
+        with open(path) as file:
+            content = json.load(file)
+        if content.get('version', 0) > cls.version:
+            raise ValueError(f'The parameter file {path} has the version {content["version"]}, '
+                             f'only versions up to {cls.version} are supported')
+        return cls({item: {int(param, 16): value for param, value in values.items()}
+                    for item, values in content['parameters'].items()},
+                   content.get('controller', ''), content.get('created'))
+
+    def diff(self, desired: Union['ParameterSnapshot', Dict[str, Dict[int, Union[int, float, str]]]]) \
+            -> Dict[str, Dict[int, Union[int, float, str]]]:
+        """ Get the minimal set of values to write so that the parameters match the desired ones
+
+        Parameters
+        ----------
+        desired: ParameterSnapshot or dict
+            the desired values, only these parameters are compared
+
+        Returns
+        -------
+        dict: {item: {parameter ID: desired value}} of the values differing from (or missing in) this snapshot
+        """
+        if isinstance(desired, ParameterSnapshot):
+            desired = desired.parameters
+        changes = {}
+        for item, values in desired.items():
+            current = self.parameters.get(str(item), {})
+            for param, value in values.items():
+                if param not in current or not same_parameter_value(current[param], value):
+                    changes.setdefault(str(item), {})[param] = value
+        return changes
+
+
+class MacroStep:
+    """ One step of a GCS macro: a move, a wait on target, a dwell time and an optional trigger pulse
+
+    Parameters
+    ----------
+    targets: dict
+        {axis_name: position}, a position can also be a macro argument such as '$1'
+    dwell: int or str
+        time in ms to wait once on target, or a macro argument
+    trigger: int or None
+        digital output line pulsed at the end of the step, None for no pulse
+    """
+
+    def __init__(self, targets: Dict[str, Union[float, str]], dwell: Union[int, str] = 0, trigger: int = None):
+        self.targets = targets
+        self.dwell = dwell
+        self.trigger = trigger
+
+
+class DeferredAnswer:
+    """ Answer of a query made within a transaction, available once the transaction is sent"""
+
+    def __init__(self, command: str, args: tuple):
+        self.command = command
+        self.args = args
+        self.done = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self.done:
+            raise IOError(f'The answer of {self.command} is only available at the end of the transaction')
+        return self._value
+
+
+class _QueryRecorded(Exception):
+    """ Interrupts a pipython query method once its command string is recorded"""
+
+
+class _CommandRecorder:
+    """ Stands for the GCS messages of a device within a transaction, keeping the command strings"""
+    errcheck = False
+    embederr = False
+
+    def __init__(self):
+        self.cmdstrs: List[str] = []
+        self.querying = False  # True while a query of Transaction.query is recorded
+
+    def send(self, tosend: str):
+        self.cmdstrs.append(tosend.rstrip('\n'))
+
+    def read(self, tosend: str, gcsdata=0):
+        if not self.querying:
+            raise IOError('Queries are deferred to the end of a transaction, use Transaction.query')
+        if gcsdata != 0:
+            raise IOError(f'{tosend.strip()} reads GCS data, it cannot be made within a transaction')
+        self.cmdstrs.append(tosend.rstrip('\n'))
+        raise _QueryRecorded
+
+
+class _AnswerReplay:
+    """ Stands for the GCS messages of a device when the answers read by a transaction are parsed by pipython
+
+    A query not made by the transaction (for instance the axes needed by a query without argument) is sent to the
+    controller.
+    """
+
+    def __init__(self, answers: Dict[str, List[str]], messages):
+        self._answers = answers
+        self._messages = messages
+        self.errcheck = messages.errcheck
+        self.embederr = messages.embederr
+
+    def send(self, tosend: str):
+        self._messages.send(tosend)
+
+    def read(self, tosend: str, gcsdata=0):
+        answers = self._answers.get(tosend.rstrip('\n'), [])
+        if len(answers) != 0:
+            return answers.pop(0)
+        return self._messages.read(tosend, gcsdata)
+
+
+_ANSWER_END = re.compile('(?<! )\n')  # a GCS answer ends with a linefeed not preceded by a space
+
+
+def _transfers_supported(device: GCSDevice) -> bool:
+    """ Check that the pipython internals used to record the commands and to send them in a single transfer are
+    available (GCSMessages of the commands, its lock, timeout and interface), see the pipython versions supported in
+    pyproject.toml"""
+    messages = getattr(getattr(device, 'gcscommands', None), '_msgs', None)
+    interface = getattr(messages, 'interface', None)
+    return (hasattr(messages, '_lock') and hasattr(messages, 'timeout') and
+            callable(getattr(interface, 'send', None)) and callable(getattr(interface, 'read', None)))
+
+
+def _exchange(device: GCSDevice, tosend: str, count: int) -> List[str]:
+    """ Send several command lines in a single transfer and read the count answers they produce
+
+    GCSMessages.read only expects one answer per transfer, the answers are split here following the GCS syntax.
+    """
+    messages = device.gcscommands._msgs
+    with messages._lock:  # taken by GCSMessages for each transfer, the ones of other threads are not interleaved
+        messages.interface.send(tosend + '\n')
+        answers, received = [], ''
+        deadline = perf_counter() + messages.timeout / 1000.
+        while len(answers) < count:
+            chunk = messages.interface.read()
+            if chunk:
+                received += chunk
+                deadline = perf_counter() + messages.timeout / 1000.
+                start = 0
+                for match in _ANSWER_END.finditer(received):
+                    answers.append(received[start:match.end()])
+                    start = match.end()
+                    if len(answers) == count:
+                        break
+                received = received[start:]
+            elif perf_counter() > deadline:
+                raise GCSError(gcserror.E_7_COM_TIMEOUT, f'{count - len(answers)} answers missing of the transfer')
+    return answers
+
+
+class _Segment:
+    """ Calls of a transaction checked by a single error query, and the answers of its queries"""
+
+    def __init__(self):
+        self.calls: List[Tuple[str, tuple]] = []
+        self.cmdstrs: List[str] = []
+        self.answers: List[Tuple[str, DeferredAnswer]] = []  # command string and answer of each query
+        self.queries: Dict[int, DeferredAnswer] = {}  # index in calls of each query, for sequential transactions
+
+    def describe(self) -> str:
+        return ', '.join(f'{command}{args}' for command, args in self.calls) + f' -> {self.cmdstrs}'
+
+
+class Transaction:
+    """ Collect GCS commands and queries and send them to the controller in a single transfer
+
+    The commands are called as on the GCSDevice (transaction.WGO(1, 0)...), pipython formatting and checking their
+    arguments, but the command strings are only recorded, as the ones of the queries (see query). They are sent
+    together in a single transfer when the transaction is committed, the answers being read back in order.
+
+    If check is True, an error query (ERR?) follows each segment within the transfer: a segment is a single call,
+    or the calls of a segment block (see segment). The GCSError then names the segment that failed. The commands
+    following a failing one are still executed by the controller.
+
+    Recording and sending the command strings rely on internals of pipython. If they are missing (another pipython
+    version than the supported ones), the transaction is sequential: its calls are made one by one on the device at
+    commit, with the usual error checks, and its command strings (cmdstr) are not available.
+
+    Parameters
+    ----------
+    wrapper: PIWrapper
+    check: bool
+        query the error register after each segment
+
+    See Also
+    --------
+    PIWrapper.transaction
+    """
+
+    def __init__(self, wrapper: 'PIWrapper', check: bool = True):
+        self._wrapper = wrapper
+        self.check = check
+        self.segments: List[_Segment] = []
+        self._segment_depth = 0
+        self._recorder = _CommandRecorder()
+        self.sequential = not _transfers_supported(wrapper.device)
+        if not self.sequential:
+            self._commands = copy.copy(wrapper.device.gcscommands)
+            self._commands._msgs = self._recorder
+
+    def __getattr__(self, command: str):
+        if command.startswith('_'):
+            raise AttributeError(command)
+        if self.sequential:
+            getattr(self._wrapper.device, command)  # unknown commands raise at once
+
+            def record_call(*args):
+                self._segment().calls.append((command, args))
+            return record_call
+        method = getattr(self._commands, command)
+
+        def record(*args):
+            start = len(self._recorder.cmdstrs)
+            method(*args)
+            segment = self._segment()
+            segment.calls.append((command, args))
+            segment.cmdstrs.extend(self._recorder.cmdstrs[start:])
+        return record
+
+    def _segment(self) -> _Segment:
+        """ Get the segment of the next call, a new one unless within a segment block"""
+        if self._segment_depth == 0 or len(self.segments) == 0:
+            self.segments.append(_Segment())
+        return self.segments[-1]
+
+    @contextmanager
+    def segment(self):
+        """ Group the calls of the block in a single segment, for instance a macro definition that should not
+        contain error queries"""
+        if self._segment_depth == 0:
+            self.segments.append(_Segment())
+        self._segment_depth += 1
+        try:
+            yield self
+        finally:
+            self._segment_depth -= 1
+
+    def query(self, command: str, *args) -> DeferredAnswer:
+        """ Record a query, such as query('qPOS', '1'), whose answer is read when the transaction is sent"""
+        answer = DeferredAnswer(command, args)
+        if self.sequential:
+            if not command.startswith('q'):
+                raise ValueError(f'{command} is not a query')
+            segment = self._segment()
+            segment.queries[len(segment.calls)] = answer
+            segment.calls.append((command, args))
+            return answer
+        start = len(self._recorder.cmdstrs)
+        self._recorder.querying = True
+        try:
+            getattr(self._commands, command)(*args)
+        except _QueryRecorded:
+            pass
+        else:
+            raise ValueError(f'{command} is not a query')
+        finally:
+            self._recorder.querying = False
+        cmdstrs = self._recorder.cmdstrs[start:]
+        segment = self._segment()
+        segment.calls.append((command, args))
+        segment.cmdstrs.extend(cmdstrs)
+        segment.answers.append((cmdstrs[-1], answer))
+        return answer
+
+    @property
+    def cmdstr(self) -> str:
+        """ The command strings of the transaction, one per line"""
+        if self.sequential:
+            raise IOError('The command strings cannot be recorded with this pipython version')
+        return '\n'.join(self._recorder.cmdstrs)
+
+    def commit(self):
+        """ Send the recorded commands and queries in a single transfer then parse the answers
+
+        The transfer goes through the supervised link of the wrapper (see PIWrapper.start_supervision). It is sent
+        again after a link error only if none of its commands is in PIWrapper.non_retriable_commands.
+
+        Raises
+        ------
+        GCSError: naming the failing segment if the controller reports an error
+        """
+        segments, self.segments = self.segments, []
+        self._recorder.cmdstrs = []
+        if len(segments) == 0:
+            return
+        if self.sequential:
+            self._commit_sequentially(segments)
+            return
+        lines, count = [], 0
+        for segment in segments:
+            lines.extend(segment.cmdstrs)
+            count += len(segment.answers)
+            if self.check:
+                lines.append('ERR?')
+                count += 1
+        calls = [call for segment in segments for call in segment.calls]
+        self._wrapper.history.extend(calls)
+        retry = not any(command in self._wrapper.non_retriable_commands for command, _ in calls)
+        answers = iter(self._wrapper._call('transaction', lambda: _exchange(self._wrapper.device, '\n'.join(lines),
+                                                                            count), retry))
+        replies: Dict[str, List[str]] = {}
+        error = None
+        for segment in segments:
+            for cmdstr, _ in segment.answers:
+                replies.setdefault(cmdstr, []).append(next(answers))
+            if self.check:
+                reply = next(answers)
+                try:
+                    code = int(reply)
+                except ValueError:
+                    code = gcserror.E_1004_PI_UNEXPECTED_RESPONSE
+                if code != 0 and error is None:
+                    error = GCSError(code, f'raised by {segment.describe()} within the transaction')
+        if error is not None:
+            raise error
+
+        commands = copy.copy(self._wrapper.device.gcscommands)
+        commands._msgs = _AnswerReplay(replies, commands._msgs)
+        for segment in segments:
+            for _, answer in segment.answers:
+                answer._value = getattr(commands, answer.command)(*answer.args)
+                answer.done = True
+
+    def _commit_sequentially(self, segments: List[_Segment]):
+        """ Make the calls one by one on the device, the errors being checked after each segment if pipython doesn't
+        check them after each call"""
+        for segment in segments:
+            for index, (command, args) in enumerate(segment.calls):
+                value = self._wrapper._send(command, *args)
+                if index in segment.queries:
+                    segment.queries[index]._value = value
+                    segment.queries[index].done = True
+            if self.check and not self._wrapper.device.errcheck:
+                self._wrapper.check_errors()
+
+
 class PIWrapper:
     """
     Plugin using the pipython package wrapper. It is compatible with :
@@ -47,6 +654,18 @@ class PIWrapper:
     'PI_G_GCS2_DLL': ['UNKNOWN', ],
     """
 
+    history_length = 16
+    position_history_size = 10000
+    heartbeat_interval = 1.  # s, the link is checked when no command was sent for this duration
+    reconnect_backoff = (0.1, 5.)  # s, first and maximum delays between two reconnection attempts
+    reconnect_timeout = 30.  # s, maximum time a call waits for the link to come back
+    max_queued_calls = 10  # calls waiting for the link to come back, the following ones fail at once
+    non_retriable_commands = ('MVR', 'MAC_BEG', 'MAC_START')  # commands whose effect would be doubled if sent again
+    status_register = 1  # SRG? register read with the positions within deferred_errors(watch_status=True)
+    status_error_bit = 8  # bit of the error flag in this register (see the controller manual)
+    parameter_batch_size = 20  # parameters queried or set per SPA? or SPA command
+    macro_prefix = 'PMD'  # macro names are this prefix followed by a content hash, 8 characters at most
+
     def __init__(self):
 
         self._device: GCSDevice = None
@@ -58,6 +677,30 @@ class PIWrapper:
         self.daisy_ids: Tuple[int] = None
         self.daisy_id: int = 0
 
+        self.motion_profiles: Dict[str, List[MotionProfile]] = {}  # per axis, sorted by increasing max_distance
+        self._motion_profile: Dict[str, MotionProfile] = {}  # profile currently set on each axis
+        self._targets: Dict[str, float] = {}  # last target of each axis, to get the move distances without query
+        self.settle_detectors: Dict[str, SettleDetector] = {}
+
+        self.history = deque(maxlen=self.history_length)  # commands sent since the last error check
+        self._deferred_depth = 0
+        self._errcheck = True  # errcheck of the device before entering deferred_errors
+        self._status_watchers = 0  # deferred_errors blocks reading the status register with the positions
+
+        self._macros: set = None  # names of the macros stored on the controller
+
+        self.position_history = PositionHistory(self.position_history_size)
+
+        self._identification: str = None
+        self._referenced: Dict[str, bool] = {}  # axes known to be referenced, kept across reconnections
+        self._link_up = threading.Event()
+        self._link_up.set()
+        self._stop_supervision = threading.Event()
+        self._supervisor: threading.Thread = None
+        self._queued_calls: threading.BoundedSemaphore = None
+        self._last_activity = perf_counter()
+        self.reconnections = 0
+
     @property
     def device(self) -> GCSDevice:
         """ Get the instance of the GCSDevice"""
@@ -78,13 +721,15 @@ class PIWrapper:
             self._device_id = dev_id
 
     def identify(self) -> str:
-        """ Get the device string identifier """
-        return self.device.qIDN()
+        """ Get the device string identifier, queried once per instance """
+        if self._identification is None:
+            self._identification = self._send('qIDN')
+        return self._identification
 
     @property
     def axis_names(self) -> List[str]:
         """ Get the list of axis of the controller as a list of string"""
-        return self.device.axes
+        return self._call('axes', lambda: self.device.axes)
 
     def get_axis_units(self, default='mm'):
         units = default
@@ -92,7 +737,7 @@ class PIWrapper:
             # get units (experimental)
             if hasattr(self.device, 'qSPA'):
                 units = \
-                    self.device.qSPA(self.axis_names[0], 0x07000601)[self.axis_names[0]][0x07000601]
+                    self._send('qSPA', self.axis_names[0], 0x07000601)[self.axis_names[0]][0x07000601]
         except GCSError:
             # library not compatible with this set of commands
             logger.info('Could not get axis units from the controller make sure you set them '
@@ -135,14 +780,14 @@ class PIWrapper:
         """
         for ind, ax in enumerate(self.axis_names):
             if do_use:
-                res = self.device.JAX(1, ind + 1, ax)
-                res = self.device.JON(ind + 1, True)
+                res = self._send('JAX', 1, ind + 1, ax)
+                res = self._send('JON', ind + 1, True)
             else:
-                self.device.JON(ind + 1, False)
+                self._send('JON', ind + 1, False)
 
     def get_servo(self, axis: str):
         """ Check if servo on a given axis is on or not"""
-        return self.device.qSVO(axis)[axis]
+        return self._send('qSVO', axis)[axis]
 
     def set_servo(self, axis: str, enable_servo=True):
         """ Turns on or off the closed loop
@@ -155,7 +800,7 @@ class PIWrapper:
         """
         if axis in self.axis_names:
             if self.get_servo(axis) != enable_servo:
-                self.device.SVO(axis, enable_servo)
+                self._send('SVO', axis, enable_servo)
 
     def set_referencing(self, axes: Union[str, List[str]]):
         """ Attempt a referencing of the specified axis or list of axis
@@ -171,9 +816,9 @@ class PIWrapper:
             # set referencing mode
             if isinstance(axe, str):
                 if self.is_referenced(axe):
-                    if self.device.HasRON():
-                        self.device.RON(axe, True)
-                    self.device.FRF(axe)
+                    if self._has('RON'):
+                        self._send('RON', axe, True)
+                    self._send('FRF', axe)
 
     def get_axis_limits(self, axis_name: str):
         """
@@ -188,11 +833,11 @@ class PIWrapper:
         (float, float) the min and max values of the specified axis
         """
         if hasattr(self.device, 'qTMN'):
-            min_val = self.device.qTMN(axis_name)[axis_name]
+            min_val = self._send('qTMN', axis_name)[axis_name]
         else:
             min_val = np.NaN
         if hasattr(self.device, 'qTMX'):
-            max_val = self.device.qTMX(axis_name)[axis_name]
+            max_val = self._send('qTMX', axis_name)[axis_name]
         else:
             max_val = np.NaN
         return min_val, max_val
@@ -200,6 +845,10 @@ class PIWrapper:
     def close(self):
         """ close the current instance of GCSDevice instrument.
         """
+        self.stop_supervision()
+        self._close_connection()
+
+    def _close_connection(self):
         if self.device is not None:
             if not self.is_daisy:
                 self.device.CloseConnection()
@@ -215,7 +864,7 @@ class PIWrapper:
         """
 
         try:
-            self.close()
+            self._close_connection()
         except Exception as e:
             pass
         index = devices_name.index(self.device_id)
@@ -228,6 +877,7 @@ class PIWrapper:
 
     def connect_device(self):
         if self.connection_type is not None and self.device_id is not None:
+            self._macros = None
             if self.device is None:
                 self.ini_device()
             if not self.is_daisy:  # simple connection
@@ -266,33 +916,479 @@ class PIWrapper:
         -------
         bool
         """
-        if self.device.HasqFRF():
-            return self.device.qFRF(axis_name)[axis_name]
+        if self._referenced.get(axis_name, False):
+            return True
+        if self._has('qFRF'):
+            self._referenced[axis_name] = self._send('qFRF', axis_name)[axis_name]
+            return self._referenced[axis_name]
         else:
             return False
 
+    @property
+    def errors_deferred(self) -> bool:
+        """ True within a deferred_errors block"""
+        return self._deferred_depth > 0
+
+    def _send(self, command: str, *args):
+        """ Call a GCSDevice command, recording it in the history used to identify a failing command
+
+        If the connection is supervised (see start_supervision), the call waits for the link to come back when it is
+        lost, and is sent again after a link error unless its effect would be doubled (non_retriable_commands).
+        """
+        self.history.append((command, args))
+        return self._call(command, lambda: getattr(self.device, command)(*args))
+
+    def _call(self, name: str, function: Callable, retry: bool = None):
+        """ Call function, accessing the device, on the supervised link if any (see _send)
+
+        Parameters
+        ----------
+        name: str
+            the command, used in the error messages
+        function: Callable
+            called without argument, it should get the device from self.device that changes when reconnecting
+        retry: bool or None
+            if the call can be made again after a link error. If None, only if name is not in non_retriable_commands
+        """
+        if self._supervisor is None:
+            return function()
+        if retry is None:
+            retry = name not in self.non_retriable_commands
+        self._wait_link()
+        try:
+            answer = function()
+        except Exception as e:
+            if not self.is_link_error(e):
+                raise
+            self._link_up.clear()
+            if not retry:
+                raise IOError(f'Link to the controller lost during {name}, it may not have been executed') from e
+            self._wait_link()
+            answer = function()
+        self._last_activity = perf_counter()
+        return answer
+
+    def _has(self, command: str) -> bool:
+        """ Check if the controller knows a command, with the pipython Has methods that may query the command list
+        """
+        return self._call(f'Has{command}', lambda: getattr(self.device, f'Has{command}')())
+
+    @staticmethod
+    def is_link_error(error: Exception) -> bool:
+        """ Check if an exception comes from the link to the controller (negative GCS codes are interface errors)"""
+        if isinstance(error, GCSError):
+            return error.val < 0
+        return isinstance(error, (IOError, OSError))
+
+    @property
+    def link_up(self) -> bool:
+        return self._link_up.is_set()
+
+    def _wait_link(self):
+        if self._link_up.is_set():
+            return
+        if not self._queued_calls.acquire(blocking=False):
+            raise IOError('Link to the controller lost, too many calls are waiting for it')
+        try:
+            if not self._link_up.wait(self.reconnect_timeout):
+                raise IOError('Link to the controller lost')
+        finally:
+            self._queued_calls.release()
+
+    def heartbeat(self) -> bool:
+        """ Check the link with a single character query (#7), True if the controller answered"""
+        try:
+            self.device.IsControllerReady()
+        except Exception as e:
+            if self.is_link_error(e):
+                return False
+        self._last_activity = perf_counter()
+        return True
+
+    def reconnect(self) -> bool:
+        """ Open the connection again, keeping the identification, referencing and settings cached in the wrapper
+
+        Returns
+        -------
+        bool: True if the controller answers on the new connection
+        """
+        device = self.device
+        try:
+            self._close_connection()
+        except Exception:
+            pass
+        self.device = None
+        try:
+            self.connect_device()
+        except Exception as e:
+            logger.info(f'Reconnection failed: {str(e)}')
+            self.device = device  # closed, its calls raise link errors until the next attempt
+            return False
+        if self.errors_deferred:
+            self.device.errcheck = False
+        self._targets = {}  # the motions may have been stopped
+        self._motion_profile = {}  # the controller may have been restarted
+        self.reconnections += 1
+        return self.heartbeat()
+
+    def start_supervision(self):
+        """ Supervise the link: check it with a heartbeat when idle and reconnect with an exponential backoff
+
+        While the link is down, the calls wait for it to come back (max_queued_calls at most, for
+        reconnect_timeout at most) then resume transparently. All the accesses to the device go through _send or
+        _call for this, a call interrupted by a link error being made again unless it is in non_retriable_commands.
+        """
+        if self._supervisor is not None:
+            return
+        self._queued_calls = threading.BoundedSemaphore(self.max_queued_calls)
+        self._stop_supervision.clear()
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+    def stop_supervision(self):
+        if self._supervisor is None:
+            return
+        self._stop_supervision.set()
+        if self._supervisor is not threading.current_thread():
+            self._supervisor.join()
+        self._supervisor = None
+        self._link_up.set()  # the calls raise on link errors again
+
+    def _supervise(self):
+        delay = self.reconnect_backoff[0]
+        while not self._stop_supervision.is_set():
+            if self._link_up.is_set():
+                if perf_counter() - self._last_activity >= self.heartbeat_interval and not self.heartbeat():
+                    logger.info('Link to the controller lost')
+                    self._link_up.clear()
+                else:
+                    self._stop_supervision.wait(min(0.05, self.heartbeat_interval))
+            elif self.reconnect():
+                logger.info('Reconnected to the controller')
+                delay = self.reconnect_backoff[0]
+                self._link_up.set()
+            else:
+                self._stop_supervision.wait(delay)
+                delay = min(2 * delay, self.reconnect_backoff[1])
+
+    def check_errors(self):
+        """ Query the controller error register, raise a GCSError listing the commands sent since the last check
+
+        Raises
+        ------
+        GCSError: if the controller reports an error
+        """
+        code = self._call('qERR', lambda: self.device.qERR())
+        commands = ', '.join(f"{command}{args}" for command, args in self.history)
+        self.history.clear()
+        if code != 0:
+            raise GCSError(code, f'raised by one of the commands (last is the most recent): {commands}')
+
+    @contextmanager
+    def deferred_errors(self, check: bool = True, watch_status: bool = False):
+        """ Disable the error query pipython sends after each command, for sequences of commands such as a move and
+        the polling of its position, or the steps of a scan
+
+        The error register is queried once at the end of the block (if check is True), or as soon as a command
+        raises, so the GCSError gives the actual controller error and the recent commands. If watch_status is True,
+        the status register (SRG?) is read in the same transfer as each position reading of the block and the error
+        register is queried as soon as its error flag is set. Blocks can be nested, and closed in any order (as by
+        plugins sharing the wrapper): the status is watched while a block watching it is open, the last block to be
+        closed restores the per command check.
+
+        Parameters
+        ----------
+        check: bool
+            query the error register at the end of the block
+        watch_status: bool
+            check the error flag of the status register with the position readings (see status_error_bit)
+
+        Examples
+        --------
+        >>> with wrapper.deferred_errors(watch_status=True):
+        ...     for position in positions:
+        ...         wrapper.move_absolute('1', position)
+        ...         wrapper.get_axis_position('1')
+        """
+        if self._deferred_depth == 0:
+            self._errcheck = self.device.errcheck
+            self.device.errcheck = False
+            self.history.clear()
+        self._status_watchers += int(watch_status)
+        self._deferred_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.check_errors()  # gives the controller error behind a failing command or a malformed answer
+            raise
+        else:
+            if check:
+                self.check_errors()
+        finally:
+            self._deferred_depth -= 1
+            self._status_watchers -= int(watch_status)
+            if self._deferred_depth == 0:
+                self._status_watchers = 0
+                self.device.errcheck = self._errcheck
+
+    def _query_positions(self, axes: Union[str, List[str]]) -> Dict[str, float]:
+        """ Query the positions of axes, with their status register within a deferred_errors block watching it
+
+        Raises
+        ------
+        GCSError: if the error flag of the status register is set
+        """
+        if not (self.errors_deferred and self._status_watchers > 0):
+            return self._send('qPOS', axes)
+        names = axes if isinstance(axes, list) else [axes]
+        with self.transaction() as transaction:
+            positions = transaction.query('qPOS', axes)
+            status = transaction.query('qSRG', names, [self.status_register] * len(names))
+        if any(registers[self.status_register] >> self.status_error_bit & 1 for registers in status.value.values()):
+            self.check_errors()
+        return positions.value
+
+    @contextmanager
+    def transaction(self, check: bool = None):
+        """ Context manager collecting commands and queries into one transfer sent at the end of the block
+
+        Nothing is sent if an exception is raised within the block.
+
+        Parameters
+        ----------
+        check: bool or None
+            query the error register after each call within the transfer. If None, only outside of a deferred_errors
+            block, the errors being then checked by the block.
+
+        Examples
+        --------
+        >>> with wrapper.transaction() as transaction:
+        ...     transaction.WCL(1)
+        ...     transaction.WSL(1, 1)
+        ...     position = transaction.query('qPOS', '1')
+        >>> position.value
+        {'1': 0.0}
+
+        See Also
+        --------
+        Transaction
+        """
+        transaction = Transaction(self, not self.errors_deferred if check is None else check)
+        yield transaction
+        transaction.commit()
+
+    def build_macro(self, steps: List[MacroStep], trigger_pulse: int = 1) -> Tuple[str, str]:
+        """ Get the name and the content of the GCS macro doing the steps
+
+        Each step moves its axes (MOV), waits for them to be on target (WAC), waits for the dwell time (DEL) and
+        pulses its trigger line (DIO). The name is made from a hash of the content, so a macro with this name on the
+        controller is this very sequence.
+
+        Parameters
+        ----------
+        steps: list of MacroStep
+        trigger_pulse: int
+            duration of the trigger pulses in ms
+
+        Returns
+        -------
+        str: the macro name
+        str: the macro content, one command per line
+        """
+        transaction = Transaction(self)  # only used to format the commands, never sent
+        for step in steps:
+            transaction.MOV(step.targets)
+            for axis_name in step.targets:
+                transaction.send(f'WAC ONT? {axis_name} = 1')
+            if step.dwell:
+                transaction.DEL(step.dwell)
+            if step.trigger is not None:
+                transaction.DIO(step.trigger, True)
+                transaction.DEL(trigger_pulse)
+                transaction.DIO(step.trigger, False)
+        content = transaction.cmdstr
+        name = self.macro_prefix + hashlib.sha1(content.encode()).hexdigest()[:8 - len(self.macro_prefix)].upper()
+        return name, content
+
+    def get_macros(self, refresh=False) -> List[str]:
+        """ Get the names of the macros stored on the controller, queried only once unless refresh is True"""
+        if self._macros is None or refresh:
+            self._macros = set(name.strip() for name in self._send('qMAC').split('\n') if name.strip() != '')
+        return sorted(self._macros)
+
+    def upload_macro(self, steps: List[MacroStep], trigger_pulse: int = 1) -> str:
+        """ Store the macro doing the steps on the controller, if not already there, and get its name
+
+        See Also
+        --------
+        build_macro, start_macro
+        """
+        name, content = self.build_macro(steps, trigger_pulse)
+        if name not in self.get_macros():
+            with self.transaction() as transaction:
+                with transaction.segment():  # no error query within the macro definition
+                    transaction.MAC_BEG(name)
+                    transaction.send(content)
+                    transaction.MAC_END()
+            self._macros.add(name)
+        return name
+
+    def start_macro(self, name: str, *args):
+        """ Start a macro stored on the controller
+
+        Parameters
+        ----------
+        name: str
+        args: values of the macro arguments $1, $2...
+        """
+        self._targets = {}  # the axes are moved by the controller
+        self._send('MAC_START', name, ' '.join(str(arg) for arg in args))
+
+    def is_macro_running(self) -> bool:
+        """ Check if a macro is running on the controller, to monitor its progress"""
+        return self._send('IsRunningMacro')
+
     def stop(self):
         """ Stop the motion of the connected device"""
-        self.device.StopAll()
+        self._send('StopAll')
+        self._targets = {}  # the axes stopped before reaching their target
+        for detector in self.settle_detectors.values():
+            detector.target = None
 
     def get_axis_position(self, axis_name: str) -> float:
-        """ Get the specified axis position
+        """ Get the specified axis position, the reading feeds the settle detector and the position history
+
+        Parameters
+        ----------
+        axis_name: str
+        """
+        position = self._query_positions(axis_name)[axis_name]
+        self._store_position(axis_name, position)
+        return position
+
+    def get_axes_positions(self, axes_names: List[str]) -> Dict[str, float]:
+        """ Get the positions of several axes with a single query, stored as single readings (get_axis_position)"""
+        positions = self._query_positions(list(axes_names))
+        now, timestamp = perf_counter(), time()
+        for axis_name, position in positions.items():
+            self._store_position(axis_name, position, now, timestamp)
+        return positions
+
+    def _store_position(self, axis_name: str, position: float, now: float = None, timestamp: float = None):
+        """ Feed a reading to the settle detector of the axis if any and to the position history"""
+        on_target = -1
+        detector = self.settle_detectors.get(axis_name)
+        if detector is not None and detector.target is not None:
+            on_target = int(detector.add_samples(position, now))
+        self.position_history.append(axis_name, position, on_target, timestamp)
+
+    def set_settle_detection(self, axis_name: str, tolerance: float = None, window: int = 5):
+        """ Enable the settle detection of an axis (see SettleDetector)
 
         Parameters
         ----------
         axis_name: str
+        tolerance: float or None
+            in axis units, None disables the detection on this axis
+        window: int
+            number of consecutive readings within tolerance
         """
-        return self.device.qPOS(axis_name)[axis_name]
+        if tolerance is None:
+            self.settle_detectors.pop(axis_name, None)
+        else:
+            self.settle_detectors[axis_name] = SettleDetector(tolerance, window)
+
+    def add_settle_samples(self, axis_name: str, positions: Iterable[float], times: Iterable[float]) -> bool:
+        """ Feed a batch of positions, for instance read from the data recorder, to the settle detector of an axis
+
+        Returns
+        -------
+        bool: True if the axis is settled
+        """
+        return self.settle_detectors[axis_name].add_samples(positions, times)
+
+    def is_settled(self, axis_name: str) -> bool:
+        """ Check if the axis settled on the target of the last move
+
+        True if the axis has no settle detector or if the target is unknown (after a stop or a homing)
+        """
+        detector = self.settle_detectors.get(axis_name)
+        return detector is None or detector.target is None or detector.settled
+
+    def get_settle_time(self, axis_name: str) -> Optional[float]:
+        """ Get the settle time in seconds of the last move of an axis, None if not settled or not detected"""
+        if axis_name not in self.settle_detectors:
+            return None
+        return self.settle_detectors[axis_name].settle_time
+
+    def _start_settle(self, axis_name: str, target: float):
+        if axis_name in self.settle_detectors:
+            self.settle_detectors[axis_name].start(target)
+
+    def set_motion_profiles(self, axis_name: str, profiles: List[MotionProfile]):
+        """ Set the motion profiles of an axis, selected by the distance of each move (see move_absolute)
+
+        Parameters
+        ----------
+        axis_name: str
+        profiles: list of MotionProfile
+            an empty list disables the profiles of this axis
+        """
+        self.motion_profiles[axis_name] = sorted(profiles, key=lambda profile: profile.max_distance)
+        self._motion_profile.pop(axis_name, None)
+
+    def select_motion_profile(self, axis_name: str, distance: float) -> Optional[MotionProfile]:
+        """ Get the profile of the smallest max_distance covering the distance, None if there is not any"""
+        for profile in self.motion_profiles.get(axis_name, []):
+            if abs(distance) <= profile.max_distance:
+                return profile
+        return None
+
+    def apply_motion_profile(self, axis_name: str, profile: MotionProfile):
+        """ Write the VEL, ACC and DEC values of the profile, only if it is not the one already set on the axis"""
+        if profile is None or self._motion_profile.get(axis_name) is profile:
+            return
+        for command, value in profile.commands():
+            if self._has(command):
+                self._send(command, axis_name, value)
+        self._motion_profile[axis_name] = profile
+
+    def _apply_profile_for(self, axis_name: str, distance: float):
+        if len(self.motion_profiles.get(axis_name, [])) != 0:
+            self.apply_motion_profile(axis_name, self.select_motion_profile(axis_name, distance))
 
     def move_absolute(self, axis_name: str, position: float):
         """ Move the specified axis to the given absolute position
 
+        If motion profiles are set for this axis, the one corresponding to the move distance is applied first. The
+        distance is computed from the last target, the position being queried only for the first move.
+
         Parameters
         ----------
         axis_name: str
         position: float
         """
-        self.device.MOV(axis_name, position)
+        if len(self.motion_profiles.get(axis_name, [])) != 0:
+            start = self._targets.get(axis_name)
+            if start is None:
+                start = self.get_axis_position(axis_name)
+            self._apply_profile_for(axis_name, position - start)
+        self._send('MOV', axis_name, position)
+        self._targets[axis_name] = position
+        self._start_settle(axis_name, position)
+
+    def move_axes(self, targets: Dict[str, float]):
+        """ Move several axes at once, all of them starting simultaneously (one MOV command)
+
+        Parameters
+        ----------
+        targets: dict
+            {axis_name: position}
+        """
+        self._send('MOV', list(targets), list(targets.values()))
+        for axis_name, position in targets.items():
+            self._targets[axis_name] = position
+            self._start_settle(axis_name, position)
 
     def move_relative(self, axis_name: str, position: float):
         """ Move the specified axis to the given relative position
@@ -302,8 +1398,14 @@ class PIWrapper:
         axis_name: str
         position: float
         """
-        if self.device.HasMVR():
-            self.device.MVR(axis_name, position)
+        if self._has('MVR'):
+            if axis_name in self.settle_detectors and axis_name not in self._targets:
+                self._targets[axis_name] = self._query_positions(axis_name)[axis_name]
+            self._apply_profile_for(axis_name, position)
+            self._send('MVR', axis_name, position)
+            if axis_name in self._targets:
+                self._targets[axis_name] += position
+                self._start_settle(axis_name, self._targets[axis_name])
 
     def move_home(self, axis_name: str):
         """ Move the specified axis to it's home position
@@ -317,10 +1419,13 @@ class PIWrapper:
         set_referencing
         """
         self.set_referencing(axis_name)
-        if self.device.HasGOH():
-            self.device.GOH(axis_name)
-        elif self.device.HasFRF():
-            self.device.FRF(axis_name)
+        self._targets.pop(axis_name, None)
+        if axis_name in self.settle_detectors:
+            self.settle_detectors[axis_name].target = None  # the home position is not known
+        if self._has('GOH'):
+            self._send('GOH', axis_name)
+        elif self._has('FRF'):
+            self._send('FRF', axis_name)
         else:
             self.move_absolute(axis_name, 0)
 
@@ -341,31 +1446,116 @@ class PIWrapper:
         seg_length = npts + start_point + npts / 2
         wavelength = npts + npts / 2
         curve_center_point = npts
-        self.device.WCL(axis)
-        self.device.WAV_RAMP(axis, 0, seg_length, 'X', wavelength,
-                             speed_up_down, amplitude, offset, curve_center_point)
-        self.device.WSL(axis, axis)  # affect axis axis to wavetable 1
-        self.device.WTR(0, rate, 1)  # set the rate (multiple of servo cycles)
+        with self.transaction() as transaction:
+            transaction.WCL(axis)
+            transaction.WAV_RAMP(axis, 0, seg_length, 'X', wavelength,
+                                 speed_up_down, amplitude, offset, curve_center_point)
+            transaction.WSL(axis, axis)  # affect axis axis to wavetable 1
+            transaction.WTR(0, rate, 1)  # set the rate (multiple of servo cycles)
 
     def start_waveform(self, axis: int = 1, cycles: int = 1):
-        self.device.WGC(axis, cycles)  # set the number of cycles
-        self.device.WGO(axis, 1)
+        with self.transaction() as transaction:
+            transaction.WGC(axis, cycles)  # set the number of cycles
+            transaction.WGO(axis, 1)
 
     def stop_waveform(self, axis: int = 1):
-        self.device.WGO(axis, 0)
+        self._send('WGO', axis, 0)
+
+    def read_parameters(self, parameters: Dict[str, List[int]] = None) -> ParameterSnapshot:
+        """ Read controller parameters in bulk
+
+        Parameters
+        ----------
+        parameters: dict or None
+            {item: [parameter IDs]} to read, queried in batches of parameter_batch_size. If None all the parameters
+            of all the items are read with a single SPA? query.
+
+        Returns
+        -------
+        ParameterSnapshot
+        """
+        if parameters is None:
+            values = self._send('qSPA')
+        else:
+            pairs = [(str(item), param) for item, params in parameters.items() for param in params]
+            values = {}
+            for start in range(0, len(pairs), self.parameter_batch_size):
+                items, params = zip(*pairs[start:start + self.parameter_batch_size])
+                for item, item_values in self._send('qSPA', list(items), list(params)).items():
+                    values.setdefault(item, {}).update(item_values)
+        return ParameterSnapshot(values, self.identify().strip())
+
+    def write_parameters(self, values: Dict[str, Dict[int, Union[int, float, str]]]):
+        """ Set parameters in RAM with SPA commands of parameter_batch_size values, sent in a single transfer
+
+        Parameters
+        ----------
+        values: dict
+            {item: {parameter ID: value}}
+        """
+        triplets = [(str(item), param, value) for item, item_values in values.items()
+                    for param, value in item_values.items()]
+        if len(triplets) == 0:
+            return
+        with self.transaction() as transaction:
+            for start in range(0, len(triplets), self.parameter_batch_size):
+                items, params, batch_values = zip(*triplets[start:start + self.parameter_batch_size])
+                transaction.SPA(list(items), list(params), list(batch_values))
+
+    def restore_parameters(self, snapshot: Union[ParameterSnapshot, Dict[str, Dict[int, Union[int, float, str]]]]) \
+            -> Dict[str, Dict[int, Union[int, float, str]]]:
+        """ Set the parameters to the values of a snapshot, writing only the ones that differ
+
+        Returns
+        -------
+        dict: {item: {parameter ID: value}} of the values written
+        """
+        desired = snapshot.parameters if isinstance(snapshot, ParameterSnapshot) else snapshot
+        try:
+            current = self.read_parameters()
+        except GCSError:  # no bulk query on this controller
+            current = self.read_parameters({item: list(values) for item, values in desired.items()})
+        changes = current.diff(desired)
+        self.write_parameters(changes)
+        return changes
 
     def get_servo_cycle_duration(self) -> float:
         """get the servo cycle duration in seconds"""
-        return self.device.qSPA('1', 0x0E000200)['1'][0x0E000200]
+        return self._send('qSPA', '1', 0x0E000200)['1'][0x0E000200]
 
-    def set_trigger_waveform(self, points: List[int],  do: int = 1):
-        # clear previous triggers
-        self.device.TWC()
-        # set trigger on digital output line do on the wave generator output
-        self.device.CTO(do, 3, 4)
-        # set the trigger position on the wave points
-        self.device.TWS(do, points, [1 for _ in points])
+    def set_on_target_trigger(self, axis_name: str, line: int = 1, enable: bool = True):
+        """ Set a digital output to be asserted when an axis is on target, to trigger detectors by hardware
 
+        The output line follows the on-target state of the axis (CTO trigger mode 2), i.e. when the axis is within
+        the settling window of the controller around its target.
+
+        Parameters
+        ----------
+        axis_name: str
+        line: int
+            the digital output line
+        enable: bool
+            if False the trigger output of the line is disabled (TRO), or if the controller has no TRO command, its
+            trigger mode is reset to the default one (0, position distance) so that it doesn't follow the on-target
+            state anymore
+        """
+        has_tro = self._has('TRO')
+        with self.transaction() as transaction:
+            if enable:
+                transaction.CTO([line, line], [2, 3], [axis_name, 2])  # axis, trigger mode: on target
+            elif not has_tro:
+                transaction.CTO(line, 3, 0)  # trigger mode: position distance, the default one
+            if has_tro:
+                transaction.TRO(line, enable)
+
+    def set_trigger_waveform(self, points: List[int],  do: int = 1):
+        with self.transaction() as transaction:
+            # clear previous triggers
+            transaction.TWC()
+            # set trigger on digital output line do on the wave generator output
+            transaction.CTO(do, 3, 4)
+            # set the trigger position on the wave points
+            transaction.TWS(do, points, [1 for _ in points])
 
 if __name__ == '__main__':
 
@@ -4,7 +4,8 @@ Created the 31/08/2023
 
 @author: Sebastien Weber
 """
-from typing import Iterable
+from copy import deepcopy
+from typing import Iterable, Callable, List, Dict, Optional
 from pathlib import Path
 
 from pymodaq_utils.config import BaseConfig, USER
@@ -22,6 +23,36 @@ class Config(BaseConfig):
     config_name = f"config_{__package__.split('pymodaq_plugins_')[1]}"
 
 
+class LazyParams:
+    """ Descriptor building the params of a plugin class only when they are accessed
+
+    To be used for plugins whose parameters need a slow hardware discovery: the discovery is then done when the plugin
+    is selected and not when its module is imported. The params are built only once, at the first access, then
+    copied from the cache until refresh is called (for instance after a change of the connected hardware).
+
+    Parameters
+    ----------
+    builder: Callable
+        called with the plugin class as argument and returning the list of parameters
+    """
+
+    def __init__(self, builder: Callable[[type], List[dict]]):
+        self._builder = builder
+        self._params: Dict[type, List[dict]] = {}
+
+    def __get__(self, instance, owner) -> List[dict]:
+        if owner not in self._params:
+            self._params[owner] = self._builder(owner)
+        return deepcopy(self._params[owner])
+
+    def refresh(self, owner: Optional[type] = None):
+        """ Clear the cached params of the owner class (if None, of all classes), built again at the next access"""
+        if owner is None:
+            self._params.clear()
+        else:
+            self._params.pop(owner, None)
+
+
 def get_devices_and_dlls(possible_dll_names: Iterable[str]):
     """ Get the connected devices and their corresponding dlls from a list of
     potential dlls
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the E-870 wrapper against a fake controller recording the GCS commands
+"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('pipython')
+
+from pymodaq_plugins_physik_instrumente.hardware.e870_wrapper import E870Wrapper, E870Group, StepCalibration
+
+
+class FakeE870:
+    """ Emulates the GCS commands of an E-870 used by the wrapper, the steps are done instantly"""
+
+    def __init__(self):
+        self.commands = []
+        self.positions = {1: 0, 2: 0, 3: 0, 4: 0}
+        self.mod = None
+        self.steps_left = 0
+
+    def HasOSM(self):
+        return True
+
+    def MOD(self, items, modes, values):
+        self.commands.append(('MOD', values))
+        self.mod = values
+
+    def OSM(self, channels, values):
+        self.commands.append(('OSM', values))
+        self.positions[self.mod] += values
+
+    def qOSN(self, channels):
+        return {channels: self.steps_left}
+
+    def SSA(self, channels, values):
+        self.commands.append(('SSA', values))
+
+    def SPA(self, items, params, values):
+        self.commands.append(('SPA', values))
+
+    def StopAll(self):
+        self.commands.append(('STP', None))
+
+
+@pytest.fixture
+def e870():
+    fake = FakeE870()
+    return E870Wrapper(fake), fake
+
+
+def test_mod_only_on_axis_change(e870):
+    wrapper, fake = e870
+    wrapper.move_steps(1, 10)
+    wrapper.move_steps(1, -5)
+    wrapper.move_steps(2, 3)
+    wrapper.move_steps(2, 3)
+    assert [cmd for cmd in fake.commands if cmd[0] == 'MOD'] == [('MOD', 1), ('MOD', 2)]
+    assert wrapper.demux_switches == 2
+    assert fake.positions == {1: 5, 2: 6, 3: 0, 4: 0}
+
+
+def test_grouped_pending_moves(e870):
+    wrapper, fake = e870
+    wrapper.move_steps(3, 1)
+    for axis, steps in [(1, 10), (3, 2), (1, 5), (2, -4), (3, -2), (4, 0)]:
+        wrapper.queue_steps(axis, steps)
+    assert wrapper.run_pending() == [(1, 15), (2, -4)]  # axis 3 requests cancel each other
+    assert wrapper.pending == {}
+
+    wrapper.queue_steps(1, 1)
+    wrapper.queue_steps(2, 1)
+    assert wrapper.run_pending() == [(2, 1), (1, 1)]  # starts with the selected axis
+    assert wrapper.demux_switches == 4
+    assert fake.positions == {1: 16, 2: -3, 3: 1, 4: 0}
+
+
+def test_stop_clears_pending(e870):
+    wrapper, fake = e870
+    wrapper.queue_steps(1, 10)
+    wrapper.stop()
+    assert wrapper.run_pending() == []
+    assert fake.commands == [('STP', None)]
+
+
+def test_stop_aborts_running_moves(e870):
+    wrapper, fake = e870
+    osm = fake.OSM
+
+    def stopping_osm(channels, values):
+        osm(channels, values)
+        fake.steps_left = values
+        wrapper.stop()  # as from the plugin thread while run_pending is executed
+        fake.steps_left = 0
+    fake.OSM = stopping_osm
+    wrapper.queue_steps(1, 10)
+    wrapper.queue_steps(2, 10)
+    assert wrapper.run_pending() == [(1, 10)]
+    assert fake.commands == [('MOD', 1), ('OSM', 10), ('STP', None)]
+
+    fake.OSM = osm
+    assert wrapper.move_steps(2, 5)  # a new move is not aborted by the previous stop
+    assert fake.positions[2] == 5
+
+
+def test_wait_steps_done_timeout(e870):
+    wrapper, fake = e870
+    wrapper.wait_timeout = 0.05
+    fake.steps_left = 10
+    with pytest.raises(IOError):
+        wrapper.wait_steps_done()
+    wrapper.stop()
+    wrapper.wait_steps_done()  # returns at once once stopped
+
+
+def test_calibration():
+    calibration = StepCalibration(forward=0.02, backward=0.025, load_slope=-0.1, load=2.)
+    assert calibration.step_size(1) == pytest.approx(0.016)
+    assert calibration.steps_to_distance(-100) == pytest.approx(-2.)
+    assert calibration.distance_to_steps(1.6) == 100
+    assert calibration.distance_to_steps(-2.) == -100
+
+
+def test_estimated_position(e870):
+    wrapper, fake = e870
+    wrapper.load_calibrations({'1': dict(forward=0.02, backward=0.025), '5': dict(forward=1.)})
+    wrapper.move_steps(1, 100)
+    assert wrapper.get_estimated_position(1) == pytest.approx(2.)
+    fake.steps_left = 50  # the move is running
+    assert wrapper.get_estimated_position(1) == pytest.approx(1.)
+    wrapper.stop()
+    assert wrapper.get_estimated_position(1) == pytest.approx(1.)
+
+    fake.steps_left = 0
+    wrapper.set_estimated_position(1, 0.5)
+    steps = wrapper.estimated_steps_to(1, -0.5)
+    assert steps == -40
+    wrapper.move_steps(1, steps)
+    assert wrapper.get_estimated_position(1) == pytest.approx(-0.5)
+    assert wrapper.get_estimated_position(2) == 0.
+
+
+def test_profiles(e870):
+    wrapper, fake = e870
+    assert wrapper.split_steps(1000) == [(None, 1000)]
+    assert wrapper.estimate_duration(-1000) == pytest.approx(1.)
+
+    wrapper.load_profiles(dict(use_profiles=True, fine_steps=100, step_frequency_id=0x1234,
+                               coarse=dict(frequency=2000., amplitude=40.),
+                               fine=dict(frequency=100., amplitude=10., step_scale=0.5)))
+    assert wrapper.split_steps(1000) == [('coarse', 900), ('fine', 200)]
+    assert wrapper.split_steps(-50) == [('fine', -100)]
+    assert wrapper.estimate_duration(1000) == pytest.approx(900 / 2000 + 200 / 100)
+
+    wrapper.load_calibrations({'1': dict(forward=0.01, backward=0.01)})
+    wrapper.queue_steps(1, 1000)
+    wrapper.run_pending()
+    assert [cmd for cmd in fake.commands if cmd[0] in ('SSA', 'SPA', 'OSM')] == \
+           [('SSA', 40.), ('SPA', 2000.), ('OSM', 900), ('SSA', 10.), ('SPA', 100.), ('OSM', 200)]
+    assert wrapper.get_estimated_position(1) == pytest.approx(10.)
+
+    fake.commands.clear()
+    wrapper.queue_steps(1, -20)
+    wrapper.run_pending()
+    assert fake.commands == [('OSM', -40)]  # the fine profile is already set
+
+
+def test_profiles_without_frequency_id(e870, monkeypatch):
+    from pymodaq_plugins_physik_instrumente.hardware import e870_wrapper
+    wrapper, fake = e870
+    warnings = []
+    monkeypatch.setattr(e870_wrapper.logger, 'warning', warnings.append)
+    wrapper.load_profiles(dict(use_profiles=True, fine_steps=10, coarse=dict(frequency=2000., amplitude=40.)))
+    assert len(warnings) == 1
+    wrapper.move_steps(1, 100, profile='coarse')
+    assert [cmd for cmd in fake.commands if cmd[0] in ('SSA', 'SPA')] == [('SSA', 40.)]  # the frequency is not sent
+
+    wrapper.load_profiles(dict(use_profiles=False))
+    assert len(warnings) == 1
+
+
+def test_stop_aborts_fine_segment(e870):
+    wrapper, fake = e870
+    wrapper.load_profiles(dict(use_profiles=True, fine_steps=10, coarse=dict(amplitude=40.),
+                               fine=dict(amplitude=10.)))
+    osm = fake.OSM
+
+    def stopping_osm(channels, values):
+        osm(channels, values)
+        wrapper.stop()
+    fake.OSM = stopping_osm
+    wrapper.queue_steps(1, 100)
+    assert wrapper.run_pending() == []  # the move was not completed
+    assert fake.commands == [('MOD', 1), ('SSA', 40.), ('OSM', 90), ('STP', None)]
+
+
+def test_group_concurrent_moves():
+    fakes = [FakeE870(), FakeE870()]
+    group = E870Group([E870Wrapper(fake) for fake in fakes])
+    group.device_ids = ['A', 'B']
+    assert group.axis_names == {f'{device} axis {axis}': 10 * (index + 1) + axis
+                                for index, device in enumerate('AB') for axis in range(1, 5)}
+    threads = []
+
+    def slow_osm(fake):
+        def osm(channels, values):
+            threads.append(threading.current_thread())
+            time.sleep(0.2)
+            fake.positions[fake.mod] += values
+        return osm
+
+    for fake in fakes:
+        fake.OSM = slow_osm(fake)
+    group.queue_steps(12, 10)
+    group.queue_steps(23, -5)
+    start = time.perf_counter()
+    assert group.run_pending() == {0: [(2, 10)], 1: [(3, -5)]}
+    assert time.perf_counter() - start < 0.35  # both controllers stepped at the same time
+    assert len(set(threads)) == 2
+    assert fakes[0].positions[2] == 10 and fakes[1].positions[3] == -5
+    assert group.get_estimated_position(23) == -5
+
+
+@pytest.fixture
+def e870_plugin():
+    pytest.importorskip('pymodaq')
+    from pymodaq_plugins_physik_instrumente.daq_move_plugins.daq_move_PI_E870 import DAQ_Move_PI_E870
+    fake = FakeE870()
+    group = E870Group([E870Wrapper(fake)])
+    group.device_ids = ['A']
+    plugin = DAQ_Move_PI_E870(None, None)
+    plugin.controller = group
+    plugin.axis_names = group.axis_names
+    plugin.axis_units = ''
+    yield plugin, fake
+    plugin.controller.stop()
+
+
+def wait_position(fake, axis, position, timeout=2.):
+    start = time.perf_counter()
+    while fake.positions[axis] != position and time.perf_counter() - start < timeout:
+        time.sleep(0.01)
+    return fake.positions[axis]
+
+
+def test_plugin_moves(e870_plugin):
+    from pymodaq.utils.data import DataActuator
+    plugin, fake = e870_plugin
+    plugin.move_rel(DataActuator(data=10.))
+    assert wait_position(fake, 1, 10) == 10
+    assert plugin.get_actuator_value() == pytest.approx(10.)
+    plugin.move_abs(DataActuator(data=3.))
+    assert wait_position(fake, 1, 3) == 3
+    assert plugin.get_actuator_value() == pytest.approx(3.)
+
+
+def test_plugin_units(monkeypatch):
+    pytest.importorskip('pymodaq')
+    from pymodaq_plugins_physik_instrumente.daq_move_plugins import daq_move_PI_E870
+    monkeypatch.setattr(daq_move_PI_E870, 'config', lambda *keys: 'step')
+    assert daq_move_PI_E870.controller_units() == ''  # not a pint unit, raw steps
+    monkeypatch.setattr(daq_move_PI_E870, 'config', lambda *keys: 'um')
+    assert daq_move_PI_E870.controller_units() == 'um'
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the hexapod pose validation against a fake controller with a spherical workspace
+"""
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pipython')
+
+from pipython.pidevice.gcs2.gcs2commands import GCS2Commands
+
+from pymodaq_plugins_physik_instrumente.hardware.pi_wrapper import PIWrapper
+from pymodaq_plugins_physik_instrumente.hardware.hexapod import HexapodPoses
+
+AXES = ['X', 'Y', 'Z', 'U', 'V', 'W']
+
+
+class FakeHexapod:
+    """ Emulates the GCS messages of a hexapod whose reachable poses are within a sphere and the travel range of
+    each axis, recording each transfer"""
+    errcheck = True
+    embederr = False
+    timeout = 1000
+
+    def __init__(self, radius=10.):
+        self.radius = radius
+        self.transfers = []
+        self.vmo_queries = 0
+        self.errors_queries = 0
+        self.moves = []
+        self.interface = FakeInterface(self)
+        self._lock = threading.RLock()
+
+    def execute(self, line):
+        words = line.split()
+        if words[0] == 'VMO?':
+            assert words[1::2] == AXES
+            self.vmo_queries += 1
+            return '1\n' if np.linalg.norm([float(value) for value in words[2::2]]) <= self.radius else '0\n'
+        if words[0] == 'ERR?':
+            self.errors_queries += 1
+            return '0\n'
+        if words[0] in ('TMN?', 'TMX?'):
+            return f'{words[1]}={-8 if words[0] == "TMN?" else 8}\n'
+        if words[0] == 'MOV':
+            self.moves.append({axis: float(value) for axis, value in zip(words[1::2], words[2::2])})
+            return ''
+        raise ValueError(f'Unexpected command {line}')
+
+    def send(self, tosend):
+        self.transfers.append(tosend)
+        for line in tosend.splitlines():
+            self.execute(line)
+
+    def read(self, tosend, gcsdata=0):
+        self.transfers.append(tosend)
+        return self.execute(tosend.rstrip('\n'))
+
+
+class FakeInterface:
+    """ Raw link of FakeHexapod, the answers of all the lines of a transfer are read together"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.received = ''
+
+    def send(self, tosend):
+        tosend = tosend.rstrip('\n')
+        self.messages.transfers.append(tosend)
+        self.received += ''.join(self.messages.execute(line) for line in tosend.split('\n'))
+
+    def read(self):
+        received, self.received = self.received, ''
+        return received
+
+
+@pytest.fixture
+def hexapod():
+    fake = FakeHexapod()
+    wrapper = PIWrapper()
+    wrapper.device = GCS2Commands(fake)
+    return HexapodPoses(wrapper, AXES, resolution=1e-3, batch_size=4), fake
+
+
+def test_validate(hexapod):
+    poses_helper, fake = hexapod
+    poses = np.zeros((100, 6))
+    poses[:, 0] = np.repeat(np.linspace(-9, 9, 10), 10)  # each pose repeated 10 times
+    poses[:, 1] = 6.
+    mask = poses_helper.validate(poses)
+    assert np.array_equal(mask, (np.linalg.norm(poses, axis=1) <= 10.) & (np.abs(poses[:, 0]) <= 8.))
+    assert fake.vmo_queries == 8  # the two poses out of the X travel range are not queried, nor the repetitions
+    vmo_transfers = [transfer for transfer in fake.transfers if transfer.startswith('VMO?')]
+    assert [transfer.count('\n') for transfer in vmo_transfers] == [4, 4]  # one transfer of 4 queries per batch
+    assert all(transfer.endswith('\nERR?') for transfer in vmo_transfers)
+    assert fake.errors_queries == 2  # one error check per batch
+
+    assert np.array_equal(poses_helper.validate(poses[::-1]), mask[::-1])
+    assert fake.vmo_queries == 8  # known poses
+
+    assert poses_helper.validate([-7, 6, 0, 0, 0, 0.0002])  # rounded to an already known pose
+    assert not poses_helper.validate([9, 0, 0, 0, 0, 0])
+    assert fake.vmo_queries == 8
+    with pytest.raises(ValueError):
+        poses_helper.validate(np.zeros((2, 3)))
+
+
+def test_move(hexapod):
+    poses_helper, fake = hexapod
+    poses_helper.move([1, 2, 3, 0, 0, 0])
+    assert fake.moves == [dict(X=1, Y=2, Z=3, U=0, V=0, W=0)]
+    with pytest.raises(ValueError):
+        poses_helper.move([7, 7, 7, 0, 0, 0])
+    assert len(fake.moves) == 1
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the sharing of the 32 bits MMC servers between the 64 bits clients, without starting any server process
+"""
+import time
+
+import pytest
+
+loadlib = pytest.importorskip('msl.loadlib')
+
+from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper_client64 import MMCServer32, MMCWrapperClient64
+
+
+class FakeClient64:
+    """ Replaces the methods of Client64 used by MMCServer32, recording the requests"""
+    started = 0
+
+    def __init__(self, module32=None, append_sys_path=None):
+        FakeClient64.started += 1
+        self.requests = []
+        self.dead = False
+        self.stopped = False
+
+    def request32(self, name, *args, **kwargs):
+        if self.dead:
+            raise ConnectionError('The 32 bits server does not answer')
+        self.requests.append(name)
+        return 0
+
+    def shutdown_server32(self):
+        self.stopped = True
+
+
+class Client(MMCWrapperClient64):
+    aliases = ['COM3', 'COM4']  # instead of the VISA discovery
+    ports = [3, 4]
+
+
+@pytest.fixture(autouse=True)
+def fake_servers(monkeypatch):
+    for name in ('__init__', 'request32', 'shutdown_server32'):
+        monkeypatch.setattr(loadlib.Client64, name, getattr(FakeClient64, name))
+    monkeypatch.setattr(MMCServer32, '_servers', {})
+    monkeypatch.setattr(MMCServer32, 'idle_timeout', 0.1)
+    FakeClient64.started = 0
+    yield
+    MMCServer32.shutdown_all()
+
+
+def test_one_server_per_port():
+    clients = [Client(com_port='COM3'), Client(com_port='COM3'), Client(com_port='COM4')]
+    assert clients[0]._server is clients[1]._server
+    assert clients[2]._server is not clients[0]._server
+    assert FakeClient64.started == 2
+    assert clients[0]._server.clients == 2
+    for client in clients:
+        client.close()
+
+
+def test_refcount_and_port_users():
+    first, second = Client(com_port='COM3'), Client(com_port='COM3')
+    server = first._server
+    first.open()
+    second.open()
+    assert server.requests.count('MMC_COM_open') == 1  # the COM port is opened once for both clients
+    first.close()
+    assert server.clients == 1 and server.port_users == 1
+    assert 'MMC_COM_close' not in server.requests
+    first.close()  # already released
+    assert server.clients == 1
+    second.close()
+    assert server.clients == 0 and server.port_users == 0
+    assert server.requests.count('MMC_COM_close') == 1
+    with pytest.raises(IOError):
+        second.getPos()
+
+
+def test_idle_shutdown():
+    client = Client(com_port='COM3')
+    server = client._server
+    client.close()
+    assert MMCServer32._servers['COM3'] is server  # kept alive for a while
+    time.sleep(3 * MMCServer32.idle_timeout)
+    assert server.stopped
+    assert 'COM3' not in MMCServer32._servers
+
+
+def test_idle_shutdown_cancelled():
+    client = Client(com_port='COM3')
+    server = client._server
+    client.close()
+    client = Client(com_port='COM3')  # re-acquired before the idle timeout
+    assert client._server is server
+    time.sleep(3 * MMCServer32.idle_timeout)
+    assert not server.stopped
+    assert MMCServer32._servers['COM3'] is server
+    client.close()
+
+
+def test_dead_server_replaced():
+    client = Client(com_port='COM3')
+    server = client._server
+    server.dead = True
+    other = Client(com_port='COM3')
+    assert other._server is not server
+    assert server.stopped
+    assert MMCServer32._servers['COM3'] is other._server
+    assert FakeClient64.started == 2
+    other.close()
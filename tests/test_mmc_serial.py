@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the pure python Mercury driver against a pty based fake controller network
+"""
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith('win'), reason='pty are not available on windows')
+
+from pymodaq_plugins_physik_instrumente.hardware.PI.base import MMCBase
+from pymodaq_plugins_physik_instrumente.hardware.PI.mmc_serial import MMCSerial, ADDRESS_CODES
+
+
+class FakeMercury:
+    """ Emulates Mercury controllers connected in a network on the master side of a pty"""
+
+    def __init__(self, addresses=(1, 2)):
+        self.positions = {address: 0 for address in addresses}
+        self.targets = {address: 0 for address in addresses}
+        self.commands = []
+        self.selections = []
+        self.selected = None
+        self.moving = False
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self._running = True
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def reply(self, report: str):
+        if self.selected in self.positions:
+            os.write(self.master, report.encode() + b'\r\n\x03')
+
+    def execute(self, cmd: str):
+        self.commands.append((self.selected, cmd))
+        if self.selected not in self.positions:
+            return
+        if cmd.startswith('MA'):
+            self.targets[self.selected] = int(cmd[2:])
+            self.positions[self.selected] = int(cmd[2:])
+        elif cmd.startswith('MR'):
+            self.targets[self.selected] += int(cmd[2:])
+            self.positions[self.selected] = self.targets[self.selected]
+        elif cmd == 'TP':
+            self.reply(f'P:{self.positions[self.selected]:+011d}')
+        elif cmd == 'TT':
+            self.reply(f'T:{self.targets[self.selected]:+011d}')
+        elif cmd == 'TE':
+            self.reply(f'E:{self.targets[self.selected] - self.positions[self.selected]:+011d}')
+        elif cmd == 'TB':
+            self.reply(f'B:{self.selected - 1}')
+
+    def run(self):
+        buffer = b''
+        while self._running:
+            try:
+                data = os.read(self.master, 1)
+            except OSError:
+                break
+            if data == b'\x01':
+                self.selected = ADDRESS_CODES.index(os.read(self.master, 1).decode()) + 1
+                self.selections.append(self.selected)
+            elif data == b'\\' and buffer == b'':
+                self.reply('1' if self.moving else '0')
+            elif data == b'\r':
+                self.execute(buffer.decode())
+                buffer = b''
+            else:
+                buffer += data
+
+    def close(self):
+        self._running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+
+@pytest.fixture
+def mercury():
+    fake = FakeMercury()
+    mmc = MMCSerial(com_port=fake.port)
+    mmc.open()
+    yield mmc, fake
+    mmc.close()
+    fake.close()
+
+
+def test_com_ports_without_visa(monkeypatch):
+    from types import SimpleNamespace
+    from pymodaq_plugins_physik_instrumente.hardware.PI import base, mmc_serial
+
+    def no_visa(refresh=False):
+        raise AssertionError('VISA should not be used by the serial driver')
+    monkeypatch.setattr(base, 'get_com_ports', no_visa)
+    monkeypatch.setattr(MMCSerial, '_com_ports', None)
+    monkeypatch.setattr(mmc_serial.list_ports, 'comports', lambda: [SimpleNamespace(device='/dev/ttyUSB7')])
+    assert MMCSerial.list_com_ports() == ['/dev/ttyUSB7']
+    monkeypatch.setattr(mmc_serial.list_ports, 'comports', lambda: [SimpleNamespace(device='/dev/ttyUSB8')])
+    assert MMCSerial.list_com_ports() == ['/dev/ttyUSB7']  # memoized
+    assert MMCSerial.list_com_ports(refresh=True) == ['/dev/ttyUSB8']
+    monkeypatch.setattr(mmc_serial.list_ports, 'comports', lambda: [SimpleNamespace(device='/dev/ttyUSB7')])
+    fake = FakeMercury()
+    try:
+        assert MMCSerial(com_port=fake.port).is_valid_com_port('/dev/ttyUSB7')
+        with pytest.raises(IOError):
+            MMCSerial(com_port='/dev/not_a_port')
+    finally:
+        fake.close()
+
+
+def test_init_network(mercury):
+    mmc, fake = mercury
+    assert mmc.MMC_initNetwork(3) == [1, 2]
+    with pytest.raises(IOError):
+        mmc.MMC_select(3)
+
+
+def test_move_and_get_pos(mercury):
+    mmc, fake = mercury
+    mmc.MMC_initNetwork(2)
+    mmc.MMC_select(2)
+    mmc.moveAbs(0, 1.)
+    assert mmc.MMC_getPos() == mmc.units_to_counts(1.)
+    assert mmc.getPos() == pytest.approx(1., abs=1e-4)
+    assert fake.positions[1] == 0
+
+    mmc.moveRel(1, 0.5)
+    assert mmc.axis == 1
+    assert mmc.MMC_getVal(2) == mmc.units_to_counts(0.5)
+
+
+def test_selection_cache(mercury):
+    mmc, fake = mercury
+    mmc.MMC_initNetwork(2)
+    fake.selections.clear()
+    mmc.MMC_select(1)
+    mmc.moveAbs(1, 1.)
+    mmc.moveRel(1, 1.)
+    mmc.getPos(1)
+    mmc.moveAbs(2, 1.)
+    mmc.getPos(2)
+    mmc.getPos()  # round trip making sure the fake controller processed all commands
+    assert fake.selections == [2]  # the network scan ends on device 1
+    assert fake.positions == {1: 2 * mmc.units_to_counts(1.), 2: mmc.units_to_counts(1.)}
+
+
+def test_moving(mercury):
+    mmc, fake = mercury
+    mmc.MMC_setDevice(1)
+    assert not mmc.MDC_moving()
+    assert not mmc.moving()
+    mmc.MDC_waitStop()
+
+
+def test_wait_stop_break(mercury):
+    mmc, fake = mercury
+    mmc.MMC_setDevice(1)
+    fake.moving = True
+    assert mmc.moving()
+    errors = []
+
+    def wait():
+        try:
+            mmc.wait_stop()
+        except IOError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    mmc.MMC_globalBreak()
+    thread.join(5.)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+
+def test_global_break_aborts_all(mercury):
+    mmc, fake = mercury
+    assert mmc.MMC_initNetwork(3) == [1, 2]
+    mmc.MMC_setDevice(2)
+    fake.commands.clear()
+    mmc.MMC_globalBreak()
+    time.sleep(0.1)
+    assert fake.commands == [(1, 'AB'), (2, 'AB')]
+    assert mmc.axis == 2 and fake.selected == 2  # selection restored
+
+
+def test_batch_and_status(mercury):
+    mmc, fake = mercury
+    mmc.MMC_setDevice(1)
+    mmc.moveAbs(0, 2.)
+    pos, target = mmc.MMC_batch([('MMC_getPos', ()), ('MMC_getVal', (2,))])
+    assert pos == target == mmc.units_to_counts(2.)
+
+    status = mmc.get_status()
+    assert status['position'] == pytest.approx(2., abs=1e-4)
+    assert status['target'] == pytest.approx(2., abs=1e-4)
+    assert status['distance'] == 0.
+    assert not status['moving']
+
+    with pytest.raises(ValueError):
+        mmc.MMC_batch([('close', ())])
+
+
+def test_home(mercury):
+    mmc, fake = mercury
+    mmc.MMC_setDevice(1)
+    fake.moving = True
+    positions = []
+
+    def progress(pos):
+        positions.append(pos)
+        if len(positions) == 3:
+            fake.moving = False
+
+    mmc.home(progress, min_interval=0.01)
+    assert len(positions) == 3
+    mmc.MMC_getPos()  # round trip making sure the fake controller processed all commands
+    assert [cmd for address, cmd in fake.commands if cmd in ('FE1', 'DH')] == ['FE1', 'DH']
+
+
+def test_discover_network(mercury):
+    mmc, fake = mercury
+    MMCSerial.network_cache.clear()
+    assert mmc.discover_network(maxAxis=3) == [1, 2]
+    assert MMCSerial.network_cache[fake.port] == 0b11
+
+    fake.commands.clear()
+    assert mmc.discover_network(maxAxis=3) == [1, 2]
+    assert 'TB' not in [cmd for address, cmd in fake.commands]
+
+    assert mmc.discover_network(bitmap=0b100, maxAxis=3) == [1, 2]
+    assert 'TB' in [cmd for address, cmd in fake.commands]
+
+
+def test_stages_and_conversions(mercury, monkeypatch):
+    mmc, fake = mercury
+    monkeypatch.setattr(MMCBase, 'stages', dict(MMCBase.stages))  # the catalogue is restored after the test
+    MMCSerial.load_stages({'test_stage': dict(cts_units_num=1000, cts_units_denom=3, units='µm', motor='step')})
+    mmc.stage = 'test_stage'
+    assert mmc.is_step_motor
+    assert mmc.units_to_counts(1.) == 333
+    assert isinstance(mmc.units_to_counts(1.), int)
+    assert mmc.counts_to_units(1000) == pytest.approx(3.)
+    assert isinstance(mmc.counts_to_units(1000), float)
+
+    units = np.linspace(-1, 1, 11)
+    counts = mmc.units_to_counts(units)
+    assert counts.dtype == np.int64
+    assert np.all(counts == -mmc.units_to_counts(-units))
+    assert np.allclose(mmc.counts_to_units(counts), units, atol=1 / 333)
+
+    with pytest.raises(ValueError):
+        mmc.stage = 'unknown_stage'
+    mmc.stage = 'M521DG'
+
+
+def test_round_robin_positions(mercury):
+    mmc, fake = mercury
+    assert mmc.discover_network(maxAxis=3, rescan=True) == mmc.devices == [1, 2]
+    mmc.moveAbs(2, 1.)
+    mmc.select(1)
+    fake.positions[1] = mmc.units_to_counts(0.5)
+    positions = mmc.get_positions()
+    assert positions[1] == pytest.approx(0.5, abs=1e-4)
+    assert positions[2] == pytest.approx(1., abs=1e-4)
+    assert mmc.getPos() == pytest.approx(0.5, abs=1e-4)  # device 1 selected back
+
+    fake.commands.clear()
+    assert mmc.get_position(2, max_age=10.) == pytest.approx(1., abs=1e-4)
+    assert fake.commands == []
+    assert mmc.get_position(1, max_age=0.) == pytest.approx(0.5, abs=1e-4)
+    assert [address for address, cmd in fake.commands if cmd == 'TP'] == [1, 2]
+
+
+def test_wait_stop_timeout(mercury):
+    mmc, fake = mercury
+    mmc.MMC_setDevice(1)
+    fake.moving = True
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        mmc.wait_stop(timeout=0.1)
+    assert time.perf_counter() - start < 1.
+    with pytest.raises(TimeoutError):
+        mmc.home(min_interval=0.01, timeout=0.1)
+    mmc.MMC_getPos()  # round trip, the fake has executed the abort
+    assert [cmd for device, cmd in fake.commands if cmd in ('FE1', 'AB', 'DH')] == ['FE1', 'AB']  # not defined as home
+    fake.moving = False
+    mmc.wait_stop(timeout=0.1)
+
+
+def test_stop_device(mercury):
+    mmc, fake = mercury
+    mmc.discover_network(maxAxis=3, rescan=True)
+    mmc.moveRel(2, 1.)
+    fake.moving = True
+    assert mmc.moving(2)
+    errors = []
+
+    def wait():
+        try:
+            mmc.wait_stop(2)
+        except IOError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    mmc.stop(1)  # another device, the waiting loop goes on
+    thread.join(0.2)
+    assert thread.is_alive()
+    mmc.stop(2)
+    thread.join(5.)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    mmc.getPos(2)  # round trip making sure the fake controller processed all commands
+    assert (2, 'AB') in fake.commands
+
+
+def test_plugin_moves(mercury):
+    pytest.importorskip('pymodaq')
+    from pymodaq.utils.data import DataActuator
+    from pymodaq_plugins_physik_instrumente.daq_move_plugins.daq_move_PI_MMC import DAQ_Move_PI_MMC
+    mmc, fake = mercury
+    mmc.discover_network(maxAxis=3, rescan=True)
+    plugin = DAQ_Move_PI_MMC(None, None)
+    plugin.controller = mmc
+    plugin.set_axis_names(mmc.devices)
+    plugin.axis_name = 'Mercury 2'
+    plugin.settings.child('position_max_age').setValue(0)
+
+    plugin.move_abs(DataActuator(data=1.))
+    mmc.MMC_getPos()
+    assert fake.targets[2] == mmc.units_to_counts(1.)
+    assert plugin.get_actuator_value() == pytest.approx(1., abs=1e-3)
+    plugin.move_rel(DataActuator(data=-0.5))
+    mmc.MMC_getPos()  # round trip, the fake has executed the move
+    assert fake.targets[2] == mmc.units_to_counts(1.) + mmc.units_to_counts(-0.5)
+    assert fake.targets[1] == 0
+
+
+def test_plugin_home_timeout(mercury, monkeypatch):
+    pytest.importorskip('pymodaq')
+    from pymodaq_plugins_physik_instrumente.daq_move_plugins.daq_move_PI_MMC import DAQ_Move_PI_MMC
+    mmc, fake = mercury
+    mmc.discover_network(maxAxis=3, rescan=True)
+    plugin = DAQ_Move_PI_MMC(None, None)
+    plugin.controller = mmc
+    plugin.set_axis_names(mmc.devices)
+    plugin.axis_name = 'Mercury 2'
+    plugin.settings.child('timeout').setValue(100)  # the move timeout does not apply to the homing
+    plugin.settings.child('home_timeout').setValue(0.1)
+    status = []
+    monkeypatch.setattr(plugin, 'emit_status', status.append)
+    fake.moving = True
+    start = time.perf_counter()
+    plugin._home()
+    assert time.perf_counter() - start < 2.
+    assert status[-1].command == 'raise_timeout'  # after the progress updates
+    mmc.MMC_getPos()
+    assert (2, 'AB') in fake.commands and (2, 'DH') not in fake.commands
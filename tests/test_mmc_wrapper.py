@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the MMC dll wrapper against a fake dll recording the calls and the threads making them
+"""
+import ctypes
+import importlib
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+MODULE = 'pymodaq_plugins_physik_instrumente.hardware.PI.mmc_wrapper'
+
+
+class FakeFunction:
+    """ Emulates a function of the dll, returning the result of a handler"""
+
+    def __init__(self, lib, name, handler):
+        self.lib = lib
+        self.name = name
+        self.handler = handler
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        self.lib.calls.append((self.name, args, threading.current_thread().name))
+        return self.handler(*args)
+
+
+class FakeLib:
+    """ Emulates MMC.dll for the devices of a network, the ones found by MMC_initNetwork being registered"""
+
+    def __init__(self, prototypes: dict, devices=(1, 2)):
+        self.devices = devices
+        self.registered = set()
+        self.calls = []
+        self.active = 0  # number of calls being executed at the same time
+        self.overlaps = 0
+        self.reports = []  # answers written in the buffer given to MMC_getStringCR
+        handlers = dict(MMC_initNetwork=self.init_network, MMC_select=self.select, MMC_getPos=self.slow_call,
+                        MMC_getStringCR=self.get_string)
+        for name in prototypes:
+            setattr(self, name, FakeFunction(self, name, handlers.get(name, lambda *args: 0)))
+
+    def init_network(self, max_axis):
+        self.registered = {device for device in self.devices if device <= max_axis}
+        return sum(1 << (device - 1) for device in self.registered)
+
+    def select(self, axis):
+        return 0 if axis in self.registered else 2
+
+    def get_string(self, buffer):
+        buffer.value = self.reports.pop(0).encode()
+        return 1
+
+    def slow_call(self):
+        self.active += 1
+        self.overlaps += self.active > 1
+        time.sleep(0.01)
+        self.active -= 1
+        return 0
+
+    def names(self):
+        return [name for name, args, thread in self.calls]
+
+
+@pytest.fixture
+def mmc_module(monkeypatch):
+    libs = []
+    monkeypatch.setattr(ctypes, 'windll', SimpleNamespace(LoadLibrary=lambda path: libs[0]), raising=False)
+    sys.modules.pop(MODULE, None)
+    module = importlib.import_module(MODULE)
+    lib = FakeLib(module.PROTOTYPES)
+    libs.append(lib)
+    monkeypatch.setattr(module, 'server32', False)
+    monkeypatch.setattr(module, 'Server32', object)
+    yield module, lib
+    sys.modules.pop(MODULE, None)
+
+
+@pytest.fixture
+def mmc(mmc_module):
+    module, lib = mmc_module
+
+    class Wrapper(module.MMC_Wrapper):
+        lib = None  # shadows the property of the msl-loadlib Server32 base
+        aliases = ['COM3']  # instead of the VISA discovery
+        ports = [3]
+
+    wrapper = Wrapper(com_port='COM3')
+    wrapper.open()
+    yield wrapper, lib
+    wrapper.close()
+
+
+def test_select_cache(mmc):
+    wrapper, lib = mmc
+    assert wrapper.MMC_initNetwork(2) == [1, 2]
+    wrapper.MMC_select(1)
+    wrapper.MMC_select(1)  # already selected
+    wrapper.MMC_moveA(1, 10)  # sent to the selected device without address selection
+    assert lib.names().count('MMC_select') == 1
+    assert lib.calls[-1][:2] == ('MMC_moveA', (0, 10))
+
+    wrapper.MMC_setDevice(3)
+    wrapper.MMC_setDevice(3)
+    assert lib.names().count('MMC_setDevice') == 1
+    with pytest.raises(IOError):
+        wrapper.MMC_select(3)  # selected but not registered: checked by the dll
+    wrapper.MMC_moveR(3, 5)
+    assert lib.calls[-1][:2] == ('MMC_moveR', (3, 5))
+
+
+def test_calls_serialized(mmc):
+    wrapper, lib = mmc
+    threads = [threading.Thread(target=wrapper.MMC_getPos) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5.)
+    assert lib.overlaps == 0
+    assert {thread for name, args, thread in lib.calls if name == 'MMC_getPos'} == \
+           {thread for name, args, thread in lib.calls if name == 'MMC_COM_open'}  # all in the dispatcher thread
+
+
+def test_dispatcher_lifecycle(mmc):
+    wrapper, lib = mmc
+    before = threading.active_count()
+    for _ in range(3):
+        wrapper.close()
+        with pytest.raises(IOError):
+            wrapper.MMC_getPos()
+        wrapper.open()
+        wrapper.MMC_getPos()
+    assert threading.active_count() == before  # each close shuts its dispatcher thread down
+    assert wrapper.MMC_getDLLversion() == 0  # not dispatched
+
+
+def test_prototypes(mmc_module, mmc):
+    module, _ = mmc_module
+    wrapper, lib = mmc
+    for name, (argtypes, restype) in module.PROTOTYPES.items():
+        function = getattr(lib, name)
+        assert function.argtypes == argtypes and function.restype == restype
+
+
+def test_string_buffer_copied(mmc):
+    wrapper, lib = mmc
+    lib.reports = ['P:+0000001000', 'E:-0000000005']
+    first = wrapper.MMC_getStringCR()
+    second = wrapper.MMC_getStringCR()
+    assert (first, second) == ('P:+0000001000', 'E:-0000000005')  # not aliased to the reused buffer
+    string_calls = [args for name, args, thread in lib.calls if name == 'MMC_getStringCR']
+    assert string_calls[0][0] is string_calls[1][0]  # the same buffer is given to the dll
+
+    wrapper.MMC_sendCommand('TE')
+    wrapper.MMC_sendCommand('TE')
+    sent = [args[0] for name, args, thread in lib.calls if name == 'MMC_sendCommand']
+    assert sent == [b'TE', b'TE'] and sent[0] is sent[1]  # encoded once
+    wrapper.MMC_sendCommand('MA10')
+    assert lib.calls[-1][1] == (b'MA10',)
@@ -0,0 +1,659 @@
+# -*- coding: utf-8 -*-
+"""
+Test of the GCS2 wrapper against a fake controller recording the GCS commands
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pipython')
+
+from pipython import GCSError
+from pipython.pidevice.gcs2.gcs2commands import GCS2Commands
+
+from pymodaq_plugins_physik_instrumente.hardware.pi_wrapper import PIWrapper, MotionProfile, SettleDetector, MacroStep, \
+    PositionHistory, ParameterSnapshot
+
+
+class FakeGCSDevice:
+    """ Emulates the GCS commands of a closed loop controller used by the wrapper, the moves are done instantly"""
+
+    def __init__(self, axes=('1', '2')):
+        self.commands = []
+        self.positions = {axis: 0. for axis in axes}
+        self.errcheck = True
+        self.error = 0
+
+    @property
+    def axes(self):
+        return list(self.positions)
+
+    def HasVEL(self):
+        return True
+
+    def HasACC(self):
+        return True
+
+    def HasDEC(self):
+        return False
+
+    def HasMVR(self):
+        return True
+
+    def VEL(self, axis, value):
+        self.commands.append(('VEL', axis, value))
+
+    def ACC(self, axis, value):
+        self.commands.append(('ACC', axis, value))
+
+    def DEC(self, axis, value):
+        self.commands.append(('DEC', axis, value))
+
+    def MOV(self, axis, value):
+        self.commands.append(('MOV', axis, value))
+        self.positions[axis] = value
+
+    def MVR(self, axis, value):
+        self.commands.append(('MVR', axis, value))
+        self.positions[axis] += value
+
+    def qPOS(self, axes):
+        self.commands.append(('POS?', axes, None))
+        axes = axes if isinstance(axes, list) else [axes]
+        return {axis: self.positions[axis] for axis in axes}
+
+    def qERR(self):
+        self.commands.append(('ERR?', None, None))
+        error, self.error = self.error, 0
+        return error
+
+    def StopAll(self):
+        self.commands.append(('STP', None, None))
+
+
+class FakeMessages:
+    """ Stands for the GCS messages layer of pipython, recording each transfer to the controller"""
+    errcheck = True
+    embederr = False
+    timeout = 1000
+
+    def __init__(self):
+        self.transfers = []
+        self.error = 0
+        self.failing = {}  # command -> error code set in the error register when it is executed
+        self.answers = {'POS?': '1=0.5\n', 'MAC?': '\n'}
+        self.interface = FakeInterface(self)
+        self._lock = threading.RLock()
+
+    def execute(self, line):
+        """ Get the answer of a command line, an empty string for a command without answer"""
+        command = line.split(' ')[0]
+        if command == 'ERR?':
+            error, self.error = self.error, 0
+            return f'{error}\n'
+        if command.endswith('?'):
+            return next(answer for prefix, answer in self.answers.items() if line.startswith(prefix))
+        self.error = self.error or self.failing.get(command, 0)
+        return ''
+
+    def send(self, tosend):
+        self.transfers.append(tosend)
+        for line in tosend.splitlines():
+            self.execute(line)
+        if self.errcheck and self.error:
+            error, self.error = self.error, 0
+            raise GCSError(error)
+
+    def read(self, tosend, gcsdata=0):
+        self.transfers.append(tosend)
+        return self.execute(tosend.rstrip('\n'))
+
+
+class FakeInterface:
+    """ Raw link of FakeMessages, the answers of all the lines of a transfer are read together"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.received = ''
+
+    def send(self, tosend):
+        tosend = tosend.rstrip('\n')
+        self.messages.transfers.append(tosend)
+        self.received += ''.join(self.messages.execute(line) for line in tosend.split('\n'))
+
+    def read(self):
+        received, self.received = self.received, ''
+        return received
+
+
+@pytest.fixture
+def pi_wrapper():
+    fake = FakeGCSDevice()
+    wrapper = PIWrapper()
+    wrapper.device = fake
+    return wrapper, fake
+
+
+def test_no_profile(pi_wrapper):
+    wrapper, fake = pi_wrapper
+    wrapper.move_absolute('1', 1.)
+    wrapper.move_relative('1', 1.)
+    assert fake.commands == [('MOV', '1', 1.), ('MVR', '1', 1.)]
+
+
+def test_motion_profiles(pi_wrapper):
+    wrapper, fake = pi_wrapper
+    scan = MotionProfile(velocity=0.1, acceleration=1., deceleration=1., max_distance=0.01)
+    move = MotionProfile(velocity=10.)
+    wrapper.set_motion_profiles('1', [move, scan])
+    assert wrapper.select_motion_profile('1', -0.005) is scan
+    assert wrapper.select_motion_profile('1', 5.) is move
+    assert wrapper.select_motion_profile('2', 5.) is None
+
+    wrapper.move_absolute('1', 1.)
+    wrapper.move_absolute('1', 1.005)
+    wrapper.move_absolute('1', 1.01)
+    wrapper.move_relative('1', 0.005)
+    assert fake.commands == [('POS?', '1', None), ('VEL', '1', 10.), ('MOV', '1', 1.),
+                             ('VEL', '1', 0.1), ('ACC', '1', 1.), ('MOV', '1', 1.005),  # no DEC on this controller
+                             ('MOV', '1', 1.01), ('MVR', '1', 0.005)]  # the scan profile is already set
+
+    fake.commands.clear()
+    wrapper.move_absolute('1', 0.)
+    wrapper.move_absolute('2', 1.)
+    assert fake.commands == [('VEL', '1', 10.), ('MOV', '1', 0.), ('MOV', '2', 1.)]
+
+
+def test_motion_profiles_after_stop(pi_wrapper):
+    wrapper, fake = pi_wrapper
+    wrapper.set_motion_profiles('1', [MotionProfile(velocity=0.1, max_distance=0.01), MotionProfile(velocity=10.)])
+    wrapper.move_absolute('1', 1.)
+    wrapper.stop()
+    fake.positions['1'] = 0.995  # stopped before the target
+    fake.commands.clear()
+    wrapper.move_absolute('1', 1.)
+    assert fake.commands == [('POS?', '1', None), ('VEL', '1', 0.1), ('MOV', '1', 1.)]
+
+    fake.commands.clear()
+    wrapper.set_motion_profiles('1', [])
+    wrapper.move_absolute('1', 5.)
+    assert fake.commands == [('MOV', '1', 5.)]
+
+
+def test_settle_detector():
+    detector = SettleDetector(tolerance=0.1, window=3)
+    assert not detector.add_samples(1.)  # no move started
+    detector.start(1., start_time=0.)
+    # ringing around the target: the first crossing is not taken as settled
+    assert not detector.add_samples([0.5, 0.95, 1.2, 1.05], [0.1, 0.2, 0.3, 0.4])
+    assert not detector.add_samples(0.98, 0.5)
+    assert detector.add_samples([1.01, 1.2], [0.6, 0.7])
+    assert detector.settle_time == pytest.approx(0.4)
+    assert detector.add_samples(2.)  # stays settled until the next move
+
+    detector.start(0., start_time=1.)
+    samples = 0.5 * np.exp(-np.linspace(0, 5, 1001)) * np.cos(np.linspace(0, 100, 1001))  # recorder like batch
+    times = 1. + np.linspace(0, 0.5, 1001)
+    assert detector.add_samples(samples, times)
+    within = np.abs(samples) <= 0.1
+    first = next(index for index in range(len(samples)) if within[index:index + 3].all())
+    assert detector.settle_time == pytest.approx(times[first] - 1.)
+
+
+def test_settle_detection(pi_wrapper):
+    wrapper, fake = pi_wrapper
+    assert wrapper.is_settled('1')
+    wrapper.set_settle_detection('1', tolerance=0.01, window=2)
+    wrapper.move_relative('1', 1.)
+    assert fake.commands[0] == ('POS?', '1', None)  # the target of the relative move is needed
+    assert not wrapper.is_settled('1')
+    wrapper.get_axis_position('1')
+    assert not wrapper.is_settled('1')
+    wrapper.get_axes_positions(['1', '2'])
+    assert wrapper.is_settled('1')
+    assert wrapper.get_settle_time('1') >= 0.
+    assert wrapper.get_settle_time('2') is None
+
+    wrapper.move_absolute('1', 2.)
+    fake.positions['1'] = 1.5
+    wrapper.get_axis_position('1')
+    assert not wrapper.is_settled('1')
+    wrapper.stop()
+    assert wrapper.is_settled('1')
+
+
+def test_deferred_errors(pi_wrapper):
+    wrapper, fake = pi_wrapper
+    with wrapper.deferred_errors():
+        assert not fake.errcheck
+        with wrapper.deferred_errors(check=False):
+            wrapper.move_absolute('1', 1.)
+        assert not fake.errcheck and wrapper.errors_deferred
+        wrapper.get_axis_position('1')
+    assert fake.errcheck and not wrapper.errors_deferred
+    assert [cmd for cmd, axis, value in fake.commands] == ['MOV', 'POS?', 'ERR?']  # a single error query
+
+    fake.error = 7  # position out of limits
+    with pytest.raises(GCSError) as error:
+        with wrapper.deferred_errors():
+            wrapper.move_absolute('1', 100.)
+            wrapper.get_axis_position('1')
+    assert error.value.val == 7
+    assert "MOV('1', 100.0)" in str(error.value)
+    assert fake.errcheck
+
+
+def test_deferred_errors_on_exception(pi_wrapper):
+    wrapper, fake = pi_wrapper
+
+    def failing_qpos(axes):
+        fake.error = 15  # invalid axis identifier
+        raise ValueError('unexpected answer')
+
+    fake.qPOS = failing_qpos
+    with pytest.raises(GCSError) as error:
+        with wrapper.deferred_errors(check=False):
+            wrapper.get_axis_position('3')
+    assert error.value.val == 15
+    assert isinstance(error.value.__context__, ValueError)
+    assert fake.errcheck
+
+
+@pytest.fixture
+def gcs_wrapper():
+    messages = FakeMessages()
+    wrapper = PIWrapper()
+    wrapper.device = GCS2Commands(messages)
+    return wrapper, messages
+
+
+def test_deferred_errors_status_flag(gcs_wrapper):
+    wrapper, messages = gcs_wrapper
+    messages.answers['SRG?'] = '1 1=0x9000\n'  # servo on, on target
+    with wrapper.deferred_errors(watch_status=True):
+        wrapper.move_absolute('1', 0.5)
+        assert wrapper.get_axis_position('1') == 0.5
+    assert messages.transfers == ['MOV 1 0.5', 'POS? 1\nSRG? 1 1', 'ERR?']
+
+    messages.transfers.clear()
+    messages.failing['MOV'] = 7  # position out of limits
+    messages.answers['SRG?'] = '1 1=0x9100\n'  # error flag set
+    with pytest.raises(GCSError) as error:
+        with wrapper.deferred_errors(watch_status=True):
+            wrapper.move_absolute('1', 100.)
+            wrapper.get_axis_position('1')
+            pytest.fail('the error is raised by the first reading')
+    assert error.value.val == 7 and "MOV('1', 100.0)" in str(error.value)
+    assert messages.transfers[:3] == ['MOV 1 100', 'POS? 1\nSRG? 1 1', 'ERR?']
+
+    messages.transfers.clear()
+    with wrapper.deferred_errors():
+        wrapper.get_axis_position('1')  # the status is only read if watched
+    assert messages.transfers == ['POS? 1', 'ERR?']
+
+
+def test_deferred_errors_out_of_order(gcs_wrapper):
+    from contextlib import ExitStack
+    wrapper, messages = gcs_wrapper
+    messages.answers['SRG?'] = '1 1=0x9000\n'
+    master, slave = ExitStack(), ExitStack()  # as the blocks kept open by plugins sharing the wrapper
+    master.enter_context(wrapper.deferred_errors(watch_status=True))
+    slave.enter_context(wrapper.deferred_errors())
+    master.close()  # closed before the nested block
+    messages.transfers.clear()
+    wrapper.get_axis_position('1')
+    assert messages.transfers == ['POS? 1']  # no block watching the status anymore
+    slave.close()
+    assert not wrapper.errors_deferred and wrapper.device.errcheck
+    with wrapper.deferred_errors():
+        messages.transfers.clear()
+        wrapper.get_axis_position('1')
+    assert messages.transfers == ['POS? 1', 'ERR?']  # a new block doesn't inherit the status watching
+
+
+def test_transaction(gcs_wrapper):
+    wrapper, messages = gcs_wrapper
+    wrapper.set_1D_waveform(10, 0, 100, rate=200, axis=2)
+    wrapper.start_waveform(2, 1)
+    assert messages.transfers == [
+        'WCL 2\nERR?\nWAV 2 X RAMP 100 10 0 150 0 0 150\nERR?\nWSL 2 2\nERR?\nWTR 0 200 1\nERR?',
+        'WGC 2 1\nERR?\nWGO 2 1\nERR?']
+
+    with wrapper.transaction() as transaction:
+        transaction.WGO(2, 0)
+        position = transaction.query('qPOS', '1')
+        with pytest.raises(IOError):
+            position.value
+        with pytest.raises(IOError):
+            transaction.qPOS('1')  # queries are not recorded
+    assert position.value == {'1': 0.5}
+    assert messages.transfers[-1] == 'WGO 2 0\nERR?\nPOS? 1\nERR?'  # a single transfer
+
+    messages.answers['MAC?'] = 'A \nB\n'  # answer of several lines
+    messages.transfers.clear()
+    with wrapper.deferred_errors():
+        with wrapper.transaction() as transaction:
+            transaction.WGO(2, 1)
+            position = transaction.query('qPOS', '1')
+            macros = transaction.query('qMAC')
+    assert position.value == {'1': 0.5} and macros.value == 'A \nB\n'
+    assert messages.transfers == ['WGO 2 1\nPOS? 1\nMAC?', 'ERR?']  # the error is checked by the block
+
+
+def test_transaction_errors(gcs_wrapper):
+    wrapper, messages = gcs_wrapper
+    with pytest.raises(ValueError):
+        with wrapper.transaction() as transaction:
+            transaction.WGO(1, 0)
+            raise ValueError
+    assert messages.transfers == []  # nothing sent
+
+    messages.failing['WSL'] = 1  # parameter syntax error
+    with pytest.raises(GCSError) as error:
+        with wrapper.transaction() as transaction:
+            transaction.WSL(1, 1)
+            transaction.WGO(1, 1)
+            position = transaction.query('qPOS', '1')
+    assert error.value.val == 1
+    assert "WSL(1, 1) -> ['WSL 1 1']" in str(error.value) and 'WGO' not in str(error.value)
+    assert messages.transfers == ['WSL 1 1\nERR?\nWGO 1 1\nERR?\nPOS? 1\nERR?']
+    assert not position.done
+
+
+def test_macro(gcs_wrapper):
+    wrapper, messages = gcs_wrapper
+    steps = [MacroStep({'1': 0.5}, dwell=10, trigger=1), MacroStep({'1': '$1', '2': 2}, dwell='$2')]
+    name, content = wrapper.build_macro(steps, trigger_pulse=2)
+    assert len(name) == 8 and name.startswith(wrapper.macro_prefix)
+    assert content.split('\n') == ['MOV 1 0.5', 'WAC ONT? 1 = 1', 'DEL 10', 'DIO 1 1', 'DEL 2', 'DIO 1 0',
+                                    'MOV 1 $1 2 2', 'WAC ONT? 1 = 1', 'WAC ONT? 2 = 1', 'DEL $2']
+    assert wrapper.build_macro(steps, trigger_pulse=1)[0] != name
+
+    assert wrapper.upload_macro(steps, trigger_pulse=2) == name
+    assert messages.transfers == ['MAC?', f'MAC BEG {name}\n{content}\nMAC END\nERR?']
+    assert wrapper.upload_macro(steps, trigger_pulse=2) == name  # already on the controller
+    wrapper.start_macro(name, 1.5, 20)
+    assert messages.transfers[2:] == [f'MAC START {name} 1.5 20']
+
+    messages.answers['MAC?'] = f'{name}\nOTHER\n'
+    messages.transfers.clear()
+    assert wrapper.get_macros(refresh=True) == ['OTHER', name]
+    assert wrapper.upload_macro(steps, trigger_pulse=2) == name
+    assert messages.transfers == ['MAC?']
+
+
+def test_position_history(tmp_path):
+    history = PositionHistory(size=4)
+    arrays = [history._times, history._positions]
+    for index in range(6):
+        history.append('1' if index % 2 else '2', float(index), on_target=index % 2, timestamp=100. + index)
+    assert len(history) == 4
+    assert history._times is arrays[0] and history._positions is arrays[1]  # no allocation
+    snapshot = history.snapshot()
+    assert list(snapshot['position']) == [2., 3., 4., 5.]  # chronological, oldest readings overwritten
+    assert list(snapshot['axis']) == ['2', '1', '2', '1']
+    assert list(history.snapshot('1')['on_target']) == [1, 1]
+    assert len(history.snapshot('unknown')['time']) == 0
+
+    history.export(tmp_path / 'history.csv', axis_name='2')
+    assert (tmp_path / 'history.csv').read_text().splitlines() == \
+           ['time,axis,position,on_target', '102.000000,2,2.0,0', '104.000000,2,4.0,0']
+    assert PositionHistory.from_memory(1900).size == 100
+
+
+def test_position_history_threads():
+    history = PositionHistory(size=50)
+    done = threading.Event()
+
+    def fill(axis_name):
+        for index in range(2000):
+            history.append(axis_name, float(index), timestamp=float(index))
+        done.set()
+
+    threads = [threading.Thread(target=fill, args=(axis_name,)) for axis_name in ('1', '2')]
+    for thread in threads:
+        thread.start()
+    while not done.is_set():
+        snapshot = history.snapshot()
+        assert not np.any(np.isnan(snapshot['position']))  # no slot counted before being written
+        for axis_name in ('1', '2'):
+            assert np.all(np.diff(history.snapshot(axis_name)['position']) > 0)  # chronological per axis
+    for thread in threads:
+        thread.join(5.)
+    assert len(history) == 50
+    assert history.snapshot()['position'][-1] == 1999.  # the last reading of the thread finishing last
+
+
+def test_position_history_of_wrapper(pi_wrapper):
+    wrapper, fake = pi_wrapper
+    wrapper.position_history.resize(10)
+    wrapper.set_settle_detection('1', tolerance=0.01, window=1)
+    wrapper.move_absolute('1', 1.)
+    wrapper.get_axis_position('1')
+    wrapper.get_axes_positions(['1', '2'])
+    snapshot = wrapper.position_history.snapshot()
+    assert list(snapshot['axis']) == ['1', '1', '2']
+    assert list(snapshot['position']) == [1., 1., 0.]
+    assert list(snapshot['on_target']) == [1, 1, -1]
+    assert snapshot['time'][1] == snapshot['time'][2]  # read with a single query
+
+
+def test_transaction_sequential_fallback(gcs_wrapper):
+    wrapper, messages = gcs_wrapper
+    messages.interface = None  # as with a pipython version without the internals used for single transfers
+    wrapper.device.HasTRO = lambda: True
+    wrapper.set_on_target_trigger('1', line=2)
+    assert messages.transfers == ['CTO 2 2 1 2 3 2', 'TRO 2 1']  # one call after the other
+
+    with wrapper.transaction() as transaction:
+        transaction.WGO(2, 0)
+        position = transaction.query('qPOS', '1')
+        with pytest.raises(IOError):
+            position.value
+    assert position.value == {'1': 0.5}
+    with pytest.raises(IOError):
+        transaction.cmdstr
+
+    messages.failing['MOV'] = 7
+    with pytest.raises(GCSError) as error:
+        with wrapper.deferred_errors():
+            with wrapper.transaction(check=True) as transaction:
+                transaction.MOV('1', 100.)
+                transaction.WGO(2, 0)
+    assert error.value.val == 7 and "MOV('1', 100.0)" in str(error.value)
+
+
+def test_on_target_trigger(gcs_wrapper):
+    wrapper, messages = gcs_wrapper
+    wrapper.device.HasTRO = lambda: True
+    wrapper.set_on_target_trigger('1', line=2)
+    wrapper.set_on_target_trigger('1', line=2, enable=False)
+    assert messages.transfers == ['CTO 2 2 1 2 3 2\nERR?\nTRO 2 1\nERR?', 'TRO 2 0\nERR?']
+
+    wrapper.device.HasTRO = lambda: False
+    messages.transfers.clear()
+    wrapper.set_on_target_trigger('1', line=1)
+    wrapper.set_on_target_trigger('1', line=1, enable=False)
+    assert messages.transfers == ['CTO 1 2 1 1 3 2\nERR?', 'CTO 1 3 0\nERR?']  # back to the default trigger mode
+
+
+class FakeLink:
+    """ Link to a fake controller that can be cut, the commands raise OSError while it is down"""
+
+    def __init__(self, device):
+        self.device = device
+        self.up = True
+        self.connections = 0
+
+    def cut(self, name):
+        method = getattr(self.device, name)
+
+        def call(*args):
+            if not self.up:
+                raise OSError('link lost')
+            return method(*args)
+        return call
+
+
+@pytest.fixture
+def supervised_wrapper():
+    fake = FakeGCSDevice()
+    link = FakeLink(fake)
+    for name in ('qPOS', 'MOV', 'MVR'):
+        setattr(fake, name, link.cut(name))
+    fake.IsControllerReady = link.cut('HasMVR')
+    fake.qFRF = lambda axis: {axis: True}
+    fake.HasqFRF = lambda: True
+    fake.CloseConnection = lambda: None
+
+    wrapper = PIWrapper()
+    wrapper.device = fake
+    wrapper.heartbeat_interval = 0.05
+    wrapper.reconnect_backoff = (0.01, 0.04)
+    wrapper.reconnect_timeout = 5.
+    wrapper.max_queued_calls = 1
+
+    def connect_device():
+        if not link.up:
+            raise OSError('no device')
+        link.connections += 1
+        wrapper.device = fake
+    wrapper.connect_device = connect_device
+    wrapper.start_supervision()
+    yield wrapper, fake, link
+    wrapper.stop_supervision()
+
+
+def test_reconnect(supervised_wrapper):
+    wrapper, fake, link = supervised_wrapper
+    assert wrapper.is_referenced('1')
+    fake.HasqFRF = lambda: pytest.fail('the referencing status is kept')
+    wrapper.move_absolute('1', 1.)
+
+    link.up = False
+    time.sleep(0.2)
+    assert not wrapper.link_up  # detected by the heartbeat
+    positions, errors = [], []
+
+    def read():
+        try:
+            positions.append(wrapper.get_axis_position('1'))
+        except IOError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    assert len(errors) == 1  # only one call can wait for the link
+    link.up = True
+    for thread in threads:
+        thread.join(5.)
+    assert positions == [1.] and wrapper.link_up
+    assert wrapper.reconnections == link.connections == 1
+    assert wrapper.is_referenced('1')
+
+
+def test_link_lost_during_call(supervised_wrapper):
+    wrapper, fake, link = supervised_wrapper
+    wrapper.heartbeat_interval = 10.  # the loss is only seen by the calls
+    time.sleep(0.1)
+    link.up = False
+    timer = threading.Timer(0.1, lambda: setattr(link, 'up', True))
+    timer.start()
+    wrapper.move_absolute('1', 2.)  # sent again once reconnected
+    assert fake.positions['1'] == 2. and wrapper.reconnections == 1
+
+    link.up = False
+    timer = threading.Timer(0.1, lambda: setattr(link, 'up', True))
+    timer.start()
+    with pytest.raises(IOError):
+        wrapper.move_relative('1', 1.)  # not sent again, it would be done twice
+    timer.join()
+    wrapper.move_relative('1', 1.)
+    assert fake.positions['1'] == 3.
+
+
+def test_all_calls_supervised(supervised_wrapper):
+    wrapper, fake, link = supervised_wrapper
+    wrapper.heartbeat_interval = 10.  # the loss is only seen by the calls
+    servo = {'1': True}
+    fake.qSVO = lambda axis: {axis: servo[axis]}
+    fake.SVO = lambda axis, value: servo.__setitem__(axis, value)
+    fake.MAC_START = lambda name, args: fake.commands.append(('MAC START', name, args))
+    for name in ('qSVO', 'SVO', 'MAC_START'):
+        setattr(fake, name, link.cut(name))
+    time.sleep(0.1)
+
+    link.up = False
+    threading.Timer(0.1, lambda: setattr(link, 'up', True)).start()
+    wrapper.set_servo('1', False)  # waits for the reconnection instead of failing
+    assert servo['1'] is False and wrapper.reconnections == 1
+
+    link.up = False
+    timer = threading.Timer(0.1, lambda: setattr(link, 'up', True))
+    timer.start()
+    with pytest.raises(IOError):
+        wrapper.start_macro('PMD1')  # not started twice
+    timer.join()
+    wrapper.start_macro('PMD1', 2)
+    assert fake.commands == [('MAC START', 'PMD1', '2')]
+
+
+class FakeParameterMessages(FakeMessages):
+    """ Answers the SPA? queries and applies the SPA commands on a set of parameters"""
+
+    def __init__(self, parameters):
+        super().__init__()
+        self.parameters = parameters
+        self.answers = {'HPA?': '', '*IDN?': 'PI fake controller\n'}
+
+    def execute(self, line):
+        words = line.split()
+        if words[0] == 'SPA':
+            for item, param, value in zip(words[1::3], words[2::3], words[3::3]):
+                self.parameters[item][int(param, 0)] = value
+            return ''
+        if words[0] == 'SPA?':
+            pairs = [(item, int(param, 0)) for item, param in zip(words[1::2], words[2::2])] or \
+                [(item, param) for item, values in self.parameters.items() for param in values]
+            return ' \n'.join(f'{item} {hex(param)}={self.parameters[item][param]}' for item, param in pairs) + '\n'
+        return super().execute(line)
+
+
+def test_parameters(tmp_path):
+    parameters = {'1': {0x1: '10', 0x2: '0.5', 0x7000601: 'MM'}, '2': {0x1: '3', 0x2: '0.25'}}
+    messages = FakeParameterMessages(parameters)
+    wrapper = PIWrapper()
+    wrapper.device = GCS2Commands(messages)
+    wrapper.parameter_batch_size = 2
+
+    snapshot = wrapper.read_parameters()
+    assert len(snapshot) == 5 and snapshot.controller == 'PI fake controller'
+    assert [transfer for transfer in messages.transfers if transfer.startswith('SPA?')] == ['SPA?']
+    snapshot.save(tmp_path / 'parameters.json')
+    loaded = ParameterSnapshot.load(tmp_path / 'parameters.json')
+    assert loaded.parameters == snapshot.parameters and loaded.created == snapshot.created
+
+    assert snapshot.diff({'1': {0x1: 10, 0x2: 0.6}, '2': {0x1: '3', 0x3: 1}}) == {'1': {0x2: 0.6}, '2': {0x3: 1}}
+
+    parameters['1'][0x1] = '12'
+    parameters['2'][0x2] = '1.5'
+    messages.transfers.clear()
+    assert wrapper.restore_parameters(loaded) == {'1': {0x1: '10'}, '2': {0x2: '0.25'}}
+    assert messages.transfers[-1] == 'SPA 1 1 10 2 2 0.25\nERR?'  # only the changed values, in one transfer
+    assert parameters == {'1': {0x1: '10', 0x2: '0.5', 0x7000601: 'MM'}, '2': {0x1: '3', 0x2: '0.25'}}
+
+    assert wrapper.read_parameters({'1': [0x1, 0x2], '2': [0x1]}).parameters == \
+           {'1': {0x1: '10', 0x2: '0.5'}, '2': {0x1: '3'}}
+    assert [transfer for transfer in messages.transfers if transfer.startswith('SPA?')][-2:] == \
+           ['SPA? 1 1 1 2', 'SPA? 2 1']
+
+    wrapper.write_parameters({'1': {0x1: 1, 0x2: 2}, '2': {0x1: 3}})
+    assert messages.transfers[-1] == 'SPA 1 1 1 1 2 2\nERR?\nSPA 2 1 3\nERR?'
+
+    (tmp_path / 'future.json').write_text('{"version": 2, "parameters": {}}')
+    with pytest.raises(ValueError):
+        ParameterSnapshot.load(tmp_path / 'future.json')